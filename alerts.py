@@ -0,0 +1,196 @@
+# alerts.py
+
+import asyncio
+import logging
+from bisect import bisect_left, bisect_right
+
+from async_crypto_api import ensure_coin_index, get_coin_prices_async
+from config import ALERT_SEND_CONCURRENCY
+from crypto_api import resolve_coin_id
+from database import get_all_active_reminders, mark_reminders_as_notified
+
+logger = logging.getLogger(__name__)
+
+
+class ReminderIndex:
+    """
+    Индекс активных напоминаний: по каждой монете — отсортированные пороги.
+
+    Для направления 'above' срабатывают все цели <= цены, для 'below' —
+    все цели >= цены, поэтому сработавшие напоминания находятся одним
+    bisect по отсортированному массиву порогов, без перебора.
+    """
+
+    def __init__(self, rows=()):
+        """
+        :param rows: строки get_all_active_reminders —
+                     (id, user_id, coin, target_price, direction)
+        """
+        grouped = {}
+        for row in rows:
+            direction = 'below' if row[4] == 'below' else 'above'
+            grouped.setdefault(row[2], {'above': [], 'below': []})[direction].append(row)
+
+        # {coin: {direction: (targets, reminders)}} — оба списка отсортированы по цели
+        self._coins = {}
+        for coin, directions in grouped.items():
+            self._coins[coin] = {}
+            for direction, reminders in directions.items():
+                reminders.sort(key=lambda r: r[3])
+                self._coins[coin][direction] = ([r[3] for r in reminders], reminders)
+
+    def __len__(self):
+        return sum(len(targets) for d in self._coins.values() for targets, _ in d.values())
+
+    def coins(self):
+        """Возвращает монеты, по которым есть активные напоминания."""
+        return list(self._coins)
+
+    def triggered(self, coin: str, price: float):
+        """
+        Возвращает напоминания по монете, сработавшие при данной цене.
+
+        :return: list of (id, user_id, coin, target_price, direction)
+        """
+        directions = self._coins.get(coin)
+        if not directions:
+            return []
+        above_targets, above = directions['above']
+        below_targets, below = directions['below']
+        return above[:bisect_right(above_targets, price)] + below[bisect_left(below_targets, price):]
+
+    def could_trigger(self, coin: str, price: float) -> bool:
+        """Проверяет, сработает ли при данной цене хотя бы одно напоминание по монете."""
+        directions = self._coins.get(coin)
+        if not directions:
+            return False
+        above_targets, _ = directions['above']
+        below_targets, _ = directions['below']
+        return bool(above_targets and above_targets[0] <= price
+                    or below_targets and below_targets[-1] >= price)
+
+
+def load_reminder_index():
+    """
+    Строит индекс всех активных напоминаний. Монеты приводятся к нижнему
+    регистру, чтобы 'BTC' и 'btc' были одной монетой и для проверки по
+    расписанию, и для потока цен.
+    """
+    return ReminderIndex((id_, user_id, coin.lower(), target_price, direction)
+                         for id_, user_id, coin, target_price, direction in get_all_active_reminders())
+
+
+async def check_reminders(bot):
+    """
+    Проверяет все активные напоминания за один проход.
+
+    Загружает напоминания одним запросом (в потоке), получает цену каждой монеты
+    один раз (одним пакетным запросом), помечает сработавшие одной
+    транзакцией и рассылает сообщения параллельно.
+
+    :param bot: telegram.Bot для отправки сообщений
+    :return: количество сработавших напоминаний
+    """
+    index = await asyncio.to_thread(load_reminder_index)
+    if not len(index):
+        return 0
+
+    await ensure_coin_index()
+    coin_ids = {coin: resolve_coin_id(coin) for coin in index.coins()}
+    prices = await get_coin_prices_async(coin_ids.values())
+
+    triggered = []
+    for coin, coin_id in coin_ids.items():
+        price = prices.get(coin_id, {}).get('usd')
+        if price is None:
+            continue
+        triggered.extend((reminder, price) for reminder in index.triggered(coin, price))
+
+    if not triggered:
+        return 0
+
+    # Сначала помечаем, потом отправляем: лучше не доставить одно сообщение,
+    # чем слать его на каждой проверке. Уже отправленные по потоку цен пропускаем
+    marked = await asyncio.to_thread(mark_reminders_as_notified, [reminder[0] for reminder, _ in triggered])
+    triggered = [(reminder, price) for reminder, price in triggered if reminder[0] in marked]
+    await send_alerts(bot, triggered)
+    logger.info(f"Сработало напоминаний: {len(triggered)} из {len(index)}")
+    return len(triggered)
+
+
+class StreamAlerts:
+    """
+    Проверка напоминаний по тикам потока цен (price_stream.py).
+
+    На каждый тик выполняется только could_trigger — сравнение цены с
+    крайними порогами монеты. Отправка запускается, лишь когда порог
+    пересечён, после чего индекс перечитывается из базы. Обращения к базе
+    идут в потоке, чтобы не задерживать обработку тиков.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.index = ReminderIndex()
+        self._coins = {}  # {coin_id: монеты напоминаний (как их ввели) с этим ID}
+        self._firing = set()
+        self._tasks = set()
+        self.fired = 0
+
+    @staticmethod
+    def _load():
+        # Тот же индекс и те же ID монет, что и в check_reminders
+        index = load_reminder_index()
+        coins = {}
+        for coin in index.coins():
+            coins.setdefault(resolve_coin_id(coin), []).append(coin)
+        return index, coins
+
+    async def reload(self):
+        """Перечитывает активные напоминания."""
+        self.index, self._coins = await asyncio.to_thread(self._load)
+
+    def on_tick(self, coin_id: str, price: float):
+        """Обработчик тика для PriceStream.add_listener."""
+        for coin in self._coins.get(coin_id, ()):
+            if coin in self._firing or not self.index.could_trigger(coin, price):
+                continue
+            self._firing.add(coin)
+            task = asyncio.create_task(self._fire(coin, price))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _fire(self, coin, price):
+        try:
+            reminders = self.index.triggered(coin, price)
+            marked = await asyncio.to_thread(mark_reminders_as_notified,
+                                             [reminder[0] for reminder in reminders])
+            await self.reload()
+            triggered = [(reminder, price) for reminder in reminders if reminder[0] in marked]
+            self.fired += len(triggered)
+            await send_alerts(self.bot, triggered)
+        except Exception as e:
+            logger.error(f"Ошибка при проверке напоминаний по {coin}: {e}")
+        finally:
+            self._firing.discard(coin)
+
+
+async def send_alerts(bot, triggered):
+    """
+    Параллельно отправляет сообщения о сработавших напоминаниях.
+
+    :param triggered: list of (reminder, price)
+    """
+    semaphore = asyncio.Semaphore(ALERT_SEND_CONCURRENCY)
+
+    async def send(reminder, price):
+        _, user_id, coin, target_price, direction = reminder
+        arrow = "📈" if direction == 'above' else "📉"
+        text = (f"🔔 {arrow} {coin.upper()} достиг цели ${target_price:,.2f}\n"
+                f"Текущая цена: ${price:,.2f}")
+        async with semaphore:
+            try:
+                await bot.send_message(chat_id=user_id, text=text)
+            except Exception as e:
+                logger.error(f"Ошибка при отправке напоминания {reminder[0]} для {user_id}: {e}")
+
+    await asyncio.gather(*(send(reminder, price) for reminder, price in triggered))
@@ -1,54 +1,283 @@
 # analytics.py
 
-from database import get_portfolio
-from crypto_api import get_coin_price
+import asyncio
 
+import numpy as np
 
-def calculate_portfolio(user_id):
+from database import get_portfolio, get_portfolios, get_realized_pnl, get_user_currency, get_user_currencies
+from crypto_api import coin_id_of, fx_rates, get_coin_prices, resolve_coin_id
+from async_crypto_api import ensure_coin_index, ensure_fx_rates, get_coin_prices_async
+from fx import BASE_CURRENCY
+from config import ANALYTICS_HISTORY_DAYS, ANALYTICS_BATCH_USERS
+from price_history import get_price_matrix
+
+PERIODS_PER_YEAR = 365  # крипторынок торгуется каждый день
+
+
+def calculate_portfolio(user_id, snapshot=None, currency=None):
     """
     Рассчитывает текущее состояние портфеля пользователя.
 
+    Все суммы считаются по ценам в USD и переводятся в валюту пользователя
+    по таблице курсов — отдельных запросов цен в этой валюте нет.
+
     :param user_id: ID пользователя Telegram
+    :param snapshot: MarketSnapshot — если передан, цены берутся только из него
+    :param currency: валюта отчёта; по умолчанию — из настроек пользователя
     :return: dict с данными по активам и общему состоянию портфеля
     """
     portfolio = get_portfolio(user_id)
-    results = []
-    total_invested = 0.0
-    total_current = 0.0
+    currency = currency or get_user_currency(user_id)
+
+    # Одним запросом получаем цены всех монет портфеля
+    coin_ids = [coin_id_of(symbol, coin_id) for symbol, _, _, coin_id in portfolio]
+    if snapshot is not None:
+        prices = snapshot.prices
+    else:
+        prices = get_coin_prices(coin_ids)
+
+    realized = get_realized_pnl([user_id]).get(user_id, 0.0)
+    return _summarize_portfolio(portfolio, coin_ids, prices, realized, currency)
+
+
+async def calculate_portfolio_async(user_id, snapshot=None, currency=None):
+    """
+    Асинхронный аналог calculate_portfolio: цены запрашиваются без блокировки
+    event loop, а история цен для риск-метрик читается и считается в потоке.
+
+    :param user_id: ID пользователя Telegram
+    :param snapshot: MarketSnapshot — если передан, цены берутся только из него
+    :param currency: валюта отчёта; по умолчанию — из настроек пользователя
+    :return: dict с данными по активам и общему состоянию портфеля
+    """
+    portfolio = get_portfolio(user_id)
+    currency = currency or get_user_currency(user_id)
+
+    await ensure_coin_index()
+    await ensure_fx_rates()
+    coin_ids = [coin_id_of(symbol, coin_id) for symbol, _, _, coin_id in portfolio]
+    if snapshot is not None:
+        prices = snapshot.prices
+    else:
+        prices = await get_coin_prices_async(coin_ids)
+
+    realized = get_realized_pnl([user_id]).get(user_id, 0.0)
+    return await asyncio.to_thread(_summarize_portfolio, portfolio, coin_ids, prices, realized, currency)
+
+
+def calculate_portfolios(user_ids, snapshot):
+    """
+    Пакетно рассчитывает портфели многих пользователей (для рассылок).
+
+    Позиции всех пользователей загружаются одним запросом и считаются как
+    плоские массивы: суммы по пользователям — через np.bincount, стоимость
+    во времени — умножением матрицы позиций (пользователи × монеты) на
+    матрицу цен (монеты × дни) блоками по ANALYTICS_BATCH_USERS.
+
+    :param user_ids: list ID пользователей
+    :param snapshot: MarketSnapshot с текущими ценами
+    :return: dict {user_id: результат в формате calculate_portfolio}
+    """
+    user_ids = list(user_ids)
+    # Рассылку ведущий процесс делает по всем пользователям, а его profile_cache
+    # не видит изменений других процессов — читаем базу напрямую
+    currencies = get_user_currencies(user_ids, cached=False)
+    results = {user_id: _build_result([], _empty_risk(), currency=currencies.get(user_id))
+               for user_id in user_ids}
+    rows = get_portfolios(user_ids)
+    if not rows:
+        return results
+    realized = get_realized_pnl(user_ids, cached=False)
+
+    user_index = {user_id: i for i, user_id in enumerate(user_ids)}
+    # Позиции без сохранённого ID монеты (старые сделки) — по символу, один раз на символ
+    symbol_ids = {symbol: resolve_coin_id(symbol) for symbol in {row[1] for row in rows if not row[4]}}
+    row_ids = [row[4] or symbol_ids[row[1]] for row in rows]
+    coin_ids = sorted(set(row_ids))
+    coin_index = {coin_id: i for i, coin_id in enumerate(coin_ids)}
+
+    users = np.array([user_index[row[0]] for row in rows])
+    coins = np.array([coin_index[coin_id] for coin_id in row_ids])
+    amounts = np.array([row[2] for row in rows], dtype=float)
+    avg_prices = np.array([row[3] for row in rows], dtype=float)
+    current_prices = _price_vector(coin_ids, snapshot.prices)[coins]
+
+    priced = current_prices > 0
+    users, coins, amounts, avg_prices, current_prices = (
+        users[priced], coins[priced], amounts[priced], avg_prices[priced], current_prices[priced])
+    positions = [rows[i] for i in np.flatnonzero(priced)]
+
+    invested, current, profit, roi = _position_values(amounts, avg_prices, current_prices)
+    totals_current = np.bincount(users, weights=current, minlength=len(user_ids))
+    weights = np.divide(current, totals_current[users],
+                        out=np.zeros_like(current), where=totals_current[users] > 0)
+    hhi = np.bincount(users, weights=weights ** 2, minlength=len(user_ids))
+
+    # Стоимость портфелей во времени: (пользователи × монеты) @ (монеты × дни)
+    _, price_matrix = get_price_matrix(coin_ids, ANALYTICS_HISTORY_DAYS)
+    price_matrix = np.nan_to_num(price_matrix)
+    risk = {}
+    for start in range(0, len(user_ids), ANALYTICS_BATCH_USERS):
+        in_block = (users >= start) & (users < start + ANALYTICS_BATCH_USERS)
+        quantities = np.zeros((min(ANALYTICS_BATCH_USERS, len(user_ids) - start), len(coin_ids)))
+        np.add.at(quantities, (users[in_block] - start, coins[in_block]), amounts[in_block])
+        block_risk = _risk_metrics(quantities @ price_matrix)
+        for offset in range(quantities.shape[0]):
+            risk[start + offset] = {name: values[offset] for name, values in block_risk.items()}
+
+    per_user = {}
+    for i, row in enumerate(positions):
+        per_user.setdefault(users[i], []).append(
+            (row[1], amounts[i], avg_prices[i], current_prices[i],
+             invested[i], current[i], profit[i], roi[i], weights[i]))
+
+    for index, assets in per_user.items():
+        user_risk = dict(risk[index], hhi=hhi[index])
+        user_id = user_ids[index]
+        results[user_id] = _build_result(assets, user_risk, realized.get(user_id, 0.0),
+                                         currencies.get(user_id))
+    return results
 
-    for symbol, amount, avg_price in portfolio:
-        current_price = get_coin_price(symbol)
-        if not current_price:
-            continue
 
-        invested_value = amount * avg_price
-        current_value = amount * current_price
-        profit = current_value - invested_value
-        roi = (profit / invested_value) * 100 if invested_value != 0 else 0
+def _price_vector(coin_ids, prices):
+    """Цены монет в USD массивом; отсутствующие — NaN."""
+    return np.array([prices.get(coin_id, {}).get('usd') or np.nan for coin_id in coin_ids], dtype=float)
 
+
+def _position_values(amounts, avg_prices, current_prices):
+    """Вложено, текущая стоимость, прибыль и ROI (%) по всем позициям сразу."""
+    invested = amounts * avg_prices
+    current = amounts * current_prices
+    profit = current - invested
+    roi = np.divide(profit, invested, out=np.zeros_like(profit), where=invested != 0) * 100
+    return invested, current, profit, roi
+
+
+def _risk_metrics(values):
+    """
+    Считает риск-метрики для строк матрицы стоимости портфелей во времени.
+
+    :param values: массив shape (N, T) — стоимость N портфелей по дням
+    :return: dict {'volatility', 'max_drawdown', 'sharpe'} — массивы shape (N,);
+             волатильность и просадка в процентах, годовые
+    """
+    n = values.shape[0]
+    if values.shape[1] < 3:
+        return {name: np.zeros(n) for name in ('volatility', 'max_drawdown', 'sharpe')}
+
+    previous = values[:, :-1]
+    returns = np.divide(np.diff(values, axis=1), previous,
+                        out=np.zeros_like(previous), where=previous > 0)
+    mean = returns.mean(axis=1)
+    std = returns.std(axis=1, ddof=1)
+    annual = np.sqrt(PERIODS_PER_YEAR)
+
+    peaks = np.maximum.accumulate(values, axis=1)
+    drawdown = np.divide(values, peaks, out=np.ones_like(values), where=peaks > 0) - 1
+
+    return {
+        'volatility': std * annual * 100,
+        'max_drawdown': drawdown.min(axis=1) * 100,
+        'sharpe': np.divide(mean, std, out=np.zeros_like(mean), where=std > 0) * annual,
+    }
+
+
+def _empty_risk():
+    return {'volatility': 0.0, 'max_drawdown': 0.0, 'sharpe': 0.0, 'hhi': 0.0}
+
+
+def _summarize_portfolio(portfolio, coin_ids, prices, realized=0.0, currency=BASE_CURRENCY):
+    """
+    Собирает результат calculate_portfolio из позиций и цен одним векторным проходом.
+
+    :param portfolio: строки get_portfolio — (symbol, amount, avg_price, coin_id)
+    :param coin_ids: list ID монет позиций (в порядке portfolio)
+    :param prices: dict {coin_id: {'usd': price}}
+    :param realized: прибыль, зафиксированная продажами (в USD)
+    :param currency: валюта результата
+    """
+    ids = list(coin_ids)
+    current_prices = _price_vector(ids, prices)
+    priced = current_prices > 0
+    if not priced.any():
+        return _build_result([], _empty_risk(), realized, currency)
+
+    symbols = [row[0] for row, ok in zip(portfolio, priced) if ok]
+    ids = [coin_id for coin_id, ok in zip(ids, priced) if ok]
+    amounts = np.array([row[1] for row in portfolio], dtype=float)[priced]
+    avg_prices = np.array([row[2] for row in portfolio], dtype=float)[priced]
+    current_prices = current_prices[priced]
+
+    invested, current, profit, roi = _position_values(amounts, avg_prices, current_prices)
+    total_current = current.sum()
+    weights = current / total_current if total_current > 0 else np.zeros_like(current)
+
+    # Стоимость текущих позиций во времени — для волатильности, просадки и Шарпа
+    _, price_matrix = get_price_matrix(ids, ANALYTICS_HISTORY_DAYS)
+    values = amounts @ np.nan_to_num(price_matrix)
+    risk = {name: metric[0] for name, metric in _risk_metrics(values.reshape(1, -1)).items()}
+    risk['hhi'] = float((weights ** 2).sum())
+
+    assets = zip(symbols, amounts, avg_prices, current_prices, invested, current, profit, roi, weights)
+    return _build_result(list(assets), risk, realized, currency)
+
+
+def _build_result(assets, risk, realized=0.0, currency=BASE_CURRENCY):
+    """
+    Формирует dict в формате calculate_portfolio.
+
+    profit — нереализованная прибыль по открытым позициям (она же unrealized),
+    realized — прибыль, зафиксированная продажами, в том числе по закрытым позициям.
+    Денежные поля переводятся из USD в currency по текущему курсу; если курс
+    неизвестен, результат остаётся в USD.
+
+    :param assets: list of (symbol, amount, avg_price, current_price,
+                   invested, current, profit, roi, weight) — суммы в USD
+    :param risk: dict с hhi, volatility, max_drawdown, sharpe
+    :param realized: зафиксированная прибыль в USD
+    :param currency: валюта результата
+    """
+    currency = (currency or BASE_CURRENCY).lower()
+    rate = fx_rates.rate(currency)
+    if rate is None:
+        currency, rate = BASE_CURRENCY, 1.0
+
+    results = []
+    total_invested = 0.0
+    total_current = 0.0
+    for symbol, amount, avg_price, current_price, invested, current, profit, roi, weight in assets:
         results.append({
             'symbol': symbol.upper(),
-            'amount': amount,
-            'avg_price': avg_price,
-            'current_price': current_price,
-            'invested': invested_value,
-            'current': current_value,
-            'profit': profit,
-            'roi': roi
+            'amount': float(amount),
+            'avg_price': float(avg_price) * rate,
+            'current_price': float(current_price) * rate,
+            'invested': float(invested) * rate,
+            'current': float(current) * rate,
+            'profit': float(profit) * rate,
+            'roi': float(roi),
+            'weight': float(weight) * 100
         })
-
-        total_invested += invested_value
-        total_current += current_value
+        total_invested += float(invested) * rate
+        total_current += float(current) * rate
 
     total_profit = total_current - total_invested
     total_roi = (total_profit / total_invested * 100) if total_invested != 0 else 0
 
     return {
+        'currency': currency,
         'assets': results,
         'total': {
             'invested': round(total_invested, 2),
             'current': round(total_current, 2),
             'profit': round(total_profit, 2),
-            'roi': round(total_roi, 2)
+            'roi': round(total_roi, 2),
+            'realized': round(float(realized) * rate, 2),
+            'unrealized': round(total_profit, 2)
+        },
+        'metrics': {
+            'hhi': round(float(risk['hhi']), 4),
+            'volatility': round(float(risk['volatility']), 2),
+            'max_drawdown': round(float(risk['max_drawdown']), 2),
+            'sharpe': round(float(risk['sharpe']), 2)
         }
-    }
\ No newline at end of file
+    }
@@ -1,74 +1,303 @@
 # app.py
 
+from datetime import datetime
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, ConversationHandler, MessageHandler, filters
-from notifications import scheduler, send_daily_report, send_weekly_report
+from notifications import scheduler, send_daily_report_to_all, send_weekly_report_to_all
+from async_crypto_api import close_client, refresh_fx_rates
+from charts import chart_cache, start_chart_pool, shutdown_chart_pool
+from crypto_api import price_cache
+from database import init_db, profile_cache
+from alerts import StreamAlerts, check_reminders
+from config import (BOT_TOKEN, ALERT_CHECK_INTERVAL, FX_REFRESH_INTERVAL, INGEST_ENABLED, INGEST_INTERVAL,
+                    PRICE_SAMPLE_INTERVAL, STREAMING_ENABLED, STREAM_WATCHLIST_INTERVAL, STREAM_FLUSH_INTERVAL,
+                    RECOMMEND_REFRESH_INTERVAL, CONVERSATION_TIMEOUT, PERSISTENCE_EVICT_INTERVAL, METRICS_ENABLED)
+from ingestion import ingest_prices, ingestor
+from metrics import registry, start_metrics_server
+from recommendation import refresh_recommendations
+from price_stream import price_stream, sync_stream_watchlist, flush_stream_prices
+from price_history import prune_history, sample_prices
+from persistence import SQLitePersistence, evict_idle_user_data
 
 from bot_handlers import (
+    ENTER_COIN,
+    ENTER_AMOUNT_OR_VALUE,
+    ENTER_PRICE,
+    ENTER_EXCHANGE,
     start,
     button_handler,
     handle_add_transaction_start,
     handle_coin_input,
+    handle_coin_choice,
     handle_amount_input,
     handle_price_input,
     handle_exchange_input,
     skip_exchange,
-    handle_confirmation
+    handle_confirmation,
+    import_help,
+    handle_import_document,
+    export_history,
+    recommend_command
 )
 
-def main():
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+def build_application(persistence=None, request=None, update_processor=None, post_init=None):
+    """
+    Собирает Application с обработчиками бота.
+
+    :param persistence: хранилище состояния диалогов и user_data или None
+    :param request: BaseRequest для запросов к Bot API или None — по умолчанию
+    :param update_processor: BaseUpdateProcessor для параллельной обработки или None
+    :param post_init: хук запуска (в режиме polling — start_background)
+    :return: Application
+    """
+    builder = ApplicationBuilder().token(BOT_TOKEN).post_shutdown(on_shutdown)
+    if post_init is not None:
+        builder = builder.post_init(post_init)
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    if request is not None:
+        builder = builder.request(request)
+    if update_processor is not None:
+        builder = builder.concurrent_updates(update_processor)
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(handle_add_transaction_start, pattern='^type_')],
         states={
             ENTER_COIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_coin_input)],
-            ENTER_AMOUNT_OR_VALUE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_amount_input)],
+            ENTER_AMOUNT_OR_VALUE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_amount_input),
+                # Другая монета из совпадений с введённым символом или названием
+                CallbackQueryHandler(handle_coin_choice, pattern=r'^coin_\d+$')
+            ],
             ENTER_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_price_input)],
             ENTER_EXCHANGE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_exchange_input),
-                CommandHandler("skip", skip_exchange)
+                CommandHandler("skip", skip_exchange),
+                CallbackQueryHandler(skip_exchange, pattern='^skip_exchange$')
             ],
         },
         fallbacks=[],
-        per_user=True
+        per_user=True,
+        # Брошенный на середине диалог не копится в памяти
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name='add_transaction',
+        persistent=persistence is not None
     )
 
     application.add_handler(CommandHandler('start', start))
-    application.add_handler(CallbackQueryHandler(button_handler))
+    # Диалог и подтверждение сделки — раньше общего обработчика кнопок,
+    # иначе он перехватывает их нажатия
     application.add_handler(conv_handler)
     application.add_handler(CallbackQueryHandler(handle_confirmation, pattern='^confirm_'))
+    application.add_handler(CallbackQueryHandler(button_handler))
 
-    # === Запуск планировщика задач ===
-    scheduler.start()
+    # Импорт сделок: CSV-файл, присланный документом (вне диалога добавления сделки)
+    application.add_handler(CommandHandler('import', import_help))
+    application.add_handler(MessageHandler(filters.Document.FileExtension('csv'), handle_import_document))
+    application.add_handler(CommandHandler('export', export_history))
+    application.add_handler(CommandHandler('recommend', recommend_command))
+
+    # Черновики сделок неактивных пользователей убираются из памяти. Задача
+    # JobQueue, а не общего планировщика: в режиме webhook память у каждого процесса своя
+    if persistence is not None:
+        application.job_queue.run_repeating(evict_idle_user_data, PERSISTENCE_EVICT_INTERVAL,
+                                            first=PERSISTENCE_EVICT_INTERVAL, name="evict_idle_user_data")
+    return application
 
+
+def register_metrics(application):
+    """Выводит в метрики статистику кэшей, фонового обновления цен, потока цен и хранилища диалогов."""
+    registry.register_info('price_cache', price_cache.info)
+    registry.register_info('profile_cache', profile_cache.info)
+    registry.register_info('chart_cache', chart_cache.info)
+    registry.register_info('ingestor', ingestor.info)
+    registry.register_info('price_stream', price_stream.info)
+    if isinstance(application.persistence, SQLitePersistence):
+        registry.register_info('persistence', application.persistence.info)
+
+
+def schedule_jobs(application):
+    """Добавляет задачи планировщика (отчёты, напоминания, обновление цен и т. д.)."""
     # Ежедневный отчёт в 9:00
     scheduler.add_job(
-        send_daily_report,
+        send_daily_report_to_all,
         'cron',
         hour=9,
         minute=0,
-        args=[],
+        args=[application.bot],
         misfire_grace_time=60,
         coalesce=True,
-        executor="default_executor",
         id="daily_report",
         replace_existing=True
     )
 
     # Еженедельный отчёт по понедельникам в 9:00
     scheduler.add_job(
-        send_weekly_report,
+        send_weekly_report_to_all,
         'cron',
         day_of_week='mon',
         hour=9,
         minute=0,
-        args=[],
+        args=[application.bot],
         misfire_grace_time=60,
         coalesce=True,
-        executor="default_executor",
         id="weekly_report",
         replace_existing=True
     )
 
+    # Проверка ценовых напоминаний
+    scheduler.add_job(
+        check_reminders,
+        'interval',
+        seconds=ALERT_CHECK_INTERVAL,
+        args=[application.bot],
+        misfire_grace_time=30,
+        coalesce=True,
+        max_instances=1,
+        id="check_reminders",
+        replace_existing=True
+    )
+
+    # Запись истории цен — и без фонового обновления цен, которое при
+    # включении само пишет замеры (тогда проход пропускается)
+    scheduler.add_job(
+        sample_prices,
+        'interval',
+        seconds=PRICE_SAMPLE_INTERVAL,
+        misfire_grace_time=60,
+        coalesce=True,
+        max_instances=1,
+        id="sample_prices",
+        replace_existing=True
+    )
+
+    # Фоновое обновление цен монет из портфелей и напоминаний (и запись истории цен):
+    # запросы пользователей читают цены из кэша и не ждут CoinGecko
+    if INGEST_ENABLED:
+        scheduler.add_job(
+            ingest_prices,
+            'interval',
+            seconds=INGEST_INTERVAL,
+            misfire_grace_time=30,
+            coalesce=True,
+            max_instances=1,
+            id="ingest_prices",
+            replace_existing=True
+        )
+
+    # Поток цен с биржи: напоминания проверяются на каждом тике, цены раз в
+    # несколько секунд переносятся в кэш. Опрос check_reminders остаётся для
+    # монет, которых нет на бирже
+    if STREAMING_ENABLED:
+        stream_alerts = StreamAlerts(application.bot)
+        application.bot_data['stream_alerts'] = stream_alerts
+        price_stream.add_listener(stream_alerts.on_tick)
+        scheduler.add_job(
+            sync_stream_watchlist,
+            'interval',
+            seconds=STREAM_WATCHLIST_INTERVAL,
+            args=[stream_alerts],
+            misfire_grace_time=30,
+            coalesce=True,
+            max_instances=1,
+            id="sync_stream_watchlist",
+            replace_existing=True
+        )
+        scheduler.add_job(
+            flush_stream_prices,
+            'interval',
+            seconds=STREAM_FLUSH_INTERVAL,
+            misfire_grace_time=10,
+            coalesce=True,
+            max_instances=1,
+            id="flush_stream_prices",
+            replace_existing=True
+        )
+
+    # Скан рынка для рекомендаций: кнопка отвечает из памяти. Первый проход —
+    # сразу после запуска, чтобы не ждать интервал
+    scheduler.add_job(
+        refresh_recommendations,
+        'interval',
+        seconds=RECOMMEND_REFRESH_INTERVAL,
+        next_run_time=datetime.now(),
+        misfire_grace_time=300,
+        coalesce=True,
+        max_instances=1,
+        id="refresh_recommendations",
+        replace_existing=True
+    )
+
+    # Удаление устаревших минутных и часовых точек истории цен
+    scheduler.add_job(
+        prune_history,
+        'cron',
+        minute=5,
+        misfire_grace_time=600,
+        coalesce=True,
+        id="prune_history",
+        replace_existing=True
+    )
+
+    # Таблица курсов валют: цены монет берутся в USD и пересчитываются по ней
+    scheduler.add_job(
+        refresh_fx_rates,
+        'interval',
+        seconds=FX_REFRESH_INTERVAL,
+        misfire_grace_time=600,
+        coalesce=True,
+        max_instances=1,
+        id="refresh_fx_rates",
+        replace_existing=True
+    )
+
+
+async def start_background(application):
+    """
+    Запускает планировщик и поток цен с биржи.
+
+    В режиме polling вызывается как post_init, в режиме webhook — только
+    в ведущем процессе, чтобы задачи не выполнялись по разу в каждом.
+    """
+    schedule_jobs(application)
+    scheduler.start()
+    if STREAMING_ENABLED:
+        await sync_stream_watchlist(application.bot_data.get('stream_alerts'))
+        price_stream.start()
+
+
+async def stop_background():
+    """Останавливает планировщик и поток цен, если они запущены."""
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    await price_stream.stop()
+
+
+async def on_shutdown(application):
+    """Освобождает ресурсы при остановке бота."""
+    await stop_background()
+    await close_client()
+    shutdown_chart_pool()
+
+
+def main():
+    # Создаёт таблицы и применяет недостающие миграции схемы
+    init_db()
+
+    # Незавершённые сделки переживают перезапуск бота
+    application = build_application(persistence=SQLitePersistence(), post_init=start_background)
+
+    # Прогреваем воркеры отрисовки заранее, чтобы первый график не ждал импорта matplotlib
+    start_chart_pool()
+
+    # Метрики Prometheus и профилировщик: http://METRICS_HOST:METRICS_PORT/metrics
+    if METRICS_ENABLED:
+        register_metrics(application)
+        start_metrics_server()
+
     print("Бот запущен...")
-    application.run_polling()
\ No newline at end of file
+    application.run_polling()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+# async_crypto_api.py
+
+import asyncio
+import logging
+
+import aiohttp
+
+from config import COINGECKO_API_URL, HTTP_TIMEOUT, HTTP_MAX_CONCURRENCY, HTTP_MAX_RETRIES, PRICE_FETCH_WAIT
+from fx import BASE_CURRENCY
+from metrics import API_ERRORS, API_LATENCY, API_RATE_LIMITED
+from crypto_api import (
+    PRICE_BATCH_SIZE,
+    MarketSnapshot,
+    coin_index,
+    fx_rates,
+    price_cache,
+    price_flight,
+    search_coins,
+    _flight_keys,
+    _normalize_request,
+    _stale_to_refresh,
+)
+
+logger = logging.getLogger(__name__)
+
+# Статусы, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class AsyncCoinGeckoClient:
+    """
+    Неблокирующий клиент CoinGecko поверх aiohttp.
+
+    Использует одну сессию с пулом соединений, ограничивает число
+    одновременных запросов и повторяет запрос при таймаутах, 429 и 5xx
+    с экспоненциальной задержкой (или по заголовку Retry-After).
+    """
+
+    def __init__(self, base_url=COINGECKO_API_URL, timeout=HTTP_TIMEOUT,
+                 max_concurrency=HTTP_MAX_CONCURRENCY, max_retries=HTTP_MAX_RETRIES):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._session = None
+        self._semaphore = None
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            self._session = aiohttp.ClientSession(timeout=self.timeout, connector=connector)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def get(self, path: str, params: dict = None):
+        """
+        Выполняет GET-запрос к API и возвращает разобранный JSON.
+
+        :param path: путь относительно base_url (например, '/simple/price')
+        :param params: query-параметры
+        :return: ответ API
+        :raises aiohttp.ClientError: если все попытки исчерпаны
+        """
+        session = await self._get_session()
+        url = self.base_url + path
+        delay = 1.0
+
+        for attempt in range(self.max_retries + 1):
+            is_last = attempt == self.max_retries
+            try:
+                async with self._semaphore:
+                    # Время каждой попытки, без ожидания семафора и пауз между повторами
+                    with API_LATENCY.time(endpoint=path):
+                        async with session.get(url, params=params) as response:
+                            if response.status == 429:
+                                API_RATE_LIMITED.inc(endpoint=path)
+                            if response.status in RETRY_STATUSES and not is_last:
+                                API_ERRORS.inc(endpoint=path, status=str(response.status))
+                                retry_after = response.headers.get('Retry-After')
+                                wait = float(retry_after) if retry_after and retry_after.isdigit() else delay
+                                logger.warning(f"CoinGecko ответил {response.status} на {path}, "
+                                               f"повтор через {wait:.1f} с")
+                            else:
+                                response.raise_for_status()
+                                return await response.json()
+            except aiohttp.ClientResponseError as e:
+                # 4xx (кроме 429) повторять бессмысленно
+                API_ERRORS.inc(endpoint=path, status=str(e.status))
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                API_ERRORS.inc(endpoint=path, status='timeout' if isinstance(e, asyncio.TimeoutError) else 'error')
+                if is_last:
+                    raise
+                wait = delay
+                logger.warning(f"Ошибка запроса {path}: {e!r}, повтор через {wait:.1f} с")
+
+            await asyncio.sleep(wait)
+            delay *= 2
+
+    async def get_price(self, ids, vs_currencies):
+        """Аналог cg.get_price: цены нескольких монет в нескольких валютах."""
+        return await self.get('/simple/price', {
+            'ids': ','.join(ids),
+            'vs_currencies': ','.join(vs_currencies),
+        })
+
+    async def get_coins_markets(self, vs_currency='usd', page=1, per_page=250, sparkline=False):
+        """Аналог cg.get_coins_markets: рыночные данные монет по убыванию капитализации."""
+        return await self.get('/coins/markets', {
+            'vs_currency': vs_currency,
+            'order': 'market_cap_desc',
+            'per_page': per_page,
+            'page': page,
+            'sparkline': 'true' if sparkline else 'false',
+        })
+
+    async def get_coins_list(self):
+        """Аналог cg.get_coins_list: полный список монет."""
+        return await self.get('/coins/list')
+
+    async def get_exchange_rates(self):
+        """Аналог cg.get_exchange_rates: курсы валют к BTC."""
+        return await self.get('/exchange_rates')
+
+    async def close(self):
+        """Закрывает HTTP-сессию."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+client = AsyncCoinGeckoClient()
+
+
+async def close_client(*_):
+    """Закрывает сессию клиента (подходит как post_shutdown-хук Application)."""
+    await client.close()
+
+
+async def _fetch_prices_async(coin_ids, currencies):
+    """Запрашивает цены пачками параллельно и кладёт их в кэш."""
+    batches = [coin_ids[i:i + PRICE_BATCH_SIZE] for i in range(0, len(coin_ids), PRICE_BATCH_SIZE)]
+    responses = await asyncio.gather(
+        *(client.get_price(batch, currencies) for batch in batches),
+        return_exceptions=True
+    )
+    result = {}
+    for batch, data in zip(batches, responses):
+        if isinstance(data, Exception):
+            price_cache.record('fetch_errors')
+            logger.error(f"Ошибка при получении цен для {len(batch)} монет: {data}")
+            continue
+        result.update(await price_cache.store_async(data, currencies))
+    return result
+
+
+async def _fetch_coalesced_async(coin_ids, currencies, wait=True):
+    """Асинхронный аналог crypto_api._fetch_coalesced."""
+    owned, waiting = price_flight.claim(_flight_keys(coin_ids, currencies))
+    result = {}
+    if owned:
+        try:
+            result = await _fetch_prices_async([coin_id for coin_id, _ in owned], currencies)
+        finally:
+            price_flight.resolve(owned, {key: result.get(key[0]) for key in owned})
+    if wait and waiting:
+        price_cache.record('coalesced', len(waiting))
+        # shield: таймаут ожидания не должен отменять общий Future
+        responses = await asyncio.gather(
+            *(asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), PRICE_FETCH_WAIT)
+              for future in waiting.values()),
+            return_exceptions=True
+        )
+        for (coin_id, _), prices in zip(waiting, responses):
+            if isinstance(prices, Exception):
+                logger.warning(f"Не дождались цены {coin_id} из параллельного запроса")
+            elif prices:
+                result[coin_id] = prices
+    return result
+
+
+# Ссылки на фоновые обновления, чтобы задачи не собрал сборщик мусора
+_background_refreshes = set()
+
+
+def _refresh_in_background(coin_ids, currencies):
+    """Обновляет устаревшие цены фоновой задачей (stale-while-revalidate)."""
+    price_cache.record('refreshes', len(coin_ids))
+    task = asyncio.create_task(_fetch_coalesced_async(coin_ids, currencies, wait=False))
+    _background_refreshes.add(task)
+    task.add_done_callback(_background_refreshes.discard)
+
+
+async def get_coin_prices_async(coin_ids, currencies=('usd',)):
+    """
+    Асинхронный аналог crypto_api.get_coin_prices.
+
+    Устаревшие цены отдаются сразу и обновляются фоновой задачей (если их
+    не обновляет ingestion.py — см. set_ingested_coins), недостающие
+    монеты запрашиваются пачками параллельно (с учётом лимита одновременных
+    запросов клиента) и объединяются с уже идущими запросами тех же монет.
+
+    :param coin_ids: iterable с ID монет в CoinGecko
+    :param currencies: iterable с валютами
+    :return: dict {coin_id: {currency: price}}
+    """
+    coin_ids, currencies = _normalize_request(coin_ids, currencies)
+    fresh, stale, missing = await price_cache.lookup_async(coin_ids, currencies)
+    result = {**fresh, **stale}
+    refresh = _stale_to_refresh(stale)
+    if refresh:
+        _refresh_in_background(refresh, currencies)
+    if missing:
+        result.update(await _fetch_coalesced_async(missing, currencies))
+    return result
+
+
+async def get_coin_price_async(coin_id: str, currency: str = 'usd'):
+    """
+    Асинхронный аналог crypto_api.get_coin_price.
+
+    :param coin_id: ID монеты в CoinGecko
+    :param currency: валюта
+    :return: цена монеты или None
+    """
+    await ensure_fx_rates()
+    prices = await get_coin_prices_async([coin_id])
+    price = prices.get(coin_id.lower(), {}).get(BASE_CURRENCY)
+    return fx_rates.convert(price, currency) if price is not None else None
+
+
+async def take_market_snapshot_async(coin_ids, currencies=('usd',)):
+    """
+    Получает цены монет пакетно и фиксирует их в MarketSnapshot.
+
+    :param coin_ids: iterable с ID монет в CoinGecko
+    :param currencies: iterable с валютами
+    :return: MarketSnapshot
+    """
+    return MarketSnapshot(await get_coin_prices_async(coin_ids, currencies))
+
+
+async def ensure_coin_index():
+    """Загружает справочник монет, не блокируя event loop."""
+    if coin_index.loaded:
+        return
+    # Первая загрузка читает снимок с диска или ходит в API — уводим в поток
+    await asyncio.to_thread(coin_index.ensure_loaded)
+
+
+async def search_coins_async(query: str, limit: int = 5):
+    """Асинхронный аналог crypto_api.search_coins."""
+    await ensure_coin_index()
+    return search_coins(query, limit)
+
+
+async def search_coin_async(query: str):
+    """Асинхронный аналог crypto_api.search_coin."""
+    coins = await search_coins_async(query, limit=1)
+    return coins[0] if coins else None
+
+
+async def refresh_fx_rates():
+    """Обновляет таблицу курсов валют (задача планировщика)."""
+    try:
+        fx_rates.load(await client.get_exchange_rates())
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении курсов валют: {e}")
+        return False
+    return True
+
+
+async def ensure_fx_rates():
+    """Загружает курсы валют при первом обращении, не блокируя event loop."""
+    if not fx_rates.loaded and not await refresh_fx_rates():
+        # API недоступен — до следующего обновления по расписанию считаем только в USD
+        fx_rates.load_fallback()
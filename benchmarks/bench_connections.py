@@ -0,0 +1,97 @@
+# benchmarks/bench_connections.py
+"""
+Смешанная нагрузка чтение/запись на базу: соединение на каждый вызов
+(как было до database.get_connection) против долгоживущего соединения
+потока с WAL и transaction().
+
+    python benchmarks/bench_connections.py --ops 4000 --users 100 --writes 0.25 --threads 1
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+READ_SQL = "SELECT symbol, amount, price FROM transactions WHERE user_id = ? AND type = 'buy'"
+WRITE_SQL = "INSERT INTO transactions (user_id, coin_name, symbol, amount, price, type) VALUES (?, ?, ?, ?, ?, ?)"
+
+
+def _workload(ops, users, writes, seed):
+    rng = random.Random(seed)
+    return [(rng.random() < writes, rng.randrange(users)) for _ in range(ops)]
+
+
+def _per_call(path, workload):
+    """Прежний database.py: connect, запрос, commit и close на каждый вызов."""
+    for is_write, user_id in workload:
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        if is_write:
+            cursor.execute(WRITE_SQL, (user_id, 'Bitcoin', 'btc', 1.0, 100.0, 'buy'))
+            conn.commit()
+        else:
+            cursor.execute(READ_SQL, (user_id,))
+            cursor.fetchall()
+        conn.close()
+
+
+def _shared(path, workload):
+    """Текущий database.py: соединение потока, запись через transaction()."""
+    for is_write, user_id in workload:
+        if is_write:
+            with database.transaction() as cursor:
+                cursor.execute(WRITE_SQL, (user_id, 'Bitcoin', 'btc', 1.0, 100.0, 'buy'))
+        else:
+            database.get_connection().execute(READ_SQL, (user_id,)).fetchall()
+    database.close_connection()
+
+
+def _prepare(path, journal_mode):
+    database.DB_NAME = path
+    database.init_db()
+    database.close_connection()
+    # init_db включает WAL; для старого варианта возвращаем журнал по умолчанию
+    conn = sqlite3.connect(path)
+    conn.execute(f"PRAGMA journal_mode={journal_mode}")
+    conn.close()
+
+
+def _run(runner, path, workloads):
+    threads = [threading.Thread(target=runner, args=(path, workload)) for workload in workloads]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ops', type=int, default=4000, help="операций на поток")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--writes', type=float, default=0.25, help="доля записей")
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+
+    workloads = [_workload(args.ops, args.users, args.writes, seed) for seed in range(args.threads)]
+    total = args.ops * args.threads
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, runner, journal_mode in (('соединение на вызов', _per_call, 'DELETE'),
+                                           ('соединение потока + WAL', _shared, 'WAL')):
+            path = os.path.join(tmp, f"{journal_mode.lower()}.db")
+            _prepare(path, journal_mode)
+            elapsed = _run(runner, path, workloads)
+            print(f"{name:>25}: {total / elapsed:10.0f} оп/с ({elapsed:.2f} с на {total} операций)")
+
+
+if __name__ == '__main__':
+    main()
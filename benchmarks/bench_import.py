@@ -0,0 +1,86 @@
+# benchmarks/bench_import.py
+"""
+Импорт большой CSV-выгрузки сделок: отдельно разбор файла и весь
+import_csv со вставкой в базу и пересчётом позиций; затем повторный
+импорт того же файла (все строки — дубли).
+
+    python benchmarks/bench_import.py --rows 100000 --format binance
+"""
+
+import argparse
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+from crypto_api import coin_index  # noqa: E402
+from importer import import_csv, parse_trades  # noqa: E402
+
+COINS = [{'id': f"coin-{symbol}", 'symbol': symbol, 'name': symbol.upper()}
+         for symbol in ('btc', 'eth', 'sol', 'ada', 'dot', 'xrp', 'doge', 'ltc', 'uni', 'link')]
+
+
+def _binance(rows, rng):
+    lines = ["Date(UTC),Pair,Side,Price,Executed,Amount,Fee"]
+    start = datetime(2020, 1, 1)
+    for i in range(rows):
+        symbol = rng.choice(COINS)['symbol'].upper()
+        price, amount = rng.uniform(1, 1000), rng.uniform(0.01, 5)
+        lines.append(f"{start + timedelta(minutes=i):%Y-%m-%d %H:%M:%S},{symbol}USDT,"
+                     f"{'BUY' if rng.random() < 0.6 else 'SELL'},{price:.4f},{amount:.6f}{symbol},"
+                     f"{price * amount:.2f}USDT,0")
+    return "\n".join(lines) + "\n"
+
+
+def _generic(rows, rng):
+    lines = ["date,symbol,type,amount,price,exchange"]
+    start = datetime(2020, 1, 1)
+    for i in range(rows):
+        lines.append(f"{(start + timedelta(minutes=i)).isoformat()}Z,{rng.choice(COINS)['symbol']},"
+                     f"{'buy' if rng.random() < 0.6 else 'sell'},{rng.uniform(0.01, 5):.6f},"
+                     f"{rng.uniform(1, 1000):.4f},Kraken")
+    return "\n".join(lines) + "\n"
+
+
+def _parse_only(data):
+    stats = {'format': None, 'rows': 0, 'skipped': 0, 'unknown': set(), 'non_usd': set(), 'errors': []}
+    return sum(len(chunk) for chunk in parse_trades(io.BytesIO(data), stats))
+
+
+def _timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--format', choices=('binance', 'generic'), default='binance')
+    args = parser.parse_args()
+
+    coin_index.load(COINS)
+    builder = _binance if args.format == 'binance' else _generic
+    data = builder(args.rows, random.Random(0)).encode('utf-8')
+    print(f"{args.rows} строк ({args.format}), {len(data) / 2 ** 20:.1f} МБ")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, 'import.db')
+        database.init_db()
+        elapsed, trades = _timed(_parse_only, data)
+        print(f"{'разбор':>18}: {elapsed:6.2f} с, {trades / elapsed:8.0f} строк/с")
+        for name in ('import_csv', 'повторный импорт'):
+            elapsed, stats = _timed(import_csv, 1, io.BytesIO(data))
+            print(f"{name:>18}: {elapsed:6.2f} с, {stats['rows'] / elapsed:8.0f} строк/с "
+                  f"(добавлено {stats['imported']}, дублей {stats['duplicates']}, пропущено {stats['skipped']})")
+        database.close_connection()
+
+
+if __name__ == '__main__':
+    main()
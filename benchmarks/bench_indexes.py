@@ -0,0 +1,101 @@
+# benchmarks/bench_indexes.py
+"""
+Задержка частых запросов к transactions и reminders с индексами
+миграций 2 и 6 и без них, на синтетической базе.
+
+    python benchmarks/bench_indexes.py --transactions 1000000 --users 20000 --reminders 200000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+SYMBOLS = ['btc', 'eth', 'sol', 'ada', 'dot', 'xrp', 'doge', 'ltc', 'uni', 'link']
+
+# Индексы, которые снимаются для замера «до»
+INDEXES = ['idx_transactions_user_symbol_type', 'idx_transactions_user_date', 'idx_transactions_user_id',
+           'idx_reminders_active_coin', 'idx_reminders_active_user']
+
+# Запросы в том виде, в каком их делали get_portfolio, get_all_transactions,
+# get_active_reminders и проверка напоминаний по монете до появления holdings
+QUERIES = {
+    'get_portfolio': ("SELECT symbol, SUM(amount), SUM(amount * price) / SUM(amount) FROM transactions "
+                      "WHERE user_id = ? AND type = 'buy' GROUP BY symbol", 'user'),
+    'get_all_transactions': ("SELECT coin_name, symbol, amount, price, type, date FROM transactions "
+                             "WHERE user_id = ? ORDER BY date DESC", 'user'),
+    'get_active_reminders': ("SELECT id, coin, target_price FROM reminders "
+                             "WHERE user_id = ? AND notified = 0", 'user'),
+    'reminders_for_coin': ("SELECT id, user_id, target_price FROM reminders "
+                           "WHERE coin = ? AND notified = 0", 'coin'),
+}
+
+
+def _fill(args, rng):
+    """Заполняет базу пользователями, сделками и напоминаниями."""
+    with database.transaction() as cursor:
+        cursor.executemany("INSERT INTO users (user_id) VALUES (?)", ((i,) for i in range(args.users)))
+        cursor.executemany(
+            "INSERT INTO transactions (user_id, coin_name, symbol, amount, price, type, date) "
+            "VALUES (?, ?, ?, ?, ?, ?, datetime('now', ?))",
+            ((rng.randrange(args.users), symbol, symbol, rng.uniform(0.1, 10), rng.uniform(1, 1000),
+              rng.choice(('buy', 'buy', 'sell')), f"-{rng.randrange(1_000_000)} seconds")
+             for symbol in (rng.choice(SYMBOLS) for _ in range(args.transactions))))
+        cursor.executemany(
+            "INSERT INTO reminders (user_id, coin, target_price, notified) VALUES (?, ?, ?, ?)",
+            ((rng.randrange(args.users), rng.choice(SYMBOLS), rng.uniform(1, 1000), int(rng.random() < 0.9))
+             for _ in range(args.reminders)))
+        cursor.execute("ANALYZE")
+
+
+def _measure(args, rng):
+    """Средняя задержка каждого запроса в миллисекундах."""
+    conn = database.get_connection()
+    result = {}
+    for name, (sql, param) in QUERIES.items():
+        values = [rng.randrange(args.users) if param == 'user' else rng.choice(SYMBOLS)
+                  for _ in range(args.repeat)]
+        started = time.perf_counter()
+        for value in values:
+            conn.execute(sql, (value,)).fetchall()
+        result[name] = (time.perf_counter() - started) / args.repeat * 1000
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--transactions', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--reminders', type=int, default=200_000)
+    parser.add_argument('--repeat', type=int, default=50, help="запросов на замер")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, 'bench.db')
+        database.init_db()
+        started = time.perf_counter()
+        _fill(args, rng)
+        print(f"База заполнена за {time.perf_counter() - started:.1f} с")
+
+        with_indexes = _measure(args, rng)
+        with database.transaction() as cursor:
+            for index in INDEXES:
+                cursor.execute(f"DROP INDEX IF EXISTS {index}")
+            cursor.execute("ANALYZE")
+        without_indexes = _measure(args, rng)
+        database.close_connection()
+
+    print(f"{'запрос':<22} {'без индексов':>14} {'с индексами':>14}")
+    for name in QUERIES:
+        print(f"{name:<22} {without_indexes[name]:11.3f} мс {with_indexes[name]:11.3f} мс")
+
+
+if __name__ == '__main__':
+    main()
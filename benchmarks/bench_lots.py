@@ -0,0 +1,94 @@
+# benchmarks/bench_lots.py
+"""
+Расчёт позиций по лотам (avg, FIFO, LIFO) у пользователя с большой историей:
+полный пересчёт из сделок против добавления одной сделки от контрольной точки.
+
+    python benchmarks/bench_lots.py --trades 100000 --symbols 5 --adds 50
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+from lots import COST_METHODS, LotBook  # noqa: E402
+
+SYMBOLS = ['btc', 'eth', 'sol', 'ada', 'dot', 'xrp', 'doge', 'ltc', 'uni', 'link']
+
+
+def _trades(count, symbols, rng):
+    """Сделки одного пользователя: покупки и продажи поменьше, лоты накапливаются."""
+    return [(symbol, symbol, rng.uniform(0.5, 2.0) if buy else rng.uniform(0.1, 1.0),
+             rng.uniform(1, 1000), 'buy' if buy else 'sell', f"-{count - i} seconds")
+            for i, (symbol, buy) in enumerate((rng.choice(symbols), rng.random() < 0.6) for _ in range(count))]
+
+
+def _fill(user_id, method, trades):
+    with database.transaction() as cursor:
+        cursor.execute("INSERT INTO users (user_id, cost_method) VALUES (?, ?)", (user_id, method))
+        cursor.executemany(
+            "INSERT INTO transactions (user_id, coin_name, symbol, amount, price, type, date) "
+            "VALUES (?, ?, ?, ?, ?, ?, datetime('now', ?))",
+            ((user_id, *trade) for trade in trades))
+
+
+def _replay(method, trades):
+    """Прогон сделок через LotBook в памяти, без базы."""
+    books = {}
+    for _, symbol, amount, price, transaction_type, _ in trades:
+        book = books.get(symbol)
+        if book is None:
+            book = books[symbol] = LotBook(method)
+        book.apply(amount, price, transaction_type)
+    return books
+
+
+def _timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--trades', type=int, default=100_000, help="сделок у пользователя")
+    parser.add_argument('--symbols', type=int, default=5, help="монет в портфеле")
+    parser.add_argument('--adds', type=int, default=50, help="сделок, добавляемых по одной")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    trades = _trades(args.trades, SYMBOLS[:args.symbols], rng)
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, 'lots.db')
+        database.init_db()
+        print(f"{args.trades} сделок по {args.symbols} монетам")
+        for user_id, method in enumerate(COST_METHODS, start=1):
+            _fill(user_id, method, trades)
+            replay, books = _timed(_replay, method, trades)
+            rebuild, _ = _timed(database.rebuild_holdings, user_id)
+            lots = sum(len(book.lots()) for book in books.values())
+
+            adds = []
+            for _ in range(args.adds):
+                symbol = rng.choice(SYMBOLS[:args.symbols])
+                buy = rng.random() < 0.6
+                elapsed, _ = _timed(database.add_transaction, user_id, symbol, symbol,
+                                    rng.uniform(0.1, 1.0), rng.uniform(1, 1000), 'buy' if buy else 'sell')
+                adds.append(elapsed)
+            adds.sort()
+
+            assert not database.verify_holdings(user_id)
+            print(f"{method:>5}: LotBook в памяти {replay * 1000:8.1f} мс, "
+                  f"rebuild_holdings {rebuild * 1000:8.1f} мс, "
+                  f"add_transaction медиана {adds[len(adds) // 2] * 1000:.2f} мс "
+                  f"(макс. {adds[-1] * 1000:.2f} мс), открытых лотов {lots}")
+        database.close_connection()
+
+
+if __name__ == '__main__':
+    main()
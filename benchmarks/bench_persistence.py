@@ -0,0 +1,80 @@
+# benchmarks/bench_persistence.py
+"""
+Пропускная способность записи SQLitePersistence: изменения user_data и
+диалогов копятся в буфере и пишутся пачками; для сравнения — транзакция
+на каждое изменение.
+
+    python benchmarks/bench_persistence.py --updates 20000 --users 2000 --batch 500
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from persistence import SQLitePersistence  # noqa: E402
+
+CONVERSATION = 'add_transaction'
+
+
+def _workload(updates, users, seed):
+    """Изменения черновика сделки: (user_id, user_data, состояние диалога)."""
+    rng = random.Random(seed)
+    return [(user_id, {'transaction': {'type': 'buy', 'coin': 'bitcoin', 'amount': rng.uniform(0.1, 10)}},
+             rng.randrange(5))
+            for user_id in (rng.randrange(1, users + 1) for _ in range(updates))]
+
+
+async def _apply(persistence, user_id, data, state):
+    await persistence.update_user_data(user_id, data)
+    await persistence.update_conversation(CONVERSATION, (user_id, user_id), state)
+
+
+async def _batched(persistence, workload, batch):
+    """Как PTB: раз в update_interval изменения пачкой корутин, запись одной транзакцией."""
+    for i in range(0, len(workload), batch):
+        await asyncio.gather(*(_apply(persistence, *update) for update in workload[i:i + batch]))
+        while persistence._write_task is not None:
+            await persistence._write_task
+    await persistence.flush()
+
+
+async def _per_update(persistence, workload):
+    """Транзакция на каждое изменение."""
+    for update in workload:
+        await _apply(persistence, *update)
+        while persistence._write_task is not None:
+            await persistence._write_task
+    await persistence.flush()
+
+
+def _run(path, scenario, *args):
+    persistence = SQLitePersistence(path)
+    started = time.perf_counter()
+    asyncio.run(scenario(persistence, *args))
+    return time.perf_counter() - started, persistence.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--updates', type=int, default=20_000, help="изменений черновиков")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=500, help="изменений за одно сохранение PTB")
+    args = parser.parse_args()
+
+    workload = _workload(args.updates, args.users, seed=0)
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, scenario, extra in (('пачками', _batched, (args.batch,)),
+                                      ('по одному', _per_update, ())):
+            elapsed, stats = _run(os.path.join(tmp, f"{scenario.__name__}.db"), scenario, workload, *extra)
+            print(f"{name:>10}: {stats['rows'] / elapsed:10.0f} строк/с ({stats['rows']} строк, "
+                  f"{stats['flushes']} транзакций, {stats['skipped']} без изменений, {elapsed:.2f} с)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,39 @@
 # bot_handlers.py
 
+import asyncio
+import tempfile
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes, ConversationHandler
-from analytics import calculate_portfolio
-from recommendation import recommend_investment
-from charts import generate_portfolio_chart
-from database import add_transaction
-from utils import main_menu_keyboard, back_to_main_menu
+from analytics import calculate_portfolio_async
+from recommendation import recommend_investment_async
+from charts import get_portfolio_chart, remember_chart_upload, render_value_chart
+from async_crypto_api import ensure_fx_rates
+from config import (IMPORT_MAX_FILE_SIZE, HISTORY_PAGE_SIZE, SUPPORTED_CURRENCIES,
+                    RECOMMEND_DEFAULT_AMOUNT, RECOMMEND_DEFAULT_PROFIT, RECOMMEND_DEFAULT_DAYS)
+from crypto_api import fx_rates
+from database import (
+    add_transaction,
+    add_user,
+    set_cost_method,
+    get_transactions_page,
+    get_user_currency,
+    get_user_profile,
+    set_user_currency,
+)
+from exporter import export_transactions
+from importer import CSVFormatError, import_csv
+from metrics import HANDLER_LATENCY
+from price_history import portfolio_value_series
+from utils import (
+    main_menu_keyboard,
+    back_to_main_menu,
+    value_period_keyboard,
+    settings_keyboard,
+    history_keyboard,
+    format_money,
+    COST_METHOD_NAMES,
+)
 
 # Этапы диалога
 SELECT_TYPE, ENTER_COIN, ENTER_AMOUNT_OR_VALUE, ENTER_PRICE, ENTER_EXCHANGE = range(5)
@@ -18,49 +45,77 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Добро пожаловать в CryptoKeeper!", reply_markup=main_menu_keyboard())
 
 
+# Метки кнопок для метрик: точные значения callback_data и префиксы кнопок с переменной частью.
+# Всё остальное (старые клавиатуры, подделанные запросы) попадает в 'unknown'
+CALLBACK_ACTIONS = frozenset({
+    "portfolio", "analytics", "recommend", "add_transaction", "chart", "value_chart",
+    "settings", "history", "back_to_main",
+})
+CALLBACK_ACTION_PREFIXES = ("value_chart_", "cost_method_", "currency_", "history_newer_", "history_older_")
+
+
+def _callback_action(data):
+    """
+    Метка кнопки для метрик из фиксированного набора, чтобы число рядов гистограммы не росло:
+    history_older_<дата>_<id> → history_older, currency_eur → currency, прочее → unknown.
+    """
+    if data in CALLBACK_ACTIONS:
+        return data
+    for prefix in CALLBACK_ACTION_PREFIXES:
+        if data and data.startswith(prefix):
+            return prefix[:-1]
+    return 'unknown'
+
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with HANDLER_LATENCY.time(action=_callback_action(update.callback_query.data)):
+        return await _handle_button(update, context)
+
+
+async def _handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
 
     if query.data == "portfolio":
-        data = calculate_portfolio(user_id)
+        data = await calculate_portfolio_async(user_id)
         text = "💼 Ваш портфель:\n\n"
+        currency = data['currency']
         for asset in data['assets']:
             text += f"{asset['symbol']} ({asset['amount']:.4f})\n"
-            text += f"Средняя цена: ${asset['avg_price']:.2f}\n"
-            text += f"Текущая цена: ${asset['current_price']:.2f}\n"
-            text += f"Вложено: ${asset['invested']:.2f}\n"
-            text += f"Текущая стоимость: ${asset['current']:.2f}\n"
-            profit_str = "+" if asset['profit'] >= 0 else "-"
-            text += f"Прибыль: {profit_str}${abs(asset['profit']):.2f} ({asset['roi']:+.2f}%)\n\n"
+            text += f"Средняя цена: {format_money(asset['avg_price'], currency)}\n"
+            text += f"Текущая цена: {format_money(asset['current_price'], currency)}\n"
+            text += f"Вложено: {format_money(asset['invested'], currency)}\n"
+            text += f"Текущая стоимость: {format_money(asset['current'], currency)}\n"
+            text += f"Прибыль: {format_money(asset['profit'], currency, signed=True)} ({asset['roi']:+.2f}%)\n\n"
 
+        total = data['total']
         text += "📊 ИТОГО:\n"
-        text += f"Всего вложено: ${data['total']['invested']:.2f}\n"
-        text += f"Текущая стоимость: ${data['total']['current']:.2f}\n"
-        profit_str = "+" if data['total']['profit'] >= 0 else "-"
-        text += f"Прибыль: {profit_str}${abs(data['total']['profit']):.2f} ({data['total']['roi']:+.2f}%)\n\n"
+        text += f"Всего вложено: {format_money(total['invested'], currency)}\n"
+        text += f"Текущая стоимость: {format_money(total['current'], currency)}\n"
+        text += f"Прибыль: {format_money(total['profit'], currency, signed=True)} ({total['roi']:+.2f}%)\n"
+        text += f"Зафиксировано продажами: {format_money(total['realized'], currency, signed=True)}\n\n"
 
         await query.edit_message_text(text=text, reply_markup=main_menu_keyboard())
 
     elif query.data == "analytics":
-        data = calculate_portfolio(user_id)
+        data = await calculate_portfolio_async(user_id)
         text = "📈 Аналитика:\n\n"
         text += f"Общая доходность: {data['total']['roi']:+.2f}%\n"
         text += f"Количество активов: {len(data['assets'])}\n"
         top_asset = max(data['assets'], key=lambda x: x['profit']) if data['assets'] else None
         top_name = top_asset['symbol'] if top_asset else '—'
-        text += f"Самый прибыльный актив: {top_name}\n"
+        text += f"Самый прибыльный актив: {top_name}\n\n"
+        metrics = data['metrics']
+        text += f"Концентрация (HHI): {metrics['hhi']:.2f}\n"
+        text += f"Волатильность (год.): {metrics['volatility']:.1f}%\n"
+        text += f"Макс. просадка: {metrics['max_drawdown']:.1f}%\n"
+        text += f"Коэффициент Шарпа: {metrics['sharpe']:.2f}\n"
         await query.edit_message_text(text=text, reply_markup=main_menu_keyboard())
 
     elif query.data == "recommend":
-        recommendations = recommend_investment(amount=100, desired_profit=10, days=7)
-        text = "🚀 Рекомендации:\n\n"
-        for rec in recommendations:
-            text += f"🔸 {rec['name']} ({rec['symbol']})\n"
-            text += f"Прогноз: {rec['forecast']}\n"
-            text += f"Риск: {rec['risk']}\n\n"
-        text += "⚠️ Это не гарантия прибыли. Крипторынок волатилен!"
+        text = await _recommendations_text(RECOMMEND_DEFAULT_AMOUNT, RECOMMEND_DEFAULT_PROFIT, RECOMMEND_DEFAULT_DAYS)
+        text += "\n\nСвоя цель: /recommend <сумма> <прибыль> <дней>"
         await query.edit_message_text(text=text, reply_markup=main_menu_keyboard())
 
     elif query.data == "add_transaction":
@@ -73,13 +128,79 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return SELECT_TYPE
 
     elif query.data == "chart":
-        data = calculate_portfolio(user_id)
-        chart_img = generate_portfolio_chart(data)
-        await query.message.reply_photo(photo=chart_img, caption="📊 Распределение вашего портфеля")
+        data = await calculate_portfolio_async(user_id)
+        chart_key, chart_img = await get_portfolio_chart(data)
+        message = await query.message.reply_photo(photo=chart_img, caption="📊 Распределение вашего портфеля")
+        remember_chart_upload(chart_key, message)
         await query.message.delete()
         await query.answer()
         return ConversationHandler.END
 
+    elif query.data == "value_chart":
+        await query.edit_message_text("За какой период показать стоимость портфеля?",
+                                      reply_markup=value_period_keyboard())
+
+    elif query.data.startswith("value_chart_"):
+        days = int(query.data.rsplit("_", 1)[1])
+        # История цен читается из базы и считается в NumPy — в потоке, не в event loop
+        timestamps, values = await asyncio.to_thread(portfolio_value_series, user_id, days)
+        await ensure_fx_rates()
+        currency = get_user_currency(user_id)
+        rate = fx_rates.rate(currency)
+        if rate is None:
+            currency, rate = 'usd', 1.0
+        chart_img = await render_value_chart(timestamps, values * rate, days, currency)
+        await query.message.reply_photo(photo=chart_img, caption=f"📈 Стоимость портфеля за {days} дн.")
+        await query.message.delete()
+        return ConversationHandler.END
+
+    elif query.data == "settings":
+        profile = get_user_profile(user_id)
+        await query.edit_message_text(_settings_text(profile), reply_markup=_settings_keyboard(profile))
+
+    elif query.data.startswith("cost_method_"):
+        method = query.data.rsplit("_", 1)[1]
+        set_cost_method(user_id, method)
+        text = f"✅ Себестоимость теперь считается: {COST_METHOD_NAMES[method]}\n"
+        text += "Позиции пересчитаны по истории сделок.\n\n"
+        profile = get_user_profile(user_id)
+        await query.edit_message_text(text + _settings_text(profile), reply_markup=_settings_keyboard(profile))
+
+    elif query.data.startswith("currency_"):
+        currency = query.data.split("_", 1)[1]
+        await ensure_fx_rates()
+        # Валюту без известного курса не сохраняем: портфель всё равно показался бы в USD
+        if currency in SUPPORTED_CURRENCIES and fx_rates.rate(currency) is not None:
+            add_user(user_id)
+            set_user_currency(user_id, currency)
+            text = f"✅ Валюта отображения: {currency.upper()}\n\n"
+        else:
+            text = "❌ Эта валюта сейчас недоступна, выберите другую.\n\n"
+        profile = get_user_profile(user_id)
+        await query.edit_message_text(text + _settings_text(profile), reply_markup=_settings_keyboard(profile))
+
+    elif query.data == "history" or query.data.startswith("history_"):
+        cursor, direction = None, 'older'
+        if query.data != "history":
+            # history_older_<date>_<id> или history_newer_<date>_<id>
+            _, direction, date, tx_id = query.data.split("_", 3)
+            cursor = (date, int(tx_id))
+        rows, has_more = get_transactions_page(user_id, HISTORY_PAGE_SIZE, cursor, direction)
+        if not rows:
+            await query.edit_message_text("📜 История сделок пуста.", reply_markup=main_menu_keyboard())
+            return ConversationHandler.END
+
+        if direction == 'older':
+            has_older, has_newer = has_more, cursor is not None
+        else:
+            has_older, has_newer = True, has_more
+        text = "📜 История сделок:\n\n"
+        text += "\n".join(format_history_row(row) for row in rows)
+        text += "\n\nВся история файлом — команда /export"
+        older = (rows[-1][1], rows[-1][0]) if has_older else None
+        newer = (rows[0][1], rows[0][0]) if has_newer else None
+        await query.edit_message_text(text, reply_markup=history_keyboard(older, newer))
+
     elif query.data == "back_to_main":
         await query.edit_message_text("Выберите действие:", reply_markup=main_menu_keyboard())
         return ConversationHandler.END
@@ -102,14 +223,53 @@ async def handle_add_transaction_start(update: Update, context: ContextTypes.DEF
 
 async def handle_coin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     coin_input = update.message.text.strip()
-    from crypto_api import search_coin
-    coin = search_coin(coin_input)
-    if not coin:
+    from async_crypto_api import search_coins_async
+    candidates = await search_coins_async(coin_input)
+    if not candidates:
         await update.message.reply_text("Монета не найдена. Попробуйте ещё раз.")
         return ENTER_COIN
-    context.user_data['coin_name'] = coin['name']
-    context.user_data['symbol'] = coin['symbol']
-    await update.message.reply_text(f"Вы выбрали: {coin['name']} ({coin['symbol'].upper()})\nВведите количество или сумму:")
+    context.user_data['coin_candidates'] = [
+        {'id': c['id'], 'name': c['name'], 'symbol': c['symbol']} for c in candidates
+    ]
+    _select_coin(context.user_data, 0)
+    text, keyboard = _coin_choice_message(context.user_data)
+    await update.message.reply_text(text, reply_markup=keyboard)
+    return ENTER_AMOUNT_OR_VALUE
+
+
+def _select_coin(t, index):
+    """Запоминает в черновике сделки монету из найденных кандидатов (вместе с её ID)."""
+    coin = t['coin_candidates'][index]
+    t['coin_id'] = coin['id']
+    t['coin_name'] = coin['name']
+    t['symbol'] = coin['symbol']
+
+
+def _coin_choice_message(t):
+    """Текст с выбранной монетой и кнопки остальных совпадений (при неоднозначном вводе)."""
+    text = f"Вы выбрали: {t['coin_name']} ({t['symbol'].upper()}, {t['coin_id']})\n"
+    others = [(i, c) for i, c in enumerate(t['coin_candidates']) if c['id'] != t['coin_id']]
+    keyboard = None
+    if others:
+        text += "Нужна другая монета — выберите её кнопкой.\n"
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"{c['name']} ({c['symbol'].upper()}, {c['id']})", callback_data=f"coin_{i}")]
+            for i, c in others
+        ])
+    text += "Введите количество или сумму:"
+    return text, keyboard
+
+
+async def handle_coin_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    t = context.user_data
+    index = int(query.data.split('_', 1)[1])
+    if index >= len(t.get('coin_candidates') or ()):
+        return ENTER_AMOUNT_OR_VALUE
+    _select_coin(t, index)
+    text, keyboard = _coin_choice_message(t)
+    await query.edit_message_text(text, reply_markup=keyboard)
     return ENTER_AMOUNT_OR_VALUE
 
 
@@ -168,6 +328,7 @@ async def confirm_and_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         value = t['amount_or_value']
         amount = value / t['price']
+    t['amount'] = amount
 
     text = "✅ Подтвердите данные сделки:\n\n"
     text += f"Тип: {'Покупка' if t['transaction_type'] == 'buy' else 'Продажа'}\n"
@@ -196,17 +357,143 @@ async def handle_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = query.from_user.id
     t = context.user_data
 
-    if query.data == "confirm_yes":
+    if query.data == "confirm_yes" and 'amount' not in t:
+        # Черновик сделки устарел и убран из памяти (PERSISTENCE_STATE_TTL)
+        await query.edit_message_text("⌛ Данные сделки устарели, добавьте её заново.",
+                                      reply_markup=main_menu_keyboard())
+    elif query.data == "confirm_yes":
         add_transaction(
             user_id=user_id,
             coin_name=t['coin_name'],
             symbol=t['symbol'],
-            amount=context.user_data['amount_or_value'],
+            amount=t['amount'],
             price=context.user_data['price'],
             transaction_type=context.user_data['transaction_type'],
-            exchange=context.user_data.get('exchange')
+            exchange=context.user_data.get('exchange'),
+            coin_id=t.get('coin_id')
         )
         await query.edit_message_text("✅ Сделка успешно добавлена!", reply_markup=main_menu_keyboard())
     else:
         await query.edit_message_text("❌ Сделка отменена.", reply_markup=main_menu_keyboard())
-    return ConversationHandler.END
\ No newline at end of file
+    return ConversationHandler.END
+
+
+# === НАСТРОЙКИ ===
+
+def _settings_text(profile):
+    """:param profile: настройки пользователя (database.get_user_profile)"""
+    text = "⚙️ Настройки\n\n"
+    text += f"Расчёт себестоимости: {COST_METHOD_NAMES[profile['cost_method']]}\n"
+    text += f"Валюта отображения: {profile['currency'].upper()}\n\n"
+    text += "Выберите, какие покупки списываются при продаже, и валюту, в которой показывать портфель:"
+    return text
+
+
+def _settings_keyboard(profile):
+    # Валюты без известного курса не предлагаем
+    currencies = fx_rates.available(SUPPORTED_CURRENCIES)
+    return settings_keyboard(profile['cost_method'], profile['currency'], currencies)
+
+
+# === ИМПОРТ СДЕЛОК ИЗ CSV ===
+
+async def import_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = "📥 Импорт сделок\n\n"
+    text += "Пришлите CSV-файл с историей сделок документом. Поддерживаются выгрузки "
+    text += "Binance и Bybit (спот), а также простой формат с колонками:\n"
+    text += "date, symbol, type (buy/sell), amount, price[, exchange]\n\n"
+    text += "Повторная загрузка того же файла не создаёт дублей."
+    await update.message.reply_text(text)
+
+
+async def handle_import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    document = update.message.document
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await update.message.reply_text("Файл слишком большой. Разбейте выгрузку на части до 20 МБ.")
+        return
+
+    status = await update.message.reply_text("⏳ Импортирую сделки...")
+    from async_crypto_api import ensure_coin_index
+    await ensure_coin_index()
+
+    # Файл скачивается во временный файл на диске и разбирается потоково в отдельном потоке
+    with tempfile.TemporaryFile() as buffer:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_memory(buffer)
+        buffer.seek(0)
+        try:
+            stats = await asyncio.to_thread(import_csv, user_id, buffer)
+        except CSVFormatError as e:
+            await status.edit_text(f"❌ {e}")
+            return
+
+    text = f"✅ Импорт завершён ({stats['format']})\n\n"
+    text += f"Строк в файле: {stats['rows']}\n"
+    text += f"Добавлено сделок: {stats['imported']}\n"
+    text += f"Уже были загружены: {stats['duplicates']}\n"
+    text += f"Пропущено: {stats['skipped']}\n"
+    if stats['unknown']:
+        text += f"Неизвестные монеты: {', '.join(sorted(stats['unknown'])[:10])}\n"
+    if stats['non_usd']:
+        text += f"Пары не к USD (не поддерживаются): {', '.join(sorted(stats['non_usd'])[:10])}\n"
+    for error in stats['errors']:
+        text += f"⚠️ {error}\n"
+    await status.edit_text(text, reply_markup=main_menu_keyboard())
+
+
+# === ИСТОРИЯ И ВЫГРУЗКА СДЕЛОК ===
+
+async def _recommendations_text(amount, desired_profit, days):
+    recommendations = await recommend_investment_async(amount, desired_profit, days)
+    text = f"🚀 Рекомендации: ${amount:,.0f} → +${desired_profit:,.0f} за {days} дн.\n\n"
+    if not recommendations:
+        text += "Данные рынка ещё собираются, попробуйте позже.\n\n"
+    for rec in recommendations:
+        text += f"🔸 {rec['name']} ({rec['symbol']})\n"
+        text += f"Прогноз: {rec['forecast']}\n"
+        text += f"Вероятность цели: {rec['probability']:.0f}%\n"
+        text += f"Риск: {rec['risk']}\n\n"
+    text += "⚠️ Это не гарантия прибыли. Крипторынок волатилен!"
+    return text
+
+
+async def recommend_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/recommend <сумма> <прибыль> <дней> — рекомендации под цель пользователя."""
+    try:
+        amount, desired_profit, days = (float(arg.replace(',', '.')) for arg in context.args)
+        days = int(days)
+        if amount <= 0 or desired_profit < 0 or days <= 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text(
+            "Укажите сумму, желаемую прибыль (в USD) и срок в днях, например:\n/recommend 500 50 30")
+        return
+    await update.message.reply_text(await _recommendations_text(amount, desired_profit, days),
+                                    reply_markup=main_menu_keyboard())
+
+
+def format_history_row(row):
+    _, date, _, symbol, transaction_type, amount, price, exchange = row
+    icon, action = ("🟢", "Покупка") if transaction_type == 'buy' else ("🔴", "Продажа")
+    text = f"{icon} {date[:16]} {action} {symbol.upper()} {amount:.6g} × ${price:,.2f}"
+    if exchange:
+        text += f" ({exchange})"
+    return text
+
+
+async def export_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    rows, _ = get_transactions_page(user_id, 1)
+    if not rows:
+        await update.message.reply_text("📜 История сделок пуста — выгружать нечего.")
+        return
+
+    # Выгрузка собирается в отдельном потоке пачками прямо в сжатый буфер
+    buffer, size = await asyncio.to_thread(export_transactions, user_id)
+    with buffer:
+        await update.message.reply_document(
+            document=buffer,
+            filename="transactions.csv.gz",
+            caption=f"📜 История сделок (CSV, gzip, {size / 1024:.0f} КБ)"
+        )
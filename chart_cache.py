@@ -0,0 +1,195 @@
+# chart_cache.py
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def chart_key(kind: str, inputs) -> str:
+    """
+    Возвращает ключ графика — хэш нормализованных входных данных.
+
+    :param kind: тип графика (например, 'pie')
+    :param inputs: JSON-сериализуемые данные, по которым рисуется график
+    """
+    payload = json.dumps([kind, inputs], separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ChartCache:
+    """
+    Кэш отрисованных PNG с адресацией по содержимому.
+
+    В памяти — LRU с ограничением по суммарному размеру в байтах; вытесненные
+    картинки при заданном spill_dir сохраняются на диск, где тоже действует
+    LRU с лимитом spill_max_bytes (давно не читанные файлы удаляются). Отдельно хранятся
+    file_id уже загруженных в Telegram картинок, чтобы отправлять их повторно
+    без передачи байтов.
+    """
+
+    def __init__(self, max_bytes: int, spill_dir: str = None, max_file_ids: int = 10000,
+                 spill_max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.max_file_ids = max_file_ids
+        self._images = OrderedDict()  # {key: png}
+        self._file_ids = OrderedDict()  # {key: file_id}
+        self._spilled = OrderedDict()  # {key: размер файла} — от давно прочитанных к недавним
+        self._bytes = 0
+        self._spilled_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'file_id_hits': 0, 'evictions': 0,
+                      'spill_evictions': 0, 'coalesced': 0}
+        if spill_dir:
+            self._load_spilled()
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, f"{key}.png")
+
+    def _load_spilled(self):
+        """Учитывает файлы, оставшиеся на диске с прошлого запуска (старые — первыми)."""
+        try:
+            entries = [entry for entry in os.scandir(self.spill_dir)
+                       if entry.is_file() and entry.name.endswith('.png')]
+        except OSError:
+            return
+        files = []
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, entry.name[:-len('.png')], stat.st_size))
+        for _, key, size in sorted(files):
+            self._spilled[key] = size
+            self._spilled_bytes += size
+        self._remove_spilled(self._trim_spilled())
+
+    def _trim_spilled(self):
+        """Выбирает файлы сверх spill_max_bytes (вызывать под self._lock)."""
+        removed = []
+        while self._spilled_bytes > self.spill_max_bytes and self._spilled:
+            old_key, size = self._spilled.popitem(last=False)
+            self._spilled_bytes -= size
+            self.stats['spill_evictions'] += 1
+            removed.append(old_key)
+        return removed
+
+    def _remove_spilled(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._spill_path(key))
+            except OSError as e:
+                logger.warning(f"Не удалось удалить график {key} с диска: {e}")
+
+    def _spill(self, key, png):
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            path = self._spill_path(key)
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.write(png)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить график {key} на диск: {e}")
+            return
+        with self._lock:
+            if key in self._spilled:
+                self._spilled.move_to_end(key)
+                return
+            self._spilled[key] = len(png)
+            self._spilled_bytes += len(png)
+            removed = self._trim_spilled()
+        self._remove_spilled(removed)
+
+    def get(self, key: str):
+        """Возвращает PNG по ключу (из памяти или с диска) или None."""
+        with self._lock:
+            png = self._images.get(key)
+            if png is not None:
+                self._images.move_to_end(key)
+                self.stats['hits'] += 1
+                return png
+
+        if self.spill_dir:
+            try:
+                with open(self._spill_path(key), 'rb') as f:
+                    png = f.read()
+            except OSError:
+                png = None
+            if png is not None:
+                with self._lock:
+                    self.stats['disk_hits'] += 1
+                    if key in self._spilled:
+                        self._spilled.move_to_end(key)
+                self.put(key, png)
+                return png
+
+        with self._lock:
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, key: str, png: bytes):
+        """Кладёт PNG в кэш, вытесняя самые старые картинки при превышении лимита."""
+        evicted = []
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                return
+            self._images[key] = png
+            self._bytes += len(png)
+            while self._bytes > self.max_bytes and len(self._images) > 1:
+                old_key, old_png = self._images.popitem(last=False)
+                self._bytes -= len(old_png)
+                self.stats['evictions'] += 1
+                evicted.append((old_key, old_png))
+
+        if self.spill_dir:
+            for old_key, old_png in evicted:
+                self._spill(old_key, old_png)
+
+    def get_file_id(self, key: str):
+        """Возвращает file_id уже загруженной в Telegram картинки или None."""
+        with self._lock:
+            file_id = self._file_ids.get(key)
+            if file_id is not None:
+                self._file_ids.move_to_end(key)
+                self.stats['file_id_hits'] += 1
+            return file_id
+
+    def remember_file_id(self, key: str, file_id: str):
+        """Запоминает file_id картинки после первой загрузки."""
+        with self._lock:
+            self._file_ids[key] = file_id
+            self._file_ids.move_to_end(key)
+            while len(self._file_ids) > self.max_file_ids:
+                self._file_ids.popitem(last=False)
+
+    def record(self, name: str, count: int = 1):
+        """Увеличивает счётчик статистики (coalesced)."""
+        with self._lock:
+            self.stats[name] += count
+
+    def hit_rate(self) -> float:
+        """Доля запросов, обслуженных без отрисовки."""
+        served = self.stats['hits'] + self.stats['disk_hits'] + self.stats['file_id_hits']
+        total = served + self.stats['misses']
+        return served / total if total else 0.0
+
+    def info(self):
+        """Возвращает счётчики и текущий размер кэша."""
+        with self._lock:
+            return {
+                **self.stats,
+                'hit_rate': round(self.hit_rate(), 4),
+                'images': len(self._images),
+                'bytes': self._bytes,
+                'spilled': len(self._spilled),
+                'spilled_bytes': self._spilled_bytes,
+                'file_ids': len(self._file_ids),
+            }
@@ -1,37 +1,63 @@
 # charts.py
 
-import matplotlib.pyplot as plt
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 
+import matplotlib
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
-def generate_portfolio_chart(portfolio_data):
-    """
-    Генерирует круговую диаграмму распределения портфеля.
+from chart_cache import ChartCache, chart_key
+from config import CHART_WORKERS, CHART_CACHE_MAX_BYTES, CHART_CACHE_DIR, CHART_CACHE_DIR_MAX_BYTES
+from metrics import CHART_BYTES, CHART_RENDER
 
-    :param portfolio_data: dict с данными о портфеле (результат calculate_portfolio)
-    :return: BytesIO изображение графика
-    """
-    assets = portfolio_data.get('assets', [])
-    
-    if not assets:
-        # Если нет активов — возвращаем пустое изображение с сообщением
-        plt.figure(figsize=(6, 6))
-        plt.text(0.5, 0.5, 'Нет данных для отображения', ha='center', va='center', fontsize=12)
-        plt.axis('off')
-
-        img = BytesIO()
-        plt.savefig(img, format='png')
-        plt.close()
-        img.seek(0)
-        return img
-
-    labels = [a['symbol'] for a in assets]
-    sizes = [a['current'] for a in assets]
-
-    plt.figure(figsize=(6, 6))
-    colors = plt.cm.Paired(range(len(labels)))  # Разные цвета для каждого актива
-
-    plt.pie(
+# Пул процессов для отрисовки: matplotlib не потокобезопасен и держит GIL,
+# поэтому графики рисуются вне event loop и вне основного процесса
+_pool = None
+
+# Готовые PNG и file_id загруженных в Telegram картинок
+chart_cache = ChartCache(CHART_CACHE_MAX_BYTES, CHART_CACHE_DIR, spill_max_bytes=CHART_CACHE_DIR_MAX_BYTES)
+
+# Идущие отрисовки {key: Task}: одинаковые графики, запрошенные одновременно
+# (например, в рассылке), рисуются один раз
+_renders = {}
+
+
+def _new_figure():
+    # Объектный API без pyplot: никакого глобального состояния между графиками
+    fig = Figure(figsize=(6, 6))
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _to_png(fig) -> bytes:
+    img = BytesIO()
+    fig.savefig(img, format='png')
+    return img.getvalue()
+
+
+def _render_empty_png() -> bytes:
+    """Рисует заглушку «Нет данных» и возвращает PNG."""
+    fig = _new_figure()
+    ax = fig.add_subplot()
+    ax.text(0.5, 0.5, 'Нет данных для отображения', ha='center', va='center', fontsize=12)
+    ax.axis('off')
+    return _to_png(fig)
+
+
+def _render_pie_png(labels, sizes) -> bytes:
+    """Рисует круговую диаграмму распределения портфеля и возвращает PNG."""
+    if not labels:
+        return _render_empty_png()
+
+    fig = _new_figure()
+    ax = fig.add_subplot()
+    colors = matplotlib.colormaps['Paired'](range(len(labels)))  # Разные цвета для каждого актива
+
+    ax.pie(
         sizes,
         labels=labels,
         autopct='%1.1f%%',
@@ -40,12 +66,146 @@ def generate_portfolio_chart(portfolio_data):
         shadow=True,
         textprops={'fontsize': 10}
     )
-    plt.title("📊 Распределение портфеля", fontsize=14)
-    plt.axis('equal')  # Круговой вид
+    ax.set_title("📊 Распределение портфеля", fontsize=14)
+    ax.axis('equal')  # Круговой вид
+    return _to_png(fig)
 
-    img = BytesIO()
-    plt.savefig(img, format='png')
-    plt.close()
-    img.seek(0)
 
-    return img
\ No newline at end of file
+def _render_value_png(timestamps, values, days, currency='usd') -> bytes:
+    """Рисует линейный график стоимости портфеля и возвращает PNG."""
+    if len(values) == 0 or not any(values):
+        return _render_empty_png()
+
+    fig = Figure(figsize=(8, 4.5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    dates = np.asarray(timestamps, dtype='datetime64[s]')
+    ax.plot(dates, values, color='tab:blue', linewidth=1.5)
+    ax.fill_between(dates, values, alpha=0.15, color='tab:blue')
+    ax.set_title(f"📈 Стоимость портфеля за {days} дн.", fontsize=14)
+    ax.set_ylabel(currency.upper())
+    ax.grid(alpha=0.3)
+    fig.autofmt_xdate()
+    fig.tight_layout()
+    return _to_png(fig)
+
+
+def _pie_inputs(portfolio_data):
+    """
+    Нормализует данные для круговой диаграммы.
+
+    Размеры секторов переводятся в доли, округлённые до 0.1% (в промилле):
+    картинка с такой точностью не меняется, а одинаковые распределения
+    получают одинаковый ключ в кэше.
+
+    :return: (labels, sizes)
+    """
+    assets = portfolio_data.get('assets', [])
+    total = sum(a['current'] for a in assets)
+    if total <= 0:
+        return [], []
+    return [a['symbol'] for a in assets], [round(a['current'] / total * 1000) for a in assets]
+
+
+def _warm_up():
+    """Инициализатор воркера: импорт matplotlib и загрузка шрифтов — один раз."""
+    _render_pie_png(['A', 'B'], [1, 1])
+
+
+def _ping():
+    return True
+
+
+def start_chart_pool(workers: int = CHART_WORKERS):
+    """
+    Запускает пул процессов отрисовки и прогревает каждый воркер.
+
+    :param workers: количество процессов
+    """
+    global _pool
+    if _pool is not None:
+        return _pool
+    # spawn — чтобы воркеры не наследовали соединения, потоки и сессии родителя
+    _pool = ProcessPoolExecutor(max_workers=workers,
+                                mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_warm_up)
+    for _ in range(workers):
+        _pool.submit(_ping)
+    return _pool
+
+
+def shutdown_chart_pool():
+    """Останавливает пул процессов отрисовки."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def _render_pie(key, labels, sizes):
+    loop = asyncio.get_running_loop()
+    with CHART_RENDER.time(chart='pie'):
+        png = await loop.run_in_executor(start_chart_pool(), _render_pie_png, labels, sizes)
+    CHART_BYTES.observe(len(png), chart='pie')
+    chart_cache.put(key, png)
+    return png
+
+
+async def _render_pie_cached(labels, sizes):
+    key = chart_key('pie', [labels, sizes])
+    png = chart_cache.get(key)
+    if png is None:
+        task = _renders.get(key)
+        if task is None:
+            task = asyncio.ensure_future(_render_pie(key, labels, sizes))
+            _renders[key] = task
+            task.add_done_callback(lambda _: _renders.pop(key, None))
+        else:
+            chart_cache.record('coalesced')
+        # shield: отмена одного ожидающего не должна отменять общую отрисовку
+        png = await asyncio.shield(task)
+    return key, png
+
+
+async def get_portfolio_chart(portfolio_data):
+    """
+    Возвращает график для отправки: file_id, если такая же картинка уже
+    загружалась в Telegram, иначе PNG из кэша или свежеотрисованный.
+
+    После отправки передайте ключ и сообщение в remember_chart_upload.
+
+    :param portfolio_data: dict с данными о портфеле (результат calculate_portfolio)
+    :return: (key, photo) — photo это str (file_id) или BytesIO
+    """
+    labels, sizes = _pie_inputs(portfolio_data)
+    key = chart_key('pie', [labels, sizes])
+    file_id = chart_cache.get_file_id(key)
+    if file_id:
+        return key, file_id
+    _, png = await _render_pie_cached(labels, sizes)
+    return key, BytesIO(png)
+
+
+async def render_value_chart(timestamps, values, days: int, currency: str = 'usd'):
+    """
+    Асинхронно рисует график стоимости портфеля за период в пуле процессов.
+
+    :param timestamps: массив unix time
+    :param values: массив стоимости портфеля в валюте currency
+    :param days: длина периода (для заголовка)
+    :param currency: валюта (подпись оси)
+    :return: BytesIO изображение графика
+    """
+    loop = asyncio.get_running_loop()
+    with CHART_RENDER.time(chart='value'):
+        png = await loop.run_in_executor(start_chart_pool(), _render_value_png,
+                                         np.asarray(timestamps), np.asarray(values), days, currency)
+    CHART_BYTES.observe(len(png), chart='value')
+    return BytesIO(png)
+
+
+def remember_chart_upload(key, message):
+    """Запоминает file_id картинки из отправленного сообщения."""
+    if message is not None and getattr(message, 'photo', None):
+        chart_cache.remember_file_id(key, message.photo[-1].file_id)
+
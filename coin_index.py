@@ -0,0 +1,216 @@
+# coin_index.py
+
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Признаки «производных» токенов (обёртки, мосты), которые при совпадении
+# символа должны уступать оригинальной монете
+_DERIVATIVE_MARKERS = ('wrapped', 'bridged', 'peg', 'wormhole')
+
+
+def _coin_rank(coin):
+    """Ключ сортировки кандидатов: сначала оригинальные монеты, затем короткие id."""
+    coin_id = coin['id']
+    is_derivative = any(marker in coin_id for marker in _DERIVATIVE_MARKERS)
+    return is_derivative, len(coin_id), coin_id
+
+
+class CoinIndex:
+    """
+    Справочник монет CoinGecko в памяти.
+
+    Список загружается один раз (из локального снимка или из API), а затем
+    обновляется в фоне по истечении TTL. Поиск идёт по индексам: точный id,
+    точный символ, префикс названия (отсортированный массив + bisect) и,
+    в последнюю очередь, подстрока названия.
+    """
+
+    def __init__(self, loader, snapshot_path=None, ttl=60 * 60 * 24):
+        """
+        :param loader: функция без аргументов, возвращающая список монет
+                       (как cg.get_coins_list)
+        :param snapshot_path: путь к JSON-файлу со снимком списка или None
+        :param ttl: через сколько секунд список считается устаревшим
+        """
+        self._loader = loader
+        self._snapshot_path = snapshot_path
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._loaded_at = 0.0
+        # Все индексы подменяются одной ссылкой, поэтому читатели
+        # никогда не видят наполовину построенное состояние
+        self._index = None
+
+    @property
+    def loaded(self):
+        """True, если индекс уже построен."""
+        return self._index is not None
+
+    # === Построение индекса ===
+
+    @staticmethod
+    def _build(coins):
+        by_id = {}
+        by_symbol = {}
+        by_name = {}
+        for coin in coins:
+            coin_id = coin['id'].lower()
+            by_id[coin_id] = coin
+            by_symbol.setdefault(coin['symbol'].lower(), []).append(coin)
+            by_name.setdefault(coin['name'].lower(), []).append(coin)
+
+        for candidates in by_symbol.values():
+            candidates.sort(key=_coin_rank)
+        for candidates in by_name.values():
+            candidates.sort(key=_coin_rank)
+
+        names = sorted(by_name)
+        return {
+            'by_id': by_id,
+            'by_symbol': by_symbol,
+            'by_name': by_name,
+            'names': names,
+        }
+
+    def load(self, coins, fetched_at=None):
+        """Перестраивает индекс по переданному списку монет."""
+        index = self._build(coins)
+        self._index = index
+        self._loaded_at = fetched_at or time.time()
+        logger.info(f"Справочник монет загружен: {len(index['by_id'])} монет")
+
+    def _read_snapshot(self):
+        if not self._snapshot_path or not os.path.exists(self._snapshot_path):
+            return None
+        try:
+            with open(self._snapshot_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось прочитать снимок справочника монет: {e}")
+            return None
+
+    def _write_snapshot(self, coins, fetched_at):
+        if not self._snapshot_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._snapshot_path) or '.', exist_ok=True)
+            tmp_path = self._snapshot_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'fetched_at': fetched_at, 'coins': coins}, f)
+            os.replace(tmp_path, self._snapshot_path)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить снимок справочника монет: {e}")
+
+    def refresh(self):
+        """Загружает свежий список из API, перестраивает индекс и сохраняет снимок."""
+        try:
+            coins = self._loader()
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке списка монет: {e}")
+            return False
+        fetched_at = time.time()
+        self.load(coins, fetched_at)
+        self._write_snapshot(coins, fetched_at)
+        return True
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            self._refreshing = False
+
+    def ensure_loaded(self):
+        """Гарантирует наличие индекса и запускает фоновое обновление по TTL."""
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    snapshot = self._read_snapshot()
+                    if snapshot:
+                        self.load(snapshot['coins'], snapshot.get('fetched_at'))
+                    else:
+                        self.refresh()
+
+        if self._index is not None and time.time() - self._loaded_at > self._ttl:
+            with self._lock:
+                if self._refreshing:
+                    return
+                self._refreshing = True
+            threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    # === Поиск ===
+
+    def get(self, coin_id: str):
+        """Возвращает монету по точному id или None."""
+        self.ensure_loaded()
+        if self._index is None:
+            return None
+        return self._index['by_id'].get(coin_id.lower())
+
+    def by_symbol(self, symbol: str):
+        """Возвращает монеты с точным символом, лучшие кандидаты первыми."""
+        self.ensure_loaded()
+        if self._index is None:
+            return []
+        return self._index['by_symbol'].get(symbol.lower(), [])
+
+    def search(self, query: str, limit: int = 5):
+        """
+        Ищет монеты и возвращает кандидатов в порядке релевантности.
+
+        Порядок: точный id, точный символ, точное название, префикс названия,
+        подстрока названия. Внутри группы оригинальные монеты идут раньше
+        обёрток и мостов.
+
+        :param query: строка поиска (id, символ или название)
+        :param limit: максимальное количество кандидатов
+        :return: list of dict — монеты в формате cg.get_coins_list
+        """
+        self.ensure_loaded()
+        index = self._index
+        query = query.strip().lower()
+        if index is None or not query:
+            return []
+
+        results = []
+        seen = set()
+
+        def add(coins):
+            for coin in coins:
+                if coin['id'] not in seen:
+                    seen.add(coin['id'])
+                    results.append(coin)
+            return len(results) >= limit
+
+        exact = index['by_id'].get(query)
+        if exact and add([exact]):
+            return results[:limit]
+        if add(index['by_symbol'].get(query, [])):
+            return results[:limit]
+        if add(index['by_name'].get(query, [])):
+            return results[:limit]
+
+        names = index['names']
+        prefixed = []
+        pos = bisect_left(names, query)
+        while pos < len(names) and names[pos].startswith(query):
+            prefixed.append(names[pos])
+            pos += 1
+        prefixed.sort(key=len)
+        for name in prefixed:
+            if add(index['by_name'][name]):
+                return results[:limit]
+
+        # Подстрока — самый дорогой вариант, только если ничего не нашли
+        if not results:
+            for name in names:
+                if query in name and add(index['by_name'][name]):
+                    break
+
+        return results[:limit]
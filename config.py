@@ -1,3 +1,119 @@
 # config.py
 BOT_TOKEN = "YOUR_TELEGRAM_BOT_TOKEN"
-DB_NAME = "data/portfolio.db"
\ No newline at end of file
+DB_NAME = "data/portfolio.db"
+
+# Справочник монет CoinGecko
+COIN_LIST_PATH = "data/coins.json"
+COIN_LIST_TTL = 60 * 60 * 24  # обновляем раз в сутки
+
+# HTTP-клиент CoinGecko для асинхронных обработчиков
+COINGECKO_API_URL = "https://api.coingecko.com/api/v3"
+HTTP_TIMEOUT = 10  # секунд на запрос
+HTTP_MAX_CONCURRENCY = 8  # одновременных запросов к CoinGecko
+HTTP_MAX_RETRIES = 3
+
+# Проверка ценовых напоминаний
+ALERT_CHECK_INTERVAL = 60  # секунд между проверками
+ALERT_SEND_CONCURRENCY = 20  # одновременных отправок сообщений
+
+# Рассылка отчётов
+BROADCAST_CONCURRENCY = 16  # пользователей обрабатываются одновременно
+BROADCAST_RATE = 25  # сообщений в секунду (лимит Telegram — около 30)
+BROADCAST_MAX_RETRIES = 3
+
+# Отрисовка графиков
+CHART_WORKERS = 2  # процессов в пуле отрисовки
+CHART_CACHE_MAX_BYTES = 32 * 1024 * 1024  # PNG в памяти
+CHART_CACHE_DIR = None  # каталог для вытесненных PNG, например "data/charts"
+CHART_CACHE_DIR_MAX_BYTES = 256 * 1024 * 1024  # PNG на диске; давно не читанные удаляются
+
+# История цен
+PRICE_SAMPLE_INTERVAL = 60 * 5  # как часто записывать цены, секунд
+PRICE_HISTORY_MINUTE_KEEP = 60 * 60 * 24  # минутные точки — сутки
+PRICE_HISTORY_HOUR_KEEP = 60 * 60 * 24 * 30  # часовые — 30 дней, дальше дневные
+
+# Аналитика портфеля
+ANALYTICS_HISTORY_DAYS = 90  # глубина дневного ряда для волатильности, просадки и Шарпа
+ANALYTICS_BATCH_USERS = 1000  # пользователей в одном матричном проходе пакетного расчёта
+
+# Импорт сделок из CSV-выгрузок бирж
+IMPORT_CHUNK_ROWS = 5000  # строк в одной пачке разбора и вставки
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # больше Bot API всё равно не отдаёт
+
+# История сделок и выгрузка
+HISTORY_PAGE_SIZE = 10  # сделок на странице в боте
+EXPORT_BATCH_ROWS = 5000  # строк, читаемых из базы за раз при выгрузке
+EXPORT_SPOOL_MAX_BYTES = 4 * 1024 * 1024  # больше — буфер выгрузки уходит на диск
+EXPORT_COMPRESS_LEVEL = 1  # gzip: быстрый уровень сжимает CSV почти так же хорошо
+
+# Валюты отображения: цены монет запрашиваются только в USD, остальное — по курсам
+SUPPORTED_CURRENCIES = ('usd', 'eur', 'rub', 'uah', 'tjs')
+FX_REFRESH_INTERVAL = 60 * 60  # как часто обновлять таблицу курсов, секунд
+# Курсы валют, которых нет в CoinGecko /exchange_rates: единиц за 1 USD,
+# например {'tjs': 10.9}. Валюта без курса не предлагается в настройках
+FX_MANUAL_RATES = {}
+
+# Кэш цен монет
+PRICE_CACHE_TTL = 60 * 5  # цена свежая 5 минут
+PRICE_CACHE_STALE_TTL = 60 * 60  # дальше час отдаётся сразу, а обновляется в фоне
+PRICE_CACHE_MAX_ENTRIES = 5000  # монет в памяти процесса (LRU)
+PRICE_CACHE_SHARED = True  # общий кэш в базе для нескольких процессов бота
+PRICE_FETCH_WAIT = 15  # секунд ждать чужой запрос тех же монет
+PRICE_REFRESH_WORKERS = 2  # потоков фонового обновления устаревших цен (синхронный путь)
+
+# Фоновое обновление цен: монеты из портфелей и напоминаний обновляются по
+# расписанию, пользовательские запросы читают их из кэша
+INGEST_ENABLED = True  # False — устаревшие цены обновляются запросами пользователей
+INGEST_INTERVAL = 60  # секунд между проходами
+INGEST_HOT_COINS = 250  # самые популярные монеты обновляются каждый проход
+INGEST_COLD_INTERVAL = 60 * 4  # остальные — не реже (меньше PRICE_CACHE_TTL)
+INGEST_MAX_COINS = 1000  # монет за один проход (бюджет запросов к API)
+INGEST_MAX_BACKOFF = 60 * 15  # наибольшая пауза после 429, секунд
+
+# Поток цен с биржи по WebSocket: напоминания срабатывают по тикам, а не по опросу
+STREAMING_ENABLED = False
+STREAM_URL = "wss://stream.binance.com:9443/stream"
+STREAM_QUOTE = 'USDT'  # цены к USDT считаются ценами в USD
+STREAM_MAX_SYMBOLS = 1000  # подписок на одно соединение (лимит Binance — 1024)
+STREAM_WATCHLIST_INTERVAL = 60  # как часто обновлять подписки, секунд
+STREAM_FLUSH_INTERVAL = 5  # как часто переносить цены потока в кэш, секунд
+
+# Рекомендации: сканер рынка по топу монет из /coins/markets
+RECOMMEND_TOP_COINS = 500  # монет по капитализации (страницы по 250)
+RECOMMEND_REFRESH_INTERVAL = 60 * 15  # как часто пересчитывать скан, секунд
+RECOMMEND_HISTORY_DAYS = 7  # глубина часового ряда для признаков
+RECOMMEND_MIN_VOLUME = 1_000_000  # минимальный оборот за сутки, USD
+RECOMMEND_DRIFT_SHRINK = 0.5  # доля исторического тренда, переносимая в прогноз
+RECOMMEND_RESULTS = 3  # рекомендаций в ответе
+# Параметры кнопки «Рекомендации»: сумма, желаемая прибыль (USD) и срок (дней)
+RECOMMEND_DEFAULT_AMOUNT = 100
+RECOMMEND_DEFAULT_PROFIT = 10
+RECOMMEND_DEFAULT_DAYS = 7
+
+# Кэш данных пользователей (валюта, настройки, портфель) в памяти процесса
+USER_CACHE_MAX_USERS = 10000
+
+# Режим webhook (webhook.py): HTTP-сервер принимает обновления и раздаёт их
+# процессам-обработчикам по user_id
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_URL = None  # публичный адрес для setWebhook, например "https://bot.example.com/webhook"
+WEBHOOK_SECRET = None  # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = 4  # процессов-обработчиков
+WEBHOOK_QUEUE_SIZE = 10000  # обновлений в очереди процесса, дальше — 503
+WEBHOOK_WORKER_CONCURRENCY = 64  # обновлений в обработке на процесс (по одному на пользователя)
+LEADER_LOCK_PATH = "data/scheduler.lock"  # задачи планировщика выполняет процесс, захвативший файл
+LEADER_CHECK_INTERVAL = 10  # как часто остальные пытаются стать ведущим, секунд
+PERSISTENCE_DB = "data/persistence.db"  # состояние диалогов, общее для процессов
+PERSISTENCE_UPDATE_INTERVAL = 5  # как часто сохранять состояние диалогов, секунд
+PERSISTENCE_RETRY_MAX_DELAY = 60  # наибольшая пауза между повторами записи после ошибки, секунд
+PERSISTENCE_STATE_TTL = 60 * 60 * 24  # черновик сделки (user_data) неактивного пользователя хранится сутки
+PERSISTENCE_EVICT_INTERVAL = 60 * 10  # как часто убирать из памяти данные неактивных пользователей
+CONVERSATION_TIMEOUT = 60 * 30  # незавершённый диалог добавления сделки сбрасывается через 30 минут
+
+# Метрики в формате Prometheus и профилировщик (metrics.py)
+METRICS_ENABLED = True
+METRICS_HOST = '127.0.0.1'  # только локально: /metrics и /profile открыты без авторизации
+METRICS_PORT = 9108  # в режиме webhook процесс-обработчик N слушает METRICS_PORT + 1 + N
+PROFILER_INTERVAL = 0.01  # секунд между снимками стеков
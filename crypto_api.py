@@ -3,60 +3,268 @@
 from pycoingecko import CoinGeckoAPI
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from coin_index import CoinIndex
+from config import (COIN_LIST_PATH, COIN_LIST_TTL, FX_MANUAL_RATES, PRICE_CACHE_TTL, PRICE_CACHE_STALE_TTL,
+                    PRICE_CACHE_MAX_ENTRIES, PRICE_CACHE_SHARED, PRICE_FETCH_WAIT, PRICE_REFRESH_WORKERS)
+from fx import BASE_CURRENCY, FxRates
+from metrics import API_ERRORS, API_LATENCY, API_RATE_LIMITED
+from price_cache import PriceCache, SingleFlight, SQLiteSharedTier
 
 cg = CoinGeckoAPI()
 logger = logging.getLogger(__name__)
 
-# Простое кэширование (в реальном проекте можно использовать Redis или TTLCache)
-PRICE_CACHE_TTL = 60 * 5  # 5 минут
-_price_cache = {}  # {coin_id: {'price': ..., 'timestamp': ...}}
+
+def _error_status(error):
+    """HTTP-статус из исключения pycoingecko (HTTPError или ValueError с JSON ошибки)."""
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None):
+        return str(response.status_code)
+    content = error.args[0] if error.args else None
+    if isinstance(content, dict) and isinstance(content.get('status'), dict):
+        return str(content['status'].get('error_code') or 'error')
+    return 'error'
+
+
+def _call_api(endpoint, method, **params):
+    """
+    Вызывает метод pycoingecko, замеряя время (metrics.API_LATENCY) и
+    учитывая ошибки и ответы 429 по endpoint.
+    """
+    with API_LATENCY.time(endpoint=endpoint):
+        try:
+            return method(**params)
+        except Exception as e:
+            status = _error_status(e)
+            API_ERRORS.inc(endpoint=endpoint, status=status)
+            if status == '429':
+                API_RATE_LIMITED.inc(endpoint=endpoint)
+            raise
+
+
+# Справочник монет: загружается один раз, дальше поиск идёт в памяти
+coin_index = CoinIndex(lambda: _call_api('/coins/list', cg.get_coins_list), COIN_LIST_PATH, COIN_LIST_TTL)
+
+# Курсы валют к USD: цены монет в других валютах считаются через них
+fx_rates = FxRates(lambda: _call_api('/exchange_rates', cg.get_exchange_rates), FX_MANUAL_RATES)
+
+PRICE_BATCH_SIZE = 250  # сколько монет запрашивать в одном simple/price
+
+# Кэш цен: LRU в памяти + общий уровень в базе; одинаковые одновременные
+# запросы объединяются через price_flight
+price_cache = PriceCache(PRICE_CACHE_MAX_ENTRIES, PRICE_CACHE_TTL, PRICE_CACHE_STALE_TTL,
+                         SQLiteSharedTier() if PRICE_CACHE_SHARED else None)
+price_flight = SingleFlight()
+
+# Фоновое обновление устаревших цен: всплеск таких чтений ставит задачи
+# в очередь, а не создаёт по потоку на каждое
+_refresh_executor = ThreadPoolExecutor(PRICE_REFRESH_WORKERS, thread_name_prefix='price-refresh')
+
+# Монеты, которые обновляет фоновая задача ingestion.py этого процесса
+# (см. set_ingested_coins): их устаревшие цены обновит она сама
+_ingested_coins = frozenset()
+
+
+def _normalize_request(coin_ids, currencies):
+    currencies = [c.lower() for c in currencies]
+    coin_ids = list(dict.fromkeys(c.lower() for c in coin_ids if c))
+    return coin_ids, currencies
+
+
+def _flight_keys(coin_ids, currencies):
+    """Ключи объединения запросов: монета + набор валют."""
+    currencies = tuple(currencies)
+    return [(coin_id, currencies) for coin_id in coin_ids]
+
+
+def _fetch_prices(coin_ids, currencies):
+    """Запрашивает цены пачками по PRICE_BATCH_SIZE и кладёт их в кэш."""
+    result = {}
+    for i in range(0, len(coin_ids), PRICE_BATCH_SIZE):
+        batch = coin_ids[i:i + PRICE_BATCH_SIZE]
+        try:
+            data = _call_api('/simple/price', cg.get_price, ids=batch, vs_currencies=currencies)
+        except Exception as e:
+            price_cache.record('fetch_errors')
+            logger.error(f"Ошибка при получении цен для {len(batch)} монет: {e}")
+            continue
+        result.update(price_cache.store(data, currencies))
+    return result
+
+
+def _fetch_owned(owned, currencies):
+    """Запрашивает цены монет, захваченных в price_flight, и завершает их ожидание."""
+    result = {}
+    try:
+        result = _fetch_prices([coin_id for coin_id, _ in owned], currencies)
+    finally:
+        price_flight.resolve(owned, {key: result.get(key[0]) for key in owned})
+    return result
+
+
+def _fetch_coalesced(coin_ids, currencies, wait=True):
+    """
+    Запрашивает цены, объединяя запрос с уже идущими по тем же монетам.
+
+    Монеты, которые уже запрашивает другой поток или корутина, не
+    запрашиваются повторно — их результат ожидается (если wait).
+
+    :return: dict {coin_id: {currency: price}}
+    """
+    owned, waiting = price_flight.claim(_flight_keys(coin_ids, currencies))
+    result = _fetch_owned(owned, currencies) if owned else {}
+    if wait and waiting:
+        price_cache.record('coalesced', len(waiting))
+        for (coin_id, _), future in waiting.items():
+            try:
+                prices = future.result(PRICE_FETCH_WAIT)
+            except FutureTimeoutError:
+                logger.warning(f"Не дождались цены {coin_id} из параллельного запроса")
+                continue
+            if prices:
+                result[coin_id] = prices
+    return result
+
+
+def set_ingested_coins(coin_ids):
+    """
+    Запоминает монеты, цены которых обновляет фоновая задача (ingestion.py).
+
+    :param coin_ids: iterable с ID монет в CoinGecko
+    """
+    global _ingested_coins
+    _ingested_coins = frozenset(coin_ids)
+
+
+def _stale_to_refresh(stale):
+    """Устаревшие цены, которые не обновит фоновая задача, — их обновляем сами."""
+    return [coin_id for coin_id in stale if coin_id not in _ingested_coins]
+
+
+def _refresh_in_background(coin_ids, currencies):
+    """
+    Обновляет устаревшие цены в фоне (stale-while-revalidate).
+
+    Монеты захватываются в price_flight сразу: уже запрошенные кем-то
+    другим (в том числе предыдущим обновлением из очереди) пропускаются,
+    остальные запрашиваются в _refresh_executor.
+    """
+    owned, _ = price_flight.claim(_flight_keys(coin_ids, currencies))
+    if not owned:
+        return
+    price_cache.record('refreshes', len(owned))
+    _refresh_executor.submit(_fetch_owned, owned, currencies)
+
+
+def get_coin_prices(coin_ids, currencies=('usd',)):
+    """
+    Возвращает текущие цены сразу для нескольких монет.
+
+    Свежие цены берутся из кэша. Устаревшие (старше PRICE_CACHE_TTL, но
+    моложе PRICE_CACHE_STALE_TTL) отдаются сразу, а обновляются в фоне —
+    задачей ingestion.ingest_prices, если она отслеживает монету, иначе здесь.
+    Остальные монеты запрашиваются пачками по PRICE_BATCH_SIZE; если те же
+    монеты уже запрашивает кто-то другой, ждём его ответа вместо нового запроса.
+
+    :param coin_ids: iterable с ID монет в CoinGecko
+    :param currencies: iterable с валютами (например, ('usd', 'eur'))
+    :return: dict {coin_id: {currency: price}}; монеты без цены отсутствуют
+    """
+    coin_ids, currencies = _normalize_request(coin_ids, currencies)
+    fresh, stale, missing = price_cache.lookup(coin_ids, currencies)
+    result = {**fresh, **stale}
+    refresh = _stale_to_refresh(stale)
+    if refresh:
+        _refresh_in_background(refresh, currencies)
+    if missing:
+        result.update(_fetch_coalesced(missing, currencies))
+    return result
 
 
 def get_coin_price(coin_id: str, currency: str = 'usd'):
     """
     Возвращает текущую цену монеты в указанной валюте.
-    
+
+    Запрашивается только цена в USD (она же кэшируется), в другую валюту
+    она переводится по таблице курсов fx_rates.
+
     :param coin_id: ID монеты в CoinGecko
     :param currency: валюта (например, 'usd', 'eur')
-    :return: цена монеты или None, если не найдена
+    :return: цена монеты или None, если не найдена или курс валюты неизвестен
     """
-    currency = currency.lower()
+    price = get_coin_prices([coin_id]).get(coin_id.lower(), {}).get(BASE_CURRENCY)
+    return fx_rates.convert(price, currency) if price is not None else None
 
-    # Проверяем кэш
-    if coin_id in _price_cache:
-        cached = _price_cache[coin_id]
-        if time.time() - cached['timestamp'] < PRICE_CACHE_TTL:
-            return cached['price'].get(currency)
 
-    try:
-        data = cg.get_coin_by_id(id=coin_id)
-        current_price = data['market_data']['current_price'].get(currency)
-        
-        # Обновляем кэш
-        _price_cache[coin_id] = {
-            'price': data['market_data']['current_price'],
-            'timestamp': time.time()
-        }
+class MarketSnapshot:
+    """
+    Цены набора монет, зафиксированные на один момент времени.
 
-        return current_price
-    except Exception as e:
-        logger.error(f"Ошибка при получении цены для {coin_id}: {e}")
-        return None
+    Снимок берётся один раз (например, перед рассылкой отчётов) и
+    передаётся в calculate_portfolio, чтобы все расчёты использовали
+    одинаковые цены и не делали новых запросов к API.
+    """
+
+    def __init__(self, prices, taken_at=None):
+        """
+        :param prices: dict {coin_id: {currency: price}}
+        :param taken_at: время снимка (unix time); по умолчанию — сейчас
+        """
+        self.prices = prices
+        self.taken_at = taken_at or time.time()
+
+    def __len__(self):
+        return len(self.prices)
+
+    def get(self, coin_id: str, currency: str = 'usd'):
+        """Возвращает цену монеты из снимка или None (ID — в любом регистре, как в resolve_coin_id)."""
+        return self.prices.get(coin_id.lower(), {}).get(currency)
+
+
+def search_coins(query: str, limit: int = 5):
+    """
+    Ищет монеты по id, символу или названию.
+
+    :param query: строка поиска
+    :param limit: максимальное количество кандидатов
+    :return: list of dict — кандидаты в порядке релевантности
+    """
+    return coin_index.search(query, limit)
 
 
 def search_coin(query: str):
     """
     Ищет монету по названию или символу.
-    
+
     :param query: строка поиска
     :return: dict с информацией о монете или None
     """
-    try:
-        coins = cg.get_coins_list()
-        for coin in coins:
-            if query.lower() in coin['name'].lower() or query.lower() == coin['symbol']:
-                return coin
-        return None
-    except Exception as e:
-        logger.error(f"Ошибка при поиске монеты '{query}': {e}")
-        return None
\ No newline at end of file
+    coins = search_coins(query, limit=1)
+    return coins[0] if coins else None
+
+
+def resolve_coin_id(symbol_or_id: str) -> str:
+    """
+    Возвращает ID монеты в CoinGecko по символу (например, 'btc') или ID.
+
+    :param symbol_or_id: символ или ID монеты
+    :return: ID монеты; если монета неизвестна — исходная строка в нижнем регистре
+    """
+    query = symbol_or_id.lower()
+    candidates = coin_index.by_symbol(query)
+    if candidates:
+        return candidates[0]['id']
+    coin = search_coin(query)
+    return coin['id'] if coin else query
+
+
+def coin_id_of(symbol: str, coin_id: str = None) -> str:
+    """
+    Возвращает ID монеты позиции или сделки.
+
+    :param symbol: символ монеты
+    :param coin_id: ID, сохранённый при сделке (None — сделки до его появления,
+                    тогда монета определяется по символу)
+    :return: ID монеты в CoinGecko
+    """
+    return coin_id or resolve_coin_id(symbol)
@@ -1,156 +1,1258 @@
 # database.py
 
+import os
+import re
 import sqlite3
-from config import DB_NAME
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from config import DB_NAME, USER_CACHE_MAX_USERS
+from lots import COST_METHODS, DEFAULT_COST_METHOD, LotBook
+from metrics import DB_FETCH, DB_QUERY
 
+# Настройки соединения: WAL позволяет читать параллельно с записью,
+# synchronous=NORMAL в режиме WAL безопасен и заметно быстрее FULL
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",  # ~16 МБ страничного кэша
+    "PRAGMA mmap_size=268435456",  # 256 МБ
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+STATEMENT_CACHE_SIZE = 256  # подготовленных запросов на соединение
 
-def init_db():
-    """Создаёт таблицы базы данных, если их ещё нет."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                currency TEXT DEFAULT 'usd',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                coin_name TEXT,
-                symbol TEXT,
-                amount REAL,
-                price REAL,
-                type TEXT,
-                date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                exchange TEXT,
-                FOREIGN KEY(user_id) REFERENCES users(user_id)
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS reminders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                coin TEXT,
-                target_price REAL,
-                notified BOOLEAN DEFAULT 0,
-                FOREIGN KEY(user_id) REFERENCES users(user_id)
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS user_settings (
-                user_id INTEGER PRIMARY KEY,
-                daily_report BOOLEAN DEFAULT 1,
-                weekly_report BOOLEAN DEFAULT 1,
-                FOREIGN KEY(user_id) REFERENCES users(user_id)
-            )
-        """)
+_local = threading.local()
+
+_QUERY_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+(\w+)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def _query_label(sql):
+    """Метка запроса для метрик: операция и первая таблица, например 'select transactions'."""
+    words = sql.split(None, 1)
+    operation = words[0].lower() if words else ''
+    table = _QUERY_TABLE.search(sql)
+    return f"{operation} {table.group(1)}" if table else operation
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """
+    Курсор, замеряющий время запросов (metrics.DB_QUERY) и явной выборки
+    строк (metrics.DB_FETCH) по метке _query_label. SELECT выполняется до
+    первой строки в execute, остальные строки — при выборке.
+    """
+
+    _label = ''
+
+    def execute(self, sql, parameters=()):
+        self._label = _query_label(sql)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            DB_QUERY.observe(time.perf_counter() - started, query=self._label)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._label = _query_label(sql)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            DB_QUERY.observe(time.perf_counter() - started, query=self._label)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            DB_FETCH.observe(time.perf_counter() - started, query=self._label)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            DB_FETCH.observe(time.perf_counter() - started, query=self._label)
+
+
+class _TimedConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого — _TimedCursor."""
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def get_connection():
+    """
+    Возвращает долгоживущее соединение текущего потока.
+
+    Соединение создаётся один раз на поток, настраивается PRAGMA-ми и
+    кэширует подготовленные запросы, поэтому повторные вызовы ничего не стоят.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(os.path.dirname(DB_NAME) or '.', exist_ok=True)
+        # isolation_level=None — транзакциями управляем сами через transaction()
+        conn = sqlite3.connect(DB_NAME, isolation_level=None,
+                               cached_statements=STATEMENT_CACHE_SIZE, factory=_TimedConnection)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+    return conn
+
+
+def close_connection():
+    """Закрывает соединение текущего потока (например, при остановке бота)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+@contextmanager
+def transaction():
+    """
+    Контекстный менеджер транзакции на записи.
+
+    Открывает BEGIN IMMEDIATE (блокировка на запись берётся сразу, без
+    взаимных блокировок при апгрейде), коммитит при успехе и откатывает
+    при исключении. Вложенные вызовы выполняются в рамках внешней транзакции.
+
+    :return: курсор соединения текущего потока
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn.cursor()
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
         conn.commit()
+    finally:
+        _run_after_commit()
+
+
+def _after_commit(callback):
+    """
+    Откладывает callback до завершения текущей транзакции (вне транзакции — вызывает сразу).
+
+    Так сброс кэша происходит, когда изменения уже видны другим соединениям,
+    и читатель не успеет закэшировать данные до коммита.
+    """
+    if get_connection().in_transaction:
+        callbacks = getattr(_local, 'after_commit', None)
+        if callbacks is None:
+            callbacks = _local.after_commit = []
+        callbacks.append(callback)
+    else:
+        callback()
+
+
+def _run_after_commit():
+    callbacks = getattr(_local, 'after_commit', None)
+    _local.after_commit = None
+    for callback in callbacks or ():
+        callback()
+
+
+class ProfileCache:
+    """
+    Кэш данных пользователей в памяти: валюта, способ расчёта себестоимости,
+    настройки уведомлений, портфель и зафиксированная прибыль.
+
+    Поле загружается из базы при первом обращении и хранится, пока его не
+    сбросит запись через функции этого модуля (write-through: сброс после
+    коммита, см. _after_commit). Загрузка, начатая до сброса, результат в кэш
+    не кладёт. Пользователи вытесняются по LRU сверх max_users.
+
+    Кэш у каждого процесса свой и сбрасывается только записями этого
+    процесса. В режиме webhook обновления пользователя обрабатывает один
+    процесс (user_id % N, см. webhook.py), и его обработчики видят свои
+    изменения. Но рассылки и напоминания ведущий процесс выполняет для всех
+    пользователей, поэтому пакетные чтения (get_portfolios, get_user_currencies
+    и get_realized_pnl с cached=False) идут в базу мимо кэша. Изменения вне
+    процессов бота (database.py rebuild-holdings) видны после перезапуска
+    или clear().
+    """
+
+    HOLDINGS_FIELDS = ('portfolio', 'holdings', 'realized')
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._users = OrderedDict()  # {user_id: {field: value}}
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._holdings_versions = {}  # {user_id: номер версии позиций}
+        self._holdings_epoch = 0  # растёт при сбросе позиций всех пользователей
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+
+    def _store(self, user_id, field, value):
+        self._users.setdefault(user_id, {})[field] = value
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def get(self, user_id, field, loader):
+        """
+        Возвращает поле пользователя из кэша или загружает его loader().
+        """
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and field in entry:
+                self._users.move_to_end(user_id)
+                self.stats['hits'] += 1
+                return entry[field]
+            self.stats['misses'] += 1
+            generation = self._generation
+        value = loader()
+        with self._lock:
+            if generation == self._generation:
+                self._store(user_id, field, value)
+        return value
+
+    def get_many(self, user_ids, field, loader, default=None):
+        """
+        Пакетный вариант get.
+
+        :param loader: функция (list user_id) → dict {user_id: value}
+        :param default: значение для пользователей, которых loader не вернул
+        :return: dict {user_id: value} по всем user_ids
+        """
+        result, missing = {}, []
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._users.get(user_id)
+                if entry is not None and field in entry:
+                    self._users.move_to_end(user_id)
+                    result[user_id] = entry[field]
+                else:
+                    missing.append(user_id)
+            self.stats['hits'] += len(result)
+            self.stats['misses'] += len(missing)
+            generation = self._generation
+        if missing:
+            loaded = loader(missing)
+            with self._lock:
+                for user_id in missing:
+                    value = loaded.get(user_id, default)
+                    result[user_id] = value
+                    if generation == self._generation:
+                        self._store(user_id, field, value)
+        return result
+
+    def invalidate(self, user_id, *fields):
+        """Сбрасывает поля пользователя (без fields — все); поля позиций меняют holdings_version."""
+        with self._lock:
+            self._generation += 1
+            self.stats['invalidations'] += 1
+            entry = self._users.get(user_id)
+            if entry is not None:
+                for field in fields or list(entry):
+                    entry.pop(field, None)
+            if not fields or set(fields) & set(self.HOLDINGS_FIELDS):
+                self._holdings_versions[user_id] = self._holdings_versions.get(user_id, 0) + 1
+
+    def invalidate_holdings(self, user_id=None):
+        """Сбрасывает позиции пользователя (None — всех пользователей)."""
+        if user_id is not None:
+            self.invalidate(user_id, *self.HOLDINGS_FIELDS)
+            return
+        with self._lock:
+            self._generation += 1
+            self._holdings_epoch += 1
+            self.stats['invalidations'] += 1
+            for entry in self._users.values():
+                for field in self.HOLDINGS_FIELDS:
+                    entry.pop(field, None)
+
+    def holdings_version(self, user_id):
+        """Номер версии позиций пользователя: меняется при каждом их изменении в этом процессе."""
+        with self._lock:
+            return self._holdings_epoch + self._holdings_versions.get(user_id, 0)
+
+    def clear(self):
+        """Сбрасывает весь кэш (например, после изменений из другого процесса)."""
+        self.invalidate_holdings()
+        with self._lock:
+            self._users.clear()
+
+    def info(self):
+        """Счётчики и число пользователей в кэше."""
+        with self._lock:
+            total = self.stats['hits'] + self.stats['misses']
+            return {**self.stats, 'users': len(self._users),
+                    'hit_rate': round(self.stats['hits'] / total, 4) if total else 0.0}
+
+
+profile_cache = ProfileCache(USER_CACHE_MAX_USERS)
+
+
+# Шаг миграции «пересчитать holdings из истории сделок». Выполняется один раз
+# после остальных шагов всех недостающих миграций: пересчёт пишет и колонки,
+# добавленные более поздними миграциями.
+REBUILD_HOLDINGS = 'rebuild holdings'
+
+# Миграции схемы: (версия, шаги). Шаг — SQL-запрос, функция, принимающая курсор,
+# или REBUILD_HOLDINGS. Номер последней применённой миграции хранится в
+# PRAGMA user_version, поэтому init_db на существующей базе применяет только
+# недостающие шаги.
+MIGRATIONS = [
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            currency TEXT DEFAULT 'usd',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            coin_name TEXT,
+            symbol TEXT,
+            amount REAL,
+            price REAL,
+            type TEXT,
+            date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            exchange TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            coin TEXT,
+            target_price REAL,
+            notified BOOLEAN DEFAULT 0,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER PRIMARY KEY,
+            daily_report BOOLEAN DEFAULT 1,
+            weekly_report BOOLEAN DEFAULT 1,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """,
+    ]),
+    (2, [
+        # Сделки пользователя по монете: WHERE user_id = ? AND symbol = ?
+        # (get_portfolio теперь читает holdings)
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user_symbol_type "
+        "ON transactions (user_id, symbol, type)",
+        # get_all_transactions: WHERE user_id = ? ORDER BY date DESC
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user_date "
+        "ON transactions (user_id, date)",
+        # Частичные индексы только по активным напоминаниям
+        "CREATE INDEX IF NOT EXISTS idx_reminders_active_coin "
+        "ON reminders (coin) WHERE notified = 0",
+        "CREATE INDEX IF NOT EXISTS idx_reminders_active_user "
+        "ON reminders (user_id) WHERE notified = 0",
+        "ANALYZE",
+    ]),
+    (3, [
+        # Материализованные позиции: обновляются в той же транзакции, что и сделка
+        """
+        CREATE TABLE IF NOT EXISTS holdings (
+            user_id INTEGER NOT NULL,
+            symbol TEXT NOT NULL,
+            quantity REAL NOT NULL DEFAULT 0,
+            cost_basis REAL NOT NULL DEFAULT 0,
+            realized_pnl REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, symbol)
+        ) WITHOUT ROWID
+        """,
+        REBUILD_HOLDINGS,
+    ]),
+    (4, [
+        # Направление напоминания: 'above' — цена поднялась до цели, 'below' — опустилась
+        "ALTER TABLE reminders ADD COLUMN direction TEXT NOT NULL DEFAULT 'above'",
+    ]),
+    (5, [
+        # История цен: resolution — длина интервала в секундах (60, 3600, 86400),
+        # ts — начало интервала (unix time), price — средняя цена за интервал
+        # по samples замерам
+        """
+        CREATE TABLE IF NOT EXISTS price_history (
+            coin_id TEXT NOT NULL,
+            resolution INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            price REAL NOT NULL,
+            samples INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (coin_id, resolution, ts)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_price_history_resolution_ts "
+        "ON price_history (resolution, ts)",
+    ]),
+    (6, [
+        # Способ расчёта себестоимости: 'avg', 'fifo' или 'lifo'
+        f"ALTER TABLE users ADD COLUMN cost_method TEXT NOT NULL DEFAULT '{DEFAULT_COST_METHOD}'",
+        # Открытые лоты позиции (LotBook.dump) и id последней учтённой сделки
+        "ALTER TABLE holdings ADD COLUMN lots BLOB",
+        "ALTER TABLE holdings ADD COLUMN last_tx_id INTEGER NOT NULL DEFAULT 0",
+        # _sync_holdings: WHERE user_id = ? AND id > ? — rowid входит в индекс
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions (user_id)",
+        # Лоты и контрольные точки существующих позиций
+        REBUILD_HOLDINGS,
+    ]),
+    (7, [
+        # Ключ импортированной сделки (биржа + id сделки или хэш строки) —
+        # повторный импорт того же файла не создаёт дублей
+        "ALTER TABLE transactions ADD COLUMN import_key TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_import_key "
+        "ON transactions (user_id, import_key) WHERE import_key IS NOT NULL",
+    ]),
+    (8, [
+        # Общий кэш цен для нескольких процессов бота: prices — JSON {currency: price}
+        """
+        CREATE TABLE IF NOT EXISTS price_cache (
+            coin_id TEXT PRIMARY KEY,
+            prices TEXT NOT NULL,
+            fetched_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (9, [
+        # ID монеты в CoinGecko, выбранной пользователем: у разных монет бывает
+        # один символ. NULL — сделки до миграции, монета определяется по символу
+        "ALTER TABLE transactions ADD COLUMN coin_id TEXT",
+        "ALTER TABLE holdings ADD COLUMN coin_id TEXT",
+    ]),
+]
+
+# Максимум параметров в одном запросе IN (...) — с запасом до лимита SQLite
+SQL_IN_BATCH_SIZE = 500
+
+
+def get_schema_version() -> int:
+    """Возвращает номер последней применённой миграции."""
+    return get_connection().execute("PRAGMA user_version").fetchone()[0]
+
+
+def init_db():
+    """Создаёт таблицы базы данных и применяет недостающие миграции схемы."""
+    current = get_schema_version()
+    pending = [(version, steps) for version, steps in MIGRATIONS if version > current]
+    if not pending:
+        return
+    # Все недостающие миграции и пересчёт holdings — одна транзакция вместе с
+    # записью версии: сбой посередине не оставит базу без пересчёта
+    rebuild = False
+    with transaction() as cursor:
+        for version, steps in pending:
+            for step in steps:
+                if step == REBUILD_HOLDINGS:
+                    rebuild = True
+                elif callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute(f"PRAGMA user_version = {version}")
+        if rebuild:
+            _rebuild_holdings(cursor)
+            _after_commit(profile_cache.invalidate_holdings)
 
 
 def add_user(user_id: int):
     """Добавляет пользователя в БД, если его ещё нет."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
+    with transaction() as cursor:
         cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-        conn.commit()
+        if cursor.rowcount:
+            _after_commit(lambda: profile_cache.invalidate(user_id))
 
 
 def add_transaction(user_id: int, coin_name: str, symbol: str, amount: float,
-                    price: float, transaction_type: str, exchange: str = None):
-    """Добавляет новую сделку в БД."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
+                    price: float, transaction_type: str, exchange: str = None, coin_id: str = None):
+    """
+    Добавляет новую сделку в БД и обновляет позицию пользователя по монете.
+
+    :param coin_id: ID монеты в CoinGecko; None — монета определяется по символу
+    """
+    with transaction() as cursor:
         cursor.execute("""
-            INSERT INTO transactions (user_id, coin_name, symbol, amount, price, type, exchange)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (user_id, coin_name, symbol, amount, price, transaction_type, exchange))
-        conn.commit()
+            INSERT INTO transactions (user_id, coin_name, symbol, amount, price, type, exchange, coin_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, coin_name, symbol, amount, price, transaction_type, exchange, coin_id))
+        _sync_holdings(cursor, user_id)
+        _after_commit(lambda: profile_cache.invalidate_holdings(user_id))
+
+
+def _get_cost_method(cursor, user_id):
+    cursor.execute("SELECT cost_method FROM users WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    return row[0] if row and row[0] in COST_METHODS else DEFAULT_COST_METHOD
+
+
+def _save_holding(cursor, user_id, symbol, book, last_tx_id, coin_id=None):
+    cursor.execute("""
+        INSERT INTO holdings (user_id, symbol, quantity, cost_basis, realized_pnl, lots, last_tx_id, coin_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, symbol) DO UPDATE SET
+            quantity = excluded.quantity,
+            cost_basis = excluded.cost_basis,
+            realized_pnl = excluded.realized_pnl,
+            lots = excluded.lots,
+            last_tx_id = excluded.last_tx_id,
+            coin_id = COALESCE(excluded.coin_id, holdings.coin_id)
+    """, (user_id, symbol, *book.position, book.dump(), last_tx_id, coin_id))
+
+
+def _sync_holdings(cursor, user_id):
+    """
+    Догоняет позиции пользователя по сделкам, добавленным после контрольной точки.
+
+    Контрольная точка — максимальный last_tx_id позиций пользователя: сделки
+    применяются строго по возрастанию id, поэтому всё, что не больше неё,
+    уже учтено. Обрабатываются только новые строки, а открытые лоты
+    восстанавливаются из holdings без повторного прохода по истории.
+
+    :return: количество обработанных сделок
+    """
+    cursor.execute("SELECT COALESCE(MAX(last_tx_id), 0) FROM holdings WHERE user_id = ?", (user_id,))
+    checkpoint = cursor.fetchone()[0]
+    cursor.execute("""
+        SELECT id, symbol, amount, price, type, coin_id FROM transactions
+        WHERE user_id = ? AND id > ?
+        ORDER BY id
+    """, (user_id, checkpoint))
+    rows = cursor.fetchall()
+    if not rows:
+        return 0
+
+    method = _get_cost_method(cursor, user_id)
+    books = {}
+    coin_ids = {}  # {symbol: ID монеты из последней сделки, где он указан}
+    for tx_id, symbol, amount, price, transaction_type, coin_id in rows:
+        if coin_id:
+            coin_ids[symbol] = coin_id
+        if symbol not in books:
+            cursor.execute("""
+                SELECT quantity, cost_basis, realized_pnl, lots FROM holdings
+                WHERE user_id = ? AND symbol = ?
+            """, (user_id, symbol))
+            row = cursor.fetchone()
+            books[symbol] = LotBook(method, *row) if row else LotBook(method)
+        books[symbol].apply(amount, price, transaction_type)
+
+    last_tx_id = rows[-1][0]
+    for symbol, book in books.items():
+        _save_holding(cursor, user_id, symbol, book, last_tx_id, coin_ids.get(symbol))
+    return len(rows)
+
+
+def sync_holdings(user_id: int):
+    """
+    Учитывает в holdings сделки, добавленные в обход add_transaction (например, импорт).
+
+    :return: количество обработанных сделок
+    """
+    with transaction() as cursor:
+        _after_commit(lambda: profile_cache.invalidate_holdings(user_id))
+        return _sync_holdings(cursor, user_id)
+
+
+def import_transactions(user_id: int, chunks):
+    """
+    Массово добавляет сделки пользователя одной транзакцией.
+
+    Сделки с уже существующим import_key пропускаются (INSERT OR IGNORE по
+    уникальному индексу). Если новые сделки идут по возрастанию даты и не
+    старше последней имеющейся, позиции догоняются инкрементально, иначе
+    пересчитываются из истории в хронологическом порядке.
+
+    :param chunks: итерируемое списков строк
+                   (coin_name, symbol, amount, price, type, date, exchange, import_key, coin_id);
+                   date — строка 'YYYY-MM-DD HH:MM:SS' (UTC)
+    :return: количество добавленных сделок
+    """
+    conn = get_connection()
+    with transaction() as cursor:
+        cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        cursor.execute("SELECT MAX(date) FROM transactions WHERE user_id = ?", (user_id,))
+        previous = cursor.fetchone()[0] or ''
+
+        changes = conn.total_changes
+        in_order = True
+        for chunk in chunks:
+            cursor.executemany("""
+                INSERT OR IGNORE INTO transactions
+                    (user_id, coin_name, symbol, amount, price, type, date, exchange, import_key, coin_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, [(user_id, *row) for row in chunk])
+            for row in chunk:
+                in_order = in_order and row[5] >= previous
+                previous = row[5]
+        inserted = conn.total_changes - changes
+
+        if inserted:
+            if in_order:
+                _sync_holdings(cursor, user_id)
+            else:
+                _rebuild_holdings(cursor, user_id)
+            _after_commit(lambda: profile_cache.invalidate_holdings(user_id))
+    return inserted
+
+
+def _compute_holdings(cursor, user_id=None):
+    """
+    Пересчитывает позиции из истории сделок (в порядке дат, при равных — в
+    порядке добавления) способом расчёта себестоимости каждого пользователя.
+
+    :return: (dict {(user_id, symbol): LotBook}, dict {user_id: id последней сделки},
+             dict {(user_id, symbol): ID монеты из последней сделки, где он указан})
+    """
+    query = """
+        SELECT t.id, t.user_id, t.symbol, t.amount, t.price, t.type, u.cost_method, t.coin_id
+        FROM transactions t
+        LEFT JOIN users u ON u.user_id = t.user_id
+    """
+    params = ()
+    if user_id is not None:
+        query += " WHERE t.user_id = ?"
+        params = (user_id,)
+    # Сделки в хронологическом порядке: импортированные могут быть старше уже добавленных
+    query += " ORDER BY t.date, t.id"
+
+    books = {}
+    last_tx_ids = {}
+    coin_ids = {}
+    rows = cursor.execute(query, params)
+    for tx_id, row_user_id, symbol, amount, price, transaction_type, method, coin_id in rows:
+        key = (row_user_id, symbol)
+        book = books.get(key)
+        if book is None:
+            book = books[key] = LotBook(method if method in COST_METHODS else DEFAULT_COST_METHOD)
+        book.apply(amount, price, transaction_type)
+        last_tx_ids[row_user_id] = max(tx_id, last_tx_ids.get(row_user_id, 0))
+        if coin_id:
+            coin_ids[key] = coin_id
+    return books, last_tx_ids, coin_ids
+
+
+def _rebuild_holdings(cursor, user_id=None):
+    books, last_tx_ids, coin_ids = _compute_holdings(cursor, user_id)
+    if user_id is None:
+        cursor.execute("DELETE FROM holdings")
+    else:
+        cursor.execute("DELETE FROM holdings WHERE user_id = ?", (user_id,))
+    cursor.executemany("""
+        INSERT INTO holdings (user_id, symbol, quantity, cost_basis, realized_pnl, lots, last_tx_id, coin_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(u, s, *book.position, book.dump(), last_tx_ids[u], coin_ids.get((u, s)))
+          for (u, s), book in books.items()])
+    return len(books)
+
+
+def rebuild_holdings(user_id: int = None):
+    """
+    Полностью пересчитывает таблицу holdings из истории сделок.
+
+    :param user_id: пересчитать только этого пользователя (None — всех)
+    :return: количество пересчитанных позиций
+    """
+    with transaction() as cursor:
+        _after_commit(lambda: profile_cache.invalidate_holdings(user_id))
+        return _rebuild_holdings(cursor, user_id)
+
+
+def verify_holdings(user_id: int = None, tolerance: float = 1e-6):
+    """
+    Сверяет holdings с пересчётом из истории сделок, ничего не изменяя.
+
+    :return: list of (user_id, symbol, сохранённая позиция, пересчитанная позиция)
+    """
+    cursor = get_connection().cursor()
+    books, _, _ = _compute_holdings(cursor, user_id)
+    expected = {key: book.position for key, book in books.items()}
+
+    query = "SELECT user_id, symbol, quantity, cost_basis, realized_pnl FROM holdings"
+    params = ()
+    if user_id is not None:
+        query += " WHERE user_id = ?"
+        params = (user_id,)
+    stored = {(row[0], row[1]): tuple(row[2:]) for row in cursor.execute(query, params)}
+
+    mismatches = []
+    for key in expected.keys() | stored.keys():
+        actual = stored.get(key, (0.0, 0.0, 0.0))
+        wanted = expected.get(key, (0.0, 0.0, 0.0))
+        if any(abs(a - w) > tolerance for a, w in zip(actual, wanted)):
+            mismatches.append((*key, actual, wanted))
+    return mismatches
 
 
 def get_portfolio(user_id: int):
-    """Возвращает портфель пользователя — монеты, которые он купил и всё ещё держит."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
+    """
+    Возвращает портфель пользователя — монеты, которые он всё ещё держит.
+
+    :return: list of (symbol, quantity, avg_price, coin_id) — средняя цена взвешена
+             по объёму, coin_id — None, если монета не выбрана явно
+             (см. crypto_api.coin_id_of)
+    """
+    def load():
+        cursor = get_connection().cursor()
         cursor.execute("""
-            SELECT symbol, SUM(amount) as total_amount, AVG(price) as avg_price
-            FROM transactions
-            WHERE user_id = ? AND type = 'buy'
-            GROUP BY symbol
-            HAVING total_amount > 0
+            SELECT symbol, quantity, cost_basis / quantity AS avg_price, coin_id
+            FROM holdings
+            WHERE user_id = ? AND quantity > 0
         """, (user_id,))
-        return cursor.fetchall()
+        return tuple(cursor.fetchall())
 
+    return list(profile_cache.get(user_id, 'portfolio', load))
 
-def get_all_transactions(user_id: int):
-    """Возвращает историю всех сделок пользователя."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
+
+def get_portfolios(user_ids):
+    """
+    Возвращает портфели сразу нескольких пользователей.
+
+    :return: list of (user_id, symbol, quantity, avg_price, coin_id)
+    """
+    user_ids = list(user_ids)
+    cursor = get_connection().cursor()
+    rows = []
+    for i in range(0, len(user_ids), SQL_IN_BATCH_SIZE):
+        batch = user_ids[i:i + SQL_IN_BATCH_SIZE]
+        placeholders = ','.join('?' * len(batch))
+        cursor.execute(f"""
+            SELECT user_id, symbol, quantity, cost_basis / quantity AS avg_price, coin_id
+            FROM holdings
+            WHERE user_id IN ({placeholders}) AND quantity > 0
+        """, batch)
+        rows.extend(cursor.fetchall())
+    return rows
+
+
+def get_realized_pnl(user_ids, cached: bool = True):
+    """
+    Возвращает зафиксированную прибыль пользователей по всем позициям, включая закрытые.
+
+    :param cached: False — читать базу мимо profile_cache (пакетные расчёты по
+                   пользователям других процессов)
+    :return: dict {user_id: realized_pnl}; пользователей без позиций в словаре нет
+    """
+    def load(user_ids):
+        cursor = get_connection().cursor()
+        result = {}
+        for i in range(0, len(user_ids), SQL_IN_BATCH_SIZE):
+            batch = user_ids[i:i + SQL_IN_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            cursor.execute(f"""
+                SELECT user_id, SUM(realized_pnl)
+                FROM holdings
+                WHERE user_id IN ({placeholders})
+                GROUP BY user_id
+            """, batch)
+            result.update(cursor.fetchall())
+        return result
+
+    user_ids = list(user_ids)
+    realized = profile_cache.get_many(user_ids, 'realized', load) if cached else load(user_ids)
+    return {user_id: value for user_id, value in realized.items() if value is not None}
+
+
+def get_holdings(user_id: int):
+    """
+    Возвращает все позиции пользователя, включая закрытые.
+
+    :return: list of (symbol, quantity, cost_basis, realized_pnl)
+    """
+    def load():
+        cursor = get_connection().cursor()
         cursor.execute("""
-            SELECT * FROM transactions
+            SELECT symbol, quantity, cost_basis, realized_pnl
+            FROM holdings
             WHERE user_id = ?
-            ORDER BY date DESC
         """, (user_id,))
-        return cursor.fetchall()
+        return tuple(cursor.fetchall())
+
+    return list(profile_cache.get(user_id, 'holdings', load))
+
+
+# Колонки сделки в истории и выгрузке
+HISTORY_COLUMNS = "id, date, coin_name, symbol, type, amount, price, exchange"
+
+
+def get_transactions_page(user_id: int, limit: int, cursor=None, direction: str = 'older'):
+    """
+    Возвращает страницу истории сделок по курсору (date, id) — от новых к старым.
 
+    Страница читается по индексу (user_id, date) без OFFSET, поэтому
+    стоимость не зависит от того, насколько далеко пролистана история.
 
-def set_reminder(user_id: int, coin: str, target_price: float):
-    """Устанавливает напоминание о целевой цене монеты."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
+    :param limit: сделок на странице
+    :param cursor: (date, id) граничной сделки текущей страницы; None — первая страница
+    :param direction: 'older' — сделки старше курсора, 'newer' — новее
+    :return: (rows, has_more) — rows от новых к старым в формате HISTORY_COLUMNS,
+             has_more — есть ли ещё сделки дальше в направлении direction
+    """
+    query = f"SELECT {HISTORY_COLUMNS} FROM transactions WHERE user_id = ?"
+    params = [user_id]
+    if cursor is not None:
+        query += " AND (date, id) < (?, ?)" if direction == 'older' else " AND (date, id) > (?, ?)"
+        params.extend(cursor)
+    order = "DESC" if direction == 'older' else "ASC"
+    query += f" ORDER BY date {order}, id {order} LIMIT ?"
+    params.append(limit + 1)
+
+    rows = get_connection().execute(query, params).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction != 'older':
+        rows.reverse()
+    return rows, has_more
+
+
+def iter_transactions(user_id: int, batch_size: int = 5000, newest_first: bool = False):
+    """
+    Потоково отдаёт всю историю сделок пользователя.
+
+    История читается пачками по курсору (date, id), в памяти одновременно
+    не больше batch_size строк, и между пачками не держится открытое чтение.
+
+    :return: генератор строк в формате HISTORY_COLUMNS
+    """
+    direction = 'older' if newest_first else 'newer'
+    cursor = None
+    while True:
+        rows, has_more = get_transactions_page(user_id, batch_size, cursor, direction)
+        if not rows:
+            return
+        # Страница всегда упорядочена от новых к старым
+        if newest_first:
+            yield from rows
+            last = rows[-1]
+        else:
+            yield from reversed(rows)
+            last = rows[0]
+        if not has_more:
+            return
+        cursor = (last[1], last[0])
+
+
+def get_all_transactions(user_id: int):
+    """
+    Возвращает историю всех сделок пользователя списком (от новых к старым).
+    Для длинной истории — iter_transactions, она не держит всё в памяти.
+    """
+    cursor = get_connection().cursor()
+    cursor.execute("""
+        SELECT * FROM transactions
+        WHERE user_id = ?
+        ORDER BY date DESC, id DESC
+    """, (user_id,))
+    return cursor.fetchall()
+
+
+def set_reminder(user_id: int, coin: str, target_price: float, direction: str = 'above'):
+    """
+    Устанавливает напоминание о целевой цене монеты.
+
+    :param direction: 'above' — сообщить, когда цена поднимется до цели,
+                      'below' — когда опустится до неё
+    """
+    with transaction() as cursor:
         cursor.execute("""
-            INSERT INTO reminders (user_id, coin, target_price)
-            VALUES (?, ?, ?)
-        """, (user_id, coin, target_price))
-        conn.commit()
+            INSERT INTO reminders (user_id, coin, target_price, direction)
+            VALUES (?, ?, ?, ?)
+        """, (user_id, coin, target_price, direction))
 
 
 def get_active_reminders(user_id: int):
     """Возвращает активные напоминания пользователя."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, coin, target_price FROM reminders
-            WHERE user_id = ? AND notified = 0
-        """, (user_id,))
-        return cursor.fetchall()
+    cursor = get_connection().cursor()
+    cursor.execute("""
+        SELECT id, coin, target_price FROM reminders
+        WHERE user_id = ? AND notified = 0
+    """, (user_id,))
+    return cursor.fetchall()
+
+
+def get_all_active_reminders():
+    """
+    Возвращает все активные напоминания всех пользователей.
+
+    :return: list of (id, user_id, coin, target_price, direction)
+    """
+    cursor = get_connection().cursor()
+    cursor.execute("""
+        SELECT id, user_id, coin, target_price, direction FROM reminders
+        WHERE notified = 0
+    """)
+    return cursor.fetchall()
+
+
+def mark_reminders_as_notified(reminder_ids):
+    """
+    Помечает пачку напоминаний как отправленные одной транзакцией.
+
+    :return: set ID, которые были помечены этим вызовом (уже отправленные
+             другой проверкой не входят — по ним сообщение слать не нужно)
+    """
+    reminder_ids = list(reminder_ids)
+    marked = set()
+    with transaction() as cursor:
+        for i in range(0, len(reminder_ids), SQL_IN_BATCH_SIZE):
+            batch = reminder_ids[i:i + SQL_IN_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            cursor.execute(f"UPDATE reminders SET notified = 1 "
+                           f"WHERE id IN ({placeholders}) AND notified = 0 RETURNING id", batch)
+            marked.update(row[0] for row in cursor.fetchall())
+    return marked
 
 
 def mark_reminder_as_notified(reminder_id: int):
     """Помечает напоминание как отправленное."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
+    with transaction() as cursor:
         cursor.execute("""
             UPDATE reminders SET notified = 1
             WHERE id = ?
         """, (reminder_id,))
-        conn.commit()
 
 
 def set_user_currency(user_id: int, currency: str):
     """Устанавливает валюту отображения для пользователя."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
+    with transaction() as cursor:
         cursor.execute("""
             UPDATE users SET currency = ? WHERE user_id = ?
         """, (currency.lower(), user_id))
-        conn.commit()
+        _after_commit(lambda: profile_cache.invalidate(user_id, 'currency'))
 
 
 def get_user_currency(user_id: int) -> str:
     """Возвращает установленную пользователем валюту."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT currency FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else 'usd'
+    return get_user_currencies([user_id]).get(user_id) or 'usd'
+
+
+def get_user_currencies(user_ids, cached: bool = True):
+    """
+    Возвращает валюты отображения нескольких пользователей.
+
+    :param cached: False — читать базу мимо profile_cache (пакетные расчёты по
+                   пользователям других процессов)
+    :return: dict {user_id: currency}; пользователей без записи в словаре нет
+    """
+    def load(user_ids):
+        cursor = get_connection().cursor()
+        result = {}
+        for i in range(0, len(user_ids), SQL_IN_BATCH_SIZE):
+            batch = user_ids[i:i + SQL_IN_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            cursor.execute(f"SELECT user_id, currency FROM users WHERE user_id IN ({placeholders})", batch)
+            result.update(cursor.fetchall())
+        return result
+
+    user_ids = list(user_ids)
+    currencies = profile_cache.get_many(user_ids, 'currency', load) if cached else load(user_ids)
+    return {user_id: currency for user_id, currency in currencies.items() if currency is not None}
+
+
+def set_cost_method(user_id: int, method: str):
+    """
+    Устанавливает способ расчёта себестоимости ('avg', 'fifo' или 'lifo').
+
+    Позиции пользователя пересчитываются из истории сделок новым способом
+    в той же транзакции.
+
+    :return: количество пересчитанных позиций
+    """
+    if method not in COST_METHODS:
+        raise ValueError(f"Неизвестный способ расчёта себестоимости: {method}")
+    with transaction() as cursor:
+        cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        cursor.execute("UPDATE users SET cost_method = ? WHERE user_id = ?", (method, user_id))
+        _after_commit(lambda: profile_cache.invalidate(user_id, 'cost_method', *ProfileCache.HOLDINGS_FIELDS))
+        return _rebuild_holdings(cursor, user_id)
+
+
+def get_cost_method(user_id: int) -> str:
+    """Возвращает способ расчёта себестоимости пользователя."""
+    return profile_cache.get(user_id, 'cost_method', lambda: _get_cost_method(get_connection().cursor(), user_id))
+
+
+def get_user_profile(user_id: int):
+    """
+    Возвращает настройки пользователя одним словарём (из кэша, без запросов к базе,
+    если с прошлого обращения ничего не менялось).
+
+    :return: dict: currency, cost_method, daily_report, weekly_report,
+             holdings_version — меняется при каждом изменении позиций
+    """
+    daily, weekly = get_user_notifications(user_id)
+    return {
+        'currency': get_user_currency(user_id),
+        'cost_method': get_cost_method(user_id),
+        'daily_report': daily,
+        'weekly_report': weekly,
+        'holdings_version': profile_cache.holdings_version(user_id),
+    }
 
 
 def get_all_users():
     """Возвращает список всех пользователей бота."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users")
-        return [row[0] for row in cursor.fetchall()]
\ No newline at end of file
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT user_id FROM users")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def get_user_notifications(user_id: int):
+    """
+    Возвращает статус уведомлений пользователя.
+
+    :return: (daily_report, weekly_report) — по умолчанию оба включены
+    """
+    def load():
+        cursor = get_connection().cursor()
+        cursor.execute("""
+            SELECT daily_report, weekly_report FROM user_settings WHERE user_id = ?
+        """, (user_id,))
+        result = cursor.fetchone()
+        return (bool(result[0]), bool(result[1])) if result else (True, True)
+
+    return profile_cache.get(user_id, 'notifications', load)
+
+
+def _toggle_notification(user_id: int, column: str) -> bool:
+    with transaction() as cursor:
+        cursor.execute("INSERT OR IGNORE INTO user_settings (user_id) VALUES (?)", (user_id,))
+        cursor.execute(f"UPDATE user_settings SET {column} = NOT {column} WHERE user_id = ?", (user_id,))
+        _after_commit(lambda: profile_cache.invalidate(user_id, 'notifications'))
+        cursor.execute(f"SELECT {column} FROM user_settings WHERE user_id = ?", (user_id,))
+        return bool(cursor.fetchone()[0])
+
+
+def toggle_daily_notification(user_id: int) -> bool:
+    """Включает или выключает ежедневный отчёт. Возвращает новое состояние."""
+    return _toggle_notification(user_id, 'daily_report')
+
+
+def toggle_weekly_notification(user_id: int) -> bool:
+    """Включает или выключает еженедельный отчёт. Возвращает новое состояние."""
+    return _toggle_notification(user_id, 'weekly_report')
+
+
+def _report_recipients_query(report: str, select: str):
+    column = {'daily': 'daily_report', 'weekly': 'weekly_report'}[report]
+    return f"""
+        SELECT {select}
+        FROM users u
+        LEFT JOIN user_settings s ON s.user_id = u.user_id
+        WHERE COALESCE(s.{column}, 1) = 1
+          AND EXISTS (
+              SELECT 1 FROM holdings h
+              WHERE h.user_id = u.user_id AND h.quantity > 0
+          )
+    """
+
+
+def get_report_recipients(report: str):
+    """
+    Возвращает получателей отчёта одним запросом.
+
+    Пользователь получает отчёт, если он включён в user_settings (или
+    настроек нет — по умолчанию включено) и в портфеле есть монеты.
+
+    :param report: 'daily' или 'weekly'
+    :return: list of user_id
+    """
+    cursor = get_connection().cursor()
+    cursor.execute(_report_recipients_query(report, "u.user_id"))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def get_report_coins(report: str):
+    """
+    Возвращает объединение монет, которые держат получатели отчёта.
+
+    :param report: 'daily' или 'weekly'
+    :return: list of (symbol, coin_id) — coin_id может быть None
+    """
+    cursor = get_connection().cursor()
+    cursor.execute(f"""
+        SELECT DISTINCT h.symbol, h.coin_id FROM holdings h
+        WHERE h.quantity > 0
+          AND h.user_id IN ({_report_recipients_query(report, "u.user_id")})
+    """)
+    return cursor.fetchall()
+
+
+def get_coin_popularity():
+    """
+    Возвращает монеты из портфелей и активных напоминаний с числом
+    пользователей, которые их держат или отслеживают.
+
+    :return: list of (symbol или ID монеты в нижнем регистре, coin_id, users) по
+             убыванию users; coin_id — None, если монета не выбрана явно
+             (старые сделки, напоминания), см. crypto_api.coin_id_of
+    """
+    cursor = get_connection().cursor()
+    cursor.execute("""
+        SELECT symbol, coin_id, COUNT(DISTINCT user_id) AS users FROM (
+            SELECT LOWER(symbol) AS symbol, coin_id, user_id FROM holdings WHERE quantity > 0
+            UNION ALL
+            SELECT LOWER(coin), NULL, user_id FROM reminders WHERE notified = 0
+        )
+        GROUP BY symbol, coin_id
+        ORDER BY users DESC, symbol
+    """)
+    return cursor.fetchall()
+
+
+def get_shared_prices(coin_ids):
+    """
+    Читает цены монет из общего кэша.
+
+    :return: list of (coin_id, prices JSON, fetched_at)
+    """
+    coin_ids = list(coin_ids)
+    cursor = get_connection().cursor()
+    rows = []
+    for i in range(0, len(coin_ids), SQL_IN_BATCH_SIZE):
+        batch = coin_ids[i:i + SQL_IN_BATCH_SIZE]
+        placeholders = ','.join('?' * len(batch))
+        cursor.execute(f"SELECT coin_id, prices, fetched_at FROM price_cache WHERE coin_id IN ({placeholders})",
+                       batch)
+        rows.extend(cursor.fetchall())
+    return rows
+
+
+def put_shared_prices(entries):
+    """
+    Записывает цены в общий кэш, не затирая более свежие записи других процессов.
+
+    :param entries: iterable of (coin_id, prices JSON, fetched_at)
+    """
+    with transaction() as cursor:
+        cursor.executemany("""
+            INSERT INTO price_cache (coin_id, prices, fetched_at) VALUES (?, ?, ?)
+            ON CONFLICT (coin_id) DO UPDATE SET
+                prices = excluded.prices,
+                fetched_at = excluded.fetched_at
+            WHERE excluded.fetched_at > price_cache.fetched_at
+        """, entries)
+
+
+def prune_shared_prices(older_than: float):
+    """Удаляет из общего кэша записи старше older_than (unix time). Возвращает их количество."""
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM price_cache WHERE fetched_at < ?", (older_than,))
+        return cursor.rowcount
+
+
+def add_price_samples(samples, resolutions):
+    """
+    Добавляет замеры цен в историю сразу во всех разрешениях.
+
+    Каждый замер обновляет среднее своего интервала в каждом разрешении,
+    поэтому часовые и дневные ряды всегда готовы и не требуют пересчёта.
+
+    :param samples: iterable of (coin_id, ts, price)
+    :param resolutions: длины интервалов в секундах, например (60, 3600, 86400)
+    """
+    rows = [(coin_id, resolution, ts // resolution * resolution, price)
+            for coin_id, ts, price in samples
+            for resolution in resolutions]
+    with transaction() as cursor:
+        cursor.executemany("""
+            INSERT INTO price_history (coin_id, resolution, ts, price)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (coin_id, resolution, ts) DO UPDATE SET
+                price = (price * samples + excluded.price) / (samples + 1),
+                samples = samples + 1
+        """, rows)
+
+
+def prune_price_history(resolution: int, older_than: int):
+    """
+    Удаляет точки разрешения resolution старше older_than.
+
+    :return: количество удалённых точек
+    """
+    with transaction() as cursor:
+        cursor.execute("""
+            DELETE FROM price_history WHERE resolution = ? AND ts < ?
+        """, (resolution, older_than))
+        return cursor.rowcount
+
+
+def get_price_history(coin_ids, resolution: int, since: int):
+    """
+    Возвращает точки истории монет заданного разрешения начиная с since.
+
+    :return: list of (coin_id, ts, price)
+    """
+    coin_ids = list(coin_ids)
+    cursor = get_connection().cursor()
+    rows = []
+    for i in range(0, len(coin_ids), SQL_IN_BATCH_SIZE):
+        batch = coin_ids[i:i + SQL_IN_BATCH_SIZE]
+        placeholders = ','.join('?' * len(batch))
+        cursor.execute(f"""
+            SELECT coin_id, ts, price
+            FROM price_history
+            WHERE coin_id IN ({placeholders}) AND resolution = ? AND ts >= ?
+        """, (*batch, resolution, since))
+        rows.extend(cursor.fetchall())
+    return rows
+
+
+def get_price_history_counts(coin_ids, resolution: int, since: int):
+    """
+    Считает точки истории монет заданного разрешения начиная с since.
+
+    :return: dict {coin_id: количество точек}; монет без истории нет
+    """
+    coin_ids = list(coin_ids)
+    cursor = get_connection().cursor()
+    counts = {}
+    for i in range(0, len(coin_ids), SQL_IN_BATCH_SIZE):
+        batch = coin_ids[i:i + SQL_IN_BATCH_SIZE]
+        placeholders = ','.join('?' * len(batch))
+        cursor.execute(f"""
+            SELECT coin_id, COUNT(*) FROM price_history
+            WHERE coin_id IN ({placeholders}) AND resolution = ? AND ts >= ?
+            GROUP BY coin_id
+        """, (*batch, resolution, since))
+        counts.update(cursor.fetchall())
+    return counts
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Обслуживание базы данных бота")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    rebuild_parser = subparsers.add_parser('rebuild-holdings',
+                                           help="пересчитать holdings из истории сделок")
+    rebuild_parser.add_argument('--user', type=int, help="только для этого пользователя")
+    rebuild_parser.add_argument('--check', action='store_true',
+                                help="только сверить, ничего не изменяя")
+    args = parser.parse_args()
+
+    init_db()
+    if args.command == 'rebuild-holdings':
+        if args.check:
+            mismatches = verify_holdings(args.user)
+            for row_user_id, symbol, actual, wanted in mismatches:
+                print(f"{row_user_id} {symbol}: в holdings {actual}, по истории {wanted}")
+            print(f"Расхождений: {len(mismatches)}")
+        else:
+            print(f"Пересчитано позиций: {rebuild_holdings(args.user)}")
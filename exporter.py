@@ -0,0 +1,59 @@
+# exporter.py
+
+import csv
+import gzip
+import io
+import tempfile
+from itertools import islice
+
+from config import EXPORT_BATCH_ROWS, EXPORT_SPOOL_MAX_BYTES, EXPORT_COMPRESS_LEVEL
+from database import iter_transactions
+
+# Те же колонки, что понимает универсальный формат импорта
+EXPORT_HEADER = ('date', 'symbol', 'type', 'amount', 'price', 'exchange', 'coin_name', 'id')
+
+
+def iter_csv_chunks(user_id: int):
+    """
+    Отдаёт историю сделок пользователя в CSV кусками (от старых к новым).
+
+    :return: генератор строк — каждая содержит EXPORT_BATCH_ROWS сделок CSV,
+             первая начинается с заголовка
+    """
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(EXPORT_HEADER)
+    rows = iter_transactions(user_id, EXPORT_BATCH_ROWS)
+    while True:
+        batch = list(islice(rows, EXPORT_BATCH_ROWS))
+        if not batch:
+            break
+        writer.writerows(
+            (date, symbol.upper(), tx_type, amount, price, exchange or '', coin_name or '', tx_id)
+            for tx_id, date, coin_name, symbol, tx_type, amount, price, exchange in batch
+        )
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    if out.tell():
+        yield out.getvalue()
+
+
+def export_transactions(user_id: int):
+    """
+    Выгружает историю сделок в сжатый CSV (gzip).
+
+    Строки идут из базы пачками прямо в gzip-поток; буфер держится в памяти
+    до EXPORT_SPOOL_MAX_BYTES, а дальше автоматически переносится во
+    временный файл — потребление памяти не растёт с длиной истории.
+
+    :return: (файловый объект, установленный на начало, количество байт);
+             закрыть его должен вызывающий
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=EXPORT_COMPRESS_LEVEL) as archive:
+        for chunk in iter_csv_chunks(user_id):
+            archive.write(chunk.encode('utf-8'))
+    size = buffer.tell()
+    buffer.seek(0)
+    return buffer, size
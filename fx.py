@@ -0,0 +1,103 @@
+# fx.py
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Валюта, в которой хранятся цены монет и сделки
+BASE_CURRENCY = 'usd'
+
+
+class FxRates:
+    """
+    Таблица курсов фиатных валют к USD.
+
+    Цены монет запрашиваются только в USD, а стоимость в валюте
+    пользователя получается умножением на курс из этой таблицы. Курсы
+    берутся из CoinGecko /exchange_rates (они даны к BTC, поэтому
+    пересчитываются в кросс-курсы к USD) и обновляются по расписанию;
+    валюты, которых нет у CoinGecko, можно задать вручную.
+    """
+
+    def __init__(self, loader, manual_rates=None):
+        """
+        :param loader: функция без аргументов, возвращающая ответ
+                       cg.get_exchange_rates()
+        :param manual_rates: dict {currency: единиц валюты за 1 USD}
+        """
+        self._loader = loader
+        self._manual = {c.lower(): rate for c, rate in (manual_rates or {}).items()}
+        self._lock = threading.Lock()
+        self._rates = None
+        self._loaded_at = 0.0
+
+    @property
+    def loaded(self):
+        """True, если курсы уже загружены."""
+        return self._rates is not None
+
+    @property
+    def age(self):
+        """Возраст таблицы курсов в секундах (None, если её ещё нет)."""
+        return time.time() - self._loaded_at if self._loaded_at else None
+
+    def load(self, exchange_rates, fetched_at=None):
+        """
+        Строит таблицу кросс-курсов из ответа /exchange_rates.
+
+        :param exchange_rates: {'rates': {code: {'value': единиц за 1 BTC, 'type': ...}}}
+        """
+        rates = exchange_rates['rates']
+        usd = rates[BASE_CURRENCY]['value']
+        table = {code: info['value'] / usd for code, info in rates.items()
+                 if info.get('type') == 'fiat' and info.get('value')}
+        table.update(self._manual)
+        table[BASE_CURRENCY] = 1.0
+        self._rates = table
+        self._loaded_at = fetched_at or time.time()
+        logger.info(f"Курсы валют обновлены: {len(table)} валют")
+
+    def refresh(self):
+        """Загружает свежие курсы; при ошибке оставляет прежние."""
+        try:
+            exchange_rates = self._loader()
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке курсов валют: {e}")
+            return False
+        self.load(exchange_rates)
+        return True
+
+    def load_fallback(self):
+        """Если курсов ещё нет — таблица только из USD и ручных курсов (API недоступен)."""
+        if self._rates is None:
+            self._rates = {**self._manual, BASE_CURRENCY: 1.0}
+
+    def ensure_loaded(self):
+        """Загружает курсы при первом обращении (обновление — refresh по расписанию)."""
+        if self._rates is None:
+            with self._lock:
+                if self._rates is None and not self.refresh():
+                    self.load_fallback()
+
+    def rate(self, currency: str):
+        """
+        Возвращает курс валюты: сколько её единиц стоит 1 USD.
+
+        :return: float или None, если курс неизвестен
+        """
+        currency = currency.lower()
+        if currency == BASE_CURRENCY:
+            return 1.0
+        self.ensure_loaded()
+        return self._rates.get(currency)
+
+    def convert(self, amount_usd: float, currency: str):
+        """Переводит сумму из USD в валюту; None, если курс неизвестен."""
+        rate = self.rate(currency)
+        return amount_usd * rate if rate is not None else None
+
+    def available(self, currencies):
+        """Оставляет из списка только валюты с известным курсом."""
+        return [c for c in currencies if self.rate(c) is not None]
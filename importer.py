@@ -0,0 +1,265 @@
+# importer.py
+
+import csv
+import hashlib
+import io
+import logging
+import re
+from datetime import datetime, timezone
+from itertools import islice
+
+from config import IMPORT_CHUNK_ROWS
+from crypto_api import coin_index
+from database import import_transactions
+
+logger = logging.getLogger(__name__)
+
+# Котировочные валюты, цены в которых считаем ценами в USD.
+# Длинные — первыми, чтобы BTCUSDT не разобрался как BTCUSD + T
+USD_QUOTES = ('FDUSD', 'USDT', 'USDC', 'BUSD', 'TUSD', 'USD')
+OTHER_QUOTES = ('BTC', 'ETH', 'BNB', 'EUR', 'TRY', 'RUB')
+
+# Колонки форматов: поле → возможные заголовки (в нижнем регистре, по приоритету).
+# Формат выбирается по первой колонке-признаку, найденной в заголовке
+FORMATS = {
+    'binance': {
+        'marker': ('date(utc)',),
+        'date': ('date(utc)',),
+        'pair': ('pair', 'market'),
+        'side': ('side', 'type'),
+        'price': ('price',),
+        # В новой выгрузке Amount — сумма в котировочной валюте, количество — Executed
+        'amount': ('executed', 'amount'),
+        'trade_id': ('trade id', 'tradeid'),
+    },
+    'bybit': {
+        'marker': ('spot pairs', 'filled quantity', 'exec qty', 'direction'),
+        'date': ('timestamp (utc)', 'trade time', 'order time', 'exec time'),
+        'pair': ('spot pairs', 'symbol', 'contracts'),
+        'side': ('direction', 'side'),
+        'price': ('filled price', 'exec price', 'avg. filled price'),
+        'amount': ('filled quantity', 'exec qty', 'filled qty'),
+        'trade_id': ('transaction id', 'exec id', 'trade id'),
+    },
+    'generic': {
+        'marker': ('symbol', 'coin', 'asset'),
+        'date': ('date', 'time', 'timestamp'),
+        'pair': ('symbol', 'coin', 'asset'),
+        'side': ('type', 'side'),
+        'price': ('price',),
+        'amount': ('amount', 'quantity', 'qty'),
+        'trade_id': ('id', 'trade id'),
+        'exchange': ('exchange',),
+    },
+}
+REQUIRED_FIELDS = ('date', 'pair', 'side', 'price', 'amount')
+
+_NUMBER = re.compile(r'-?\d*\.?\d+(?:[eE][-+]?\d+)?')
+
+
+class CSVFormatError(ValueError):
+    """Файл не удалось распознать как выгрузку сделок."""
+
+
+def _detect_format(header):
+    """
+    Определяет формат выгрузки по заголовку.
+
+    :return: (format_name, {field: индекс колонки})
+    """
+    columns = {name.strip().lower(): i for i, name in enumerate(header)}
+    for name, spec in FORMATS.items():
+        if not any(marker in columns for marker in spec['marker']):
+            continue
+        mapping = {}
+        for field, aliases in spec.items():
+            if field == 'marker':
+                continue
+            for alias in aliases:
+                if alias in columns:
+                    mapping[field] = columns[alias]
+                    break
+        if all(field in mapping for field in REQUIRED_FIELDS):
+            return name, mapping
+    raise CSVFormatError(f"Неизвестный формат файла. Колонки: {', '.join(header)}")
+
+
+def _parse_number(value: str) -> float:
+    """Число из ячейки: '0.5BTC', '1 234,5', '1,234.5 USDT' → float."""
+    cleaned = value.replace('\u00a0', '').replace(' ', '')
+    if ',' in cleaned and '.' in cleaned:
+        cleaned = cleaned.replace(',', '')  # запятая — разделитель тысяч
+    else:
+        cleaned = cleaned.replace(',', '.')
+    match = _NUMBER.search(cleaned)
+    if not match:
+        raise ValueError(f"не число: {value!r}")
+    return float(match.group())
+
+
+def _parse_date(value: str) -> str:
+    """Дата в любом из форматов выгрузок → 'YYYY-MM-DD HH:MM:SS' (UTC)."""
+    value = value.strip()
+    if len(value) == 19 and value[4] == '-' and value[10] == ' ':
+        return value  # уже в нужном формате (Binance, Bybit)
+    if value.isdigit():
+        ts = int(value)
+        if ts > 10 ** 11:  # миллисекунды
+            ts //= 1000
+        moment = datetime.fromtimestamp(ts, tz=timezone.utc)
+    else:
+        try:
+            moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            moment = None
+            for fmt in ('%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d.%m.%Y'):
+                try:
+                    moment = datetime.strptime(value, fmt)
+                    break
+                except ValueError:
+                    continue
+            if moment is None:
+                raise ValueError(f"неизвестный формат даты: {value!r}")
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(timezone.utc)
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _split_pair(pair: str):
+    """
+    Разбирает торговую пару на базовую монету и котировку.
+
+    :return: (base, quote) — quote пустой, если в ячейке только символ монеты
+    """
+    pair = pair.strip().upper()
+    for separator in ('/', '-', '_'):
+        if separator in pair:
+            base, _, quote = pair.partition(separator)
+            return base, quote
+    for quote in USD_QUOTES + OTHER_QUOTES:
+        if pair.endswith(quote) and len(pair) > len(quote):
+            return pair[:-len(quote)], quote
+    return pair, ''
+
+
+class _SymbolResolver:
+    """Сопоставляет символы биржи монетам локального справочника (один раз на символ)."""
+
+    def __init__(self):
+        self._cache = {}
+
+    def __call__(self, symbol: str):
+        if symbol not in self._cache:
+            candidates = coin_index.by_symbol(symbol)
+            self._cache[symbol] = candidates[0] if candidates else None
+        return self._cache[symbol]
+
+
+def _open_text(stream):
+    """Оборачивает бинарный поток в текстовый и подбирает разделитель CSV."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    first_line = text.readline()
+    try:
+        dialect = csv.Sniffer().sniff(first_line, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    return first_line, text, dialect
+
+
+def parse_trades(stream, stats):
+    """
+    Потоково разбирает CSV-выгрузку и отдаёт сделки пачками.
+
+    Файл читается построчно, в памяти одновременно только одна пачка из
+    IMPORT_CHUNK_ROWS строк. Ключ импорта — id сделки биржи, а если его нет —
+    хэш строки с номером повторения (одинаковые строки в одном файле —
+    разные сделки, а при повторном импорте получают те же ключи).
+
+    :param stream: бинарный файловый объект
+    :param stats: dict для статистики — заполняется по ходу разбора
+    :return: генератор списков строк для database.import_transactions
+    """
+    first_line, text, dialect = _open_text(stream)
+    header = next(csv.reader([first_line], dialect), [])
+    format_name, columns = _detect_format(header)
+    stats['format'] = format_name
+    resolve = _SymbolResolver()
+    seen = {}
+    reader = csv.reader(text, dialect)
+
+    while True:
+        rows = list(islice(reader, IMPORT_CHUNK_ROWS))
+        if not rows:
+            break
+        chunk = []
+        for row in rows:
+            if not any(cell.strip() for cell in row):
+                continue
+            stats['rows'] += 1
+            try:
+                trade = _parse_row(row, columns, format_name, resolve, seen, stats)
+            except (ValueError, IndexError) as e:
+                stats['skipped'] += 1
+                if len(stats['errors']) < 5:
+                    stats['errors'].append(f"строка {stats['rows'] + 1}: {e}")
+                continue
+            if trade is not None:
+                chunk.append(trade)
+        if chunk:
+            yield chunk
+
+
+def _parse_row(row, columns, format_name, resolve, seen, stats):
+    side = row[columns['side']].strip().lower()
+    if side not in ('buy', 'sell'):
+        raise ValueError(f"неизвестный тип сделки {side!r}")
+
+    base, quote = _split_pair(row[columns['pair']])
+    if quote and quote not in USD_QUOTES:
+        stats['skipped'] += 1
+        stats['non_usd'].add(f"{base}/{quote}")
+        return None
+    coin = resolve(base)
+    if coin is None:
+        stats['skipped'] += 1
+        stats['unknown'].add(base)
+        return None
+
+    amount = abs(_parse_number(row[columns['amount']]))
+    price = _parse_number(row[columns['price']])
+    date = _parse_date(row[columns['date']])
+    exchange = row[columns['exchange']].strip() if 'exchange' in columns else None
+    exchange = exchange or format_name.capitalize()
+
+    trade_id = row[columns['trade_id']].strip() if 'trade_id' in columns else ''
+    if trade_id:
+        key = f"{format_name}:{trade_id}"
+    else:
+        digest = hashlib.sha1('\x1f'.join(cell.strip() for cell in row).encode('utf-8')).hexdigest()
+        seen[digest] = seen.get(digest, 0) + 1
+        key = f"{format_name}:{digest}:{seen[digest]}"
+
+    return coin['name'], coin['symbol'], amount, price, side, date, exchange, key, coin['id']
+
+
+def import_csv(user_id: int, stream):
+    """
+    Импортирует сделки пользователя из CSV-выгрузки биржи (Binance, Bybit
+    или универсальный формат: date, symbol, type, amount, price[, exchange]).
+
+    Символы сопоставляются с локальным справочником монет, уже
+    импортированные сделки пропускаются, всё добавляется одной транзакцией.
+
+    :param stream: бинарный файловый объект
+    :return: dict со статистикой: format, rows, imported, duplicates, skipped,
+             unknown (неизвестные символы), non_usd (пары не к USD), errors
+    """
+    coin_index.ensure_loaded()
+    stats = {'format': None, 'rows': 0, 'imported': 0, 'duplicates': 0, 'skipped': 0,
+             'unknown': set(), 'non_usd': set(), 'errors': []}
+    stats['imported'] = import_transactions(user_id, parse_trades(stream, stats))
+    stats['duplicates'] = stats['rows'] - stats['skipped'] - stats['imported']
+    logger.info(f"Импорт для {user_id}: {stats['format']}, {stats['rows']} строк, "
+                f"добавлено {stats['imported']}, дублей {stats['duplicates']}, "
+                f"пропущено {stats['skipped']}")
+    return stats
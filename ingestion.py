@@ -0,0 +1,191 @@
+# ingestion.py
+
+import logging
+import time
+
+import aiohttp
+import numpy as np
+
+from async_crypto_api import client, ensure_coin_index
+from config import (
+    INGEST_COLD_INTERVAL,
+    INGEST_HOT_COINS,
+    INGEST_INTERVAL,
+    INGEST_MAX_BACKOFF,
+    INGEST_MAX_COINS,
+    PRICE_SAMPLE_INTERVAL,
+)
+from crypto_api import PRICE_BATCH_SIZE, coin_id_of, price_cache, price_flight, set_ingested_coins, _flight_keys
+from database import get_coin_popularity
+from fx import BASE_CURRENCY
+from price_history import record_prices
+
+logger = logging.getLogger(__name__)
+
+CURRENCIES = [BASE_CURRENCY]
+
+
+class PriceIngestor:
+    """
+    Фоновое обновление цен монет, которые держат или отслеживают пользователи.
+
+    Каждый проход берёт монеты из портфелей и активных напоминаний,
+    упорядоченные по числу пользователей. Первые INGEST_HOT_COINS
+    обновляются каждый проход, остальные — когда их цене исполнилось
+    INGEST_COLD_INTERVAL. Цены пишутся в кэш (и его общий уровень в базе),
+    раз в PRICE_SAMPLE_INTERVAL — в историю цен. Пользовательские запросы
+    после этого находят цены в кэше и не ждут CoinGecko.
+
+    На 429 проход прерывается, и следующие пропускаются с экспоненциально
+    растущей паузой (до INGEST_MAX_BACKOFF).
+    """
+
+    def __init__(self):
+        self.tracked = []  # ID монет по убыванию популярности
+        self.backoff = 0.0
+        self.backoff_until = 0.0
+        self.last_run = 0.0
+        self.last_duration = 0.0
+        self._last_sample = 0.0
+        self.stats = {'runs': 0, 'fetched': 0, 'requests': 0, 'errors': 0, 'rate_limited': 0, 'skipped_runs': 0}
+
+    def _track(self):
+        """Обновляет список отслеживаемых монет по популярности."""
+        users = {}
+        for symbol, coin_id, count in get_coin_popularity():
+            coin_id = coin_id_of(symbol, coin_id)
+            users[coin_id] = users.get(coin_id, 0) + count
+        self.tracked = sorted(users, key=users.get, reverse=True)
+        # Устаревшие цены только этих монет запросы пользователей не обновляют
+        set_ingested_coins(self.tracked[:INGEST_MAX_COINS])
+
+    def _due(self, now):
+        """
+        Монеты для этого прохода: все популярные плюс устаревшие остальные.
+        Цены, только что пришедшие из потока биржи (price_stream.py), не запрашиваются.
+        """
+        entries = price_cache.peek(self.tracked)
+        due = []
+        for rank, coin_id in enumerate(self.tracked):
+            interval = INGEST_INTERVAL / 2 if rank < INGEST_HOT_COINS else INGEST_COLD_INTERVAL
+            if coin_id not in entries or now - entries[coin_id][1] >= interval:
+                due.append(coin_id)
+        return due[:INGEST_MAX_COINS]
+
+    def _rate_limited(self):
+        self.stats['rate_limited'] += 1
+        self.backoff = min(max(self.backoff * 2, INGEST_INTERVAL), INGEST_MAX_BACKOFF)
+        self.backoff_until = time.time() + self.backoff
+        logger.warning(f"CoinGecko ограничил частоту запросов, фоновое обновление цен "
+                       f"приостановлено на {self.backoff:.0f} с")
+
+    async def _fetch(self, coin_ids):
+        """
+        Запрашивает цены пачками последовательно, не превышая лимит API.
+
+        Пачка объединяется с идущими запросами пользователей через price_flight:
+        монеты, которые уже запрашивает кто-то другой, пропускаются.
+
+        :return: количество полученных цен
+        """
+        fetched = 0
+        for i in range(0, len(coin_ids), PRICE_BATCH_SIZE):
+            owned, _ = price_flight.claim(_flight_keys(coin_ids[i:i + PRICE_BATCH_SIZE], CURRENCIES))
+            if not owned:
+                continue
+            result = {}
+            try:
+                self.stats['requests'] += 1
+                data = await client.get_price([coin_id for coin_id, _ in owned], CURRENCIES)
+                result = await price_cache.store_async(data, CURRENCIES)
+                fetched += len(result)
+            except aiohttp.ClientResponseError as e:
+                if e.status != 429:
+                    raise
+                self._rate_limited()
+                break
+            finally:
+                price_flight.resolve(owned, {key: result.get(key[0]) for key in owned})
+        else:
+            self.backoff = 0.0
+        return fetched
+
+    def _sample_history(self, now):
+        """Раз в PRICE_SAMPLE_INTERVAL записывает свежие цены в историю."""
+        if now - self._last_sample < PRICE_SAMPLE_INTERVAL:
+            return 0
+        entries = price_cache.peek(self.tracked)
+        prices = {coin_id: prices[BASE_CURRENCY] for coin_id, (prices, fetched_at) in entries.items()
+                  if BASE_CURRENCY in prices and now - fetched_at < INGEST_COLD_INTERVAL}
+        self._last_sample = now
+        return record_prices(prices, now) if prices else 0
+
+    async def run(self):
+        """
+        Один проход обновления (задача планировщика).
+
+        :return: количество обновлённых цен
+        """
+        now = time.time()
+        if now < self.backoff_until:
+            self.stats['skipped_runs'] += 1
+            return 0
+
+        await ensure_coin_index()
+        self._track()
+        try:
+            fetched = await self._fetch(self._due(now))
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.error(f"Ошибка фонового обновления цен: {e}")
+            fetched = 0
+
+        self.stats['runs'] += 1
+        self.stats['fetched'] += fetched
+        self._sample_history(time.time())
+        self.last_run = now
+        self.last_duration = time.time() - now
+        logger.debug(f"Обновлено цен: {fetched} из {len(self.tracked)} отслеживаемых "
+                     f"за {self.last_duration:.2f} с")
+        return fetched
+
+    def freshness(self, now=None):
+        """
+        Возраст цен отслеживаемых монет в кэше.
+
+        :return: dict: tracked, cached, missing, p50_age, p95_age, max_age (секунд),
+                 stale — сколько цен старше INGEST_COLD_INTERVAL
+        """
+        now = now or time.time()
+        entries = price_cache.peek(self.tracked)
+        ages = np.array([now - fetched_at for _, fetched_at in entries.values()])
+        result = {'tracked': len(self.tracked), 'cached': len(entries),
+                  'missing': len(self.tracked) - len(entries)}
+        if ages.size:
+            result.update({
+                'p50_age': round(float(np.percentile(ages, 50)), 1),
+                'p95_age': round(float(np.percentile(ages, 95)), 1),
+                'max_age': round(float(ages.max()), 1),
+                'stale': int((ages >= INGEST_COLD_INTERVAL).sum()),
+            })
+        else:
+            result.update({'p50_age': 0.0, 'p95_age': 0.0, 'max_age': 0.0, 'stale': 0})
+        return result
+
+    def info(self):
+        """Счётчики, пауза после 429 и свежесть цен."""
+        return {
+            **self.stats,
+            'last_run': self.last_run,
+            'last_duration': round(self.last_duration, 3),
+            'backoff': round(max(self.backoff_until - time.time(), 0.0), 1),
+            **self.freshness(),
+        }
+
+
+ingestor = PriceIngestor()
+
+
+async def ingest_prices():
+    """Фоновое обновление цен отслеживаемых монет (задача планировщика)."""
+    return await ingestor.run()
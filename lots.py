@@ -0,0 +1,128 @@
+# lots.py
+
+from array import array
+
+# Способы расчёта себестоимости при продаже
+COST_METHODS = ('avg', 'fifo', 'lifo')
+DEFAULT_COST_METHOD = 'avg'
+
+# Остатки меньше этого значения считаем нулём (погрешность float)
+QUANTITY_EPSILON = 1e-12
+
+
+class LotBook:
+    """
+    Открытые лоты одной позиции и сопоставление продаж с ними.
+
+    Лоты хранятся плоским массивом double [qty0, price0, qty1, price1, ...]:
+    покупка дописывает пару в конец, FIFO списывает с начала (сдвигая
+    указатель head), LIFO — с конца. Для способа 'avg' лоты не хранятся —
+    достаточно количества и общей себестоимости.
+
+    Состояние сериализуется в bytes (dump) и восстанавливается без
+    повторного прохода по истории сделок.
+    """
+
+    __slots__ = ('method', 'quantity', 'cost_basis', 'realized_pnl', '_lots', '_head')
+
+    def __init__(self, method: str = DEFAULT_COST_METHOD, quantity: float = 0.0,
+                 cost_basis: float = 0.0, realized_pnl: float = 0.0, lots: bytes = None):
+        if method not in COST_METHODS:
+            raise ValueError(f"Неизвестный способ расчёта себестоимости: {method}")
+        self.method = method
+        self.quantity = quantity
+        self.cost_basis = cost_basis
+        self.realized_pnl = realized_pnl
+        self._lots = array('d')
+        self._head = 0
+        if method != 'avg':
+            if lots:
+                self._lots.frombytes(lots)
+            elif quantity > 0:
+                # Позиция без сохранённых лотов (например, после смены способа) — один лот
+                self._lots.extend((quantity, cost_basis / quantity))
+
+    @property
+    def position(self):
+        """(quantity, cost_basis, realized_pnl)"""
+        return self.quantity, self.cost_basis, self.realized_pnl
+
+    def lots(self):
+        """Возвращает открытые лоты: list of (quantity, price) в порядке покупки."""
+        lots = self._lots
+        return [(lots[i], lots[i + 1]) for i in range(self._head * 2, len(lots), 2)]
+
+    def dump(self):
+        """Сериализует открытые лоты в bytes (None для способа 'avg')."""
+        if self.method == 'avg':
+            return None
+        return self._lots[self._head * 2:].tobytes()
+
+    def apply(self, amount: float, price: float, transaction_type: str):
+        """
+        Применяет сделку к позиции.
+
+        :return: прибыль, зафиксированная этой сделкой
+        """
+        if transaction_type == 'buy':
+            self.buy(amount, price)
+            return 0.0
+        return self.sell(amount, price)
+
+    def buy(self, amount: float, price: float):
+        self.quantity += amount
+        self.cost_basis += amount * price
+        if self.method != 'avg':
+            self._lots.extend((amount, price))
+
+    def sell(self, amount: float, price: float):
+        """
+        Списывает проданное количество с лотов.
+
+        Продать больше, чем есть, нельзя — лишнее количество игнорируется.
+
+        :return: зафиксированная прибыль
+        """
+        sold = min(amount, self.quantity)
+        if sold <= 0:
+            return 0.0
+
+        if self.method == 'avg':
+            cost = self.cost_basis / self.quantity * sold
+        else:
+            cost = self._consume(sold)
+
+        realized = price * sold - cost
+        self.quantity -= sold
+        self.cost_basis -= cost
+        self.realized_pnl += realized
+        if self.quantity < QUANTITY_EPSILON:
+            self.quantity, self.cost_basis = 0.0, 0.0
+            del self._lots[:]
+            self._head = 0
+        return realized
+
+    def _consume(self, sold):
+        """Списывает sold с лотов в порядке FIFO или LIFO и возвращает их себестоимость."""
+        lots = self._lots
+        cost = 0.0
+        remaining = sold
+        fifo = self.method == 'fifo'
+        while remaining > QUANTITY_EPSILON and len(lots) > self._head * 2:
+            i = self._head * 2 if fifo else len(lots) - 2
+            lot_quantity, lot_price = lots[i], lots[i + 1]
+            taken = min(lot_quantity, remaining)
+            cost += taken * lot_price
+            remaining -= taken
+            if lot_quantity - taken > QUANTITY_EPSILON:
+                lots[i] = lot_quantity - taken
+            elif fifo:
+                self._head += 1
+            else:
+                del lots[-2:]
+
+        # Списанные с начала лоты удаляем пачкой, когда их накопилось много
+        if self._head > 1024 and self._head * 4 > len(lots):
+            del lots[:self._head * 2]
+            self._head = 0
+        return cost
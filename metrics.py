@@ -0,0 +1,333 @@
+# metrics.py
+
+import bisect
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter as _StackCounter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from config import METRICS_HOST, METRICS_PORT, PROFILER_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм: время (секунды) и размер (байты, 4 КБ … 2 МБ)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = tuple(2 ** power for power in range(12, 22))
+BROADCAST_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 3600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Монотонный счётчик с метками (Prometheus counter)."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in values]
+
+
+class Histogram:
+    """
+    Гистограмма с метками (Prometheus histogram).
+
+    observe стоит одного bisect и инкремента под блокировкой, поэтому
+    годится для горячих путей (SQL-запросы, обработчики кнопок).
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # {метки: [счётчики корзин (+Inf последней), сумма]}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет время блока with (в том числе завершившегося исключением)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        entry = self._values.get(tuple(labels[name] for name in self.labelnames))
+        return sum(entry[0]) if entry else 0
+
+    def render(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(float(bound))}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    Набор метрик процесса и их вывод в текстовом формате Prometheus.
+
+    Кроме счётчиков и гистограмм выводит как gauge числовые поля info()
+    компонентов (кэши, фоновое обновление цен, поток цен): они уже ведут
+    свою статистику, и дублировать её счётчиками незачем.
+    """
+
+    def __init__(self, prefix='bot'):
+        self.prefix = prefix
+        self._metrics = []
+        self._infos = {}
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(f"{self.prefix}_{name}", documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(f"{self.prefix}_{name}", documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_info(self, name, callback):
+        """
+        Добавляет компонент, чьи числовые поля выводятся как gauge {prefix}_{name}_{поле}.
+
+        :param name: имя компонента, например 'price_cache'
+        :param callback: функция без аргументов, возвращающая dict (например, price_cache.info)
+        """
+        self._infos[name] = callback
+
+    def _render_infos(self):
+        lines = []
+        for component, callback in self._infos.items():
+            try:
+                info = callback()
+            except Exception as e:
+                logger.error(f"Ошибка при сборе метрик {component}: {e}")
+                continue
+            for field, value in info.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue
+                name = re.sub(r'[^a-zA-Z0-9_]', '_', f"{self.prefix}_{component}_{field}")
+                lines += [f"# TYPE {name} gauge", f"{name} {_format_value(value)}"]
+        return lines
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus (version 0.0.4)."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines += metric.render()
+        lines += self._render_infos()
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# === Метрики горячих путей ===
+
+API_LATENCY = registry.histogram('api_request_seconds', "Время запроса к CoinGecko", ('endpoint',))
+API_ERRORS = registry.counter('api_errors_total', "Неудачные запросы к CoinGecko", ('endpoint', 'status'))
+API_RATE_LIMITED = registry.counter('api_rate_limited_total', "Ответы 429 от CoinGecko", ('endpoint',))
+DB_QUERY = registry.histogram('db_query_seconds', "Время выполнения SQL-запроса", ('query',))
+DB_FETCH = registry.histogram('db_fetch_seconds', "Время выборки строк результата (fetchall/fetchone)", ('query',))
+CHART_RENDER = registry.histogram('chart_render_seconds', "Время отрисовки графика в пуле процессов", ('chart',))
+CHART_BYTES = registry.histogram('chart_png_bytes', "Размер PNG графика", ('chart',), SIZE_BUCKETS)
+HANDLER_LATENCY = registry.histogram('button_handler_seconds', "Время обработки нажатия кнопки", ('action',))
+REPORTS = registry.counter('reports_total', "Отчёты рассылки по исходу", ('report', 'outcome'))
+REPORT_DURATION = registry.histogram('report_broadcast_seconds', "Длительность рассылки отчёта",
+                                     ('report',), BROADCAST_BUCKETS)
+
+
+# === Профилировщик ===
+
+class SamplingProfiler:
+    """
+    Статистический профилировщик: фоновый поток раз в interval снимает
+    стеки всех потоков (sys._current_frames) и считает одинаковые.
+
+    Почти ничего не стоит, пока выключен, поэтому включается на работающем
+    боте (через /profile/start), когда что-то тормозит. Отчёт — в формате
+    collapsed stacks (flamegraph.pl, speedscope): стек через «;» и число
+    снимков. Для event loop видно, чем он занят, в том числе блокирующие
+    вызовы.
+    """
+
+    def __init__(self, interval=PROFILER_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.started_at = None
+        self._stacks = _StackCounter()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=None):
+        """Начинает новый сбор (накопленные стеки сбрасываются)."""
+        if self.running:
+            return False
+        self.interval = interval or self.interval
+        self._stacks = _StackCounter()
+        self.samples = 0
+        self.started_at = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        logger.info(f"Профилировщик запущен, интервал {self.interval * 1000:.0f} мс")
+        return True
+
+    def stop(self):
+        """Останавливает сбор; накопленные стеки остаются для report."""
+        if not self.running:
+            return False
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        logger.info(f"Профилировщик остановлен: {self.samples} снимков")
+        return True
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self._stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def report(self, limit=None):
+        """
+        :param limit: сколько самых частых стеков вывести (None — все)
+        :return: текст collapsed stacks
+        """
+        return ''.join(f"{stack} {count}\n" for stack, count in self._stacks.most_common(limit))
+
+
+profiler = SamplingProfiler()
+
+
+# === HTTP-сервер ===
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """
+    GET /metrics — метрики; /profile/start[?interval=сек], /profile/stop,
+    /profile[?limit=N] — управление профилировщиком и отчёт.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/metrics':
+            self._reply(registry.render(), 'text/plain; version=0.0.4; charset=utf-8')
+        elif url.path == '/profile/start':
+            interval = float(query['interval'][0]) if 'interval' in query else None
+            started = profiler.start(interval)
+            self._reply("started\n" if started else "already running\n")
+        elif url.path == '/profile/stop':
+            profiler.stop()
+            self._reply(profiler.report())
+        elif url.path == '/profile':
+            limit = int(query['limit'][0]) if 'limit' in query else None
+            self._reply(profiler.report(limit))
+        else:
+            self.send_error(404)
+
+    def _reply(self, text, content_type='text/plain; charset=utf-8'):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Запускает HTTP-сервер метрик в фоновом потоке.
+
+    :return: ThreadingHTTPServer (server.shutdown() — остановить) или None, если порт занят
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Не удалось запустить сервер метрик на {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f"Метрики: http://{host}:{port}/metrics")
+    return server
@@ -1,99 +1,265 @@
 # notifications.py
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from datetime import time
-from telegram import Bot
+from telegram.error import Forbidden, BadRequest, NetworkError, RetryAfter, TelegramError
+import asyncio
 import logging
-from analytics import calculate_portfolio
-from charts import generate_portfolio_chart
-from database import get_all_users, get_user_notifications, toggle_daily_notification, toggle_weekly_notification
+import time as time_module
+from analytics import calculate_portfolio_async, calculate_portfolios
+from async_crypto_api import ensure_coin_index, ensure_fx_rates, take_market_snapshot_async
+from charts import get_portfolio_chart, remember_chart_upload
+from config import BROADCAST_CONCURRENCY, BROADCAST_RATE, BROADCAST_MAX_RETRIES
+from crypto_api import coin_id_of
+from database import get_report_coins, get_report_recipients
+from metrics import REPORT_DURATION, REPORTS
+from utils import format_money
 
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot("YOUR_BOT_TOKEN")  # Заменяется на config.BOT_TOKEN
 scheduler = AsyncIOScheduler()
 
-# === Функции управления уведомлениями ===
-
-def init_scheduler():
-    """Инициализирует расписание задач."""
-    scheduler.start()
-
-    # Ежедневный отчёт в 9:00
-    scheduler.add_job(
-        send_daily_report_to_all,
-        'cron',
-        hour=9,
-        minute=0,
-        id='daily_report',
-        replace_existing=True
-    )
-
-    # Еженедельный отчёт по понедельникам в 9:00
-    scheduler.add_job(
-        send_weekly_report_to_all,
-        'cron',
-        day_of_week='mon',
-        hour=9,
-        minute=0,
-        id='weekly_report',
-        replace_existing=True
-    )
-
-
-async def send_daily_report(user_id):
-    """Отправляет пользователю ежедневный отчёт о состоянии портфеля."""
-    try:
-        data = calculate_portfolio(user_id)
-        if not data['assets']:
-            return  # Нет активов — не отправляем
+# === Отчёты (задачи планировщика ставит app.schedule_jobs) ===
+
+def _format_daily_report(data):
+    currency = data['currency']
+    total = data['total']
+    text = "📅 Ежедневный отчёт:\n\n"
+    text += f"Общая стоимость: {format_money(total['current'], currency)}\n"
+    text += f"Прибыль: {format_money(total['profit'], currency, signed=True)} ({total['roi']:+.2f}%)\n"
+    text += f"Зафиксировано: {format_money(total['realized'], currency, signed=True)}\n"
+    return text
+
+
+def _format_weekly_report(data):
+    currency = data['currency']
+    total = data['total']
+    text = "📆 Еженедельный отчёт:\n\n"
+    text += f"Всего вложено: {format_money(total['invested'], currency)}\n"
+    text += f"Текущая стоимость: {format_money(total['current'], currency)}\n"
+    text += f"Прибыль: {format_money(total['profit'], currency, signed=True)} ({total['roi']:+.2f}%)\n"
+    text += f"Зафиксировано: {format_money(total['realized'], currency, signed=True)}\n\n"
+    text += "Самый прибыльный актив:\n"
+    top_asset = max(data['assets'], key=lambda x: x['profit']) if data['assets'] else None
+    if top_asset:
+        text += f"{top_asset['symbol']} ({format_money(top_asset['profit'], currency, signed=True)})\n\n"
+    metrics = data['metrics']
+    text += f"Волатильность: {metrics['volatility']:.1f}%, макс. просадка: {metrics['max_drawdown']:.1f}%"
+    return text
+
+
+REPORT_FORMATTERS = {
+    'daily': _format_daily_report,
+    'weekly': _format_weekly_report,
+}
+
+
+async def _build_report(user_id, report, snapshot=None, data=None):
+    """
+    Готовит отчёт пользователя.
+
+    :param snapshot: MarketSnapshot с ценами для всей рассылки
+    :param data: готовый результат calculate_portfolio (из пакетного расчёта)
+    :return: (chart_key, chart_img, text) или None, если активов нет;
+             chart_img — file_id или BytesIO
+    """
+    if data is None:
+        data = await calculate_portfolio_async(user_id, snapshot)
+    if not data['assets']:
+        return None  # Нет активов — не отправляем
+    chart_key, chart_img = await get_portfolio_chart(data)
+    return chart_key, chart_img, REPORT_FORMATTERS[report](data)
 
-        text = "📅 Ежедневный отчёт:\n\n"
-        text += f"Общая стоимость: ${data['total']['current']:.2f}\n"
-        profit_str = "+" if data['total']['profit'] >= 0 else "-"
-        text += f"Прибыль: {profit_str}${abs(data['total']['profit']):.2f} ({data['total']['roi']:+.2f}%)\n"
 
-        chart_img = generate_portfolio_chart(data)
-        await bot.send_photo(chat_id=user_id, photo=chart_img, caption=text)
+async def send_daily_report(telegram_bot, user_id):
+    """Отправляет пользователю ежедневный отчёт о состоянии портфеля."""
+    try:
+        report = await _build_report(user_id, 'daily')
+        if report:
+            chart_key, chart_img, text = report
+            message = await telegram_bot.send_photo(chat_id=user_id, photo=chart_img, caption=text)
+            remember_chart_upload(chart_key, message)
     except Exception as e:
         logging.error(f"Ошибка при отправке ежедневного отчёта для {user_id}: {e}")
 
 
-async def send_weekly_report(user_id):
+async def send_weekly_report(telegram_bot, user_id):
     """Отправляет пользователю еженедельный отчёт о состоянии портфеля."""
     try:
-        data = calculate_portfolio(user_id)
-        if not data['assets']:
-            return  # Нет активов — не отправляем
-
-        text = "📆 Еженедельный отчёт:\n\n"
-        text += f"Всего вложено: ${data['total']['invested']:.2f}\n"
-        text += f"Текущая стоимость: ${data['total']['current']:.2f}\n"
-        profit_str = "+" if data['total']['profit'] >= 0 else "-"
-        text += f"Прибыль: {profit_str}${abs(data['total']['profit']):.2f} ({data['total']['roi']:+.2f}%)\n\n"
-        text += "Самый прибыльный актив:\n"
-        top_asset = max(data['assets'], key=lambda x: x['profit']) if data['assets'] else None
-        if top_asset:
-            text += f"{top_asset['symbol']} (+${top_asset['profit']:.2f})"
-
-        chart_img = generate_portfolio_chart(data)
-        await bot.send_photo(chat_id=user_id, photo=chart_img, caption=text)
+        report = await _build_report(user_id, 'weekly')
+        if report:
+            chart_key, chart_img, text = report
+            message = await telegram_bot.send_photo(chat_id=user_id, photo=chart_img, caption=text)
+            remember_chart_upload(chart_key, message)
     except Exception as e:
         logging.error(f"Ошибка при отправке еженедельного отчёта для {user_id}: {e}")
 
 
-async def send_daily_report_to_all():
+async def send_daily_report_to_all(telegram_bot):
     """Отправляет ежедневный отчёт всем, кто его включил."""
-    for user_id in get_all_users():
-        if get_user_notifications(user_id)[0]:  # daily_report enabled
-            await send_daily_report(user_id)
+    return await broadcast_report('daily', telegram_bot)
 
 
-async def send_weekly_report_to_all():
+async def send_weekly_report_to_all(telegram_bot):
     """Отправляет еженедельный отчёт всем, кто его включил."""
-    for user_id in get_all_users():
-        if get_user_notifications(user_id)[1]:  # weekly_report enabled
-            await send_weekly_report(user_id)
+    return await broadcast_report('weekly', telegram_bot)
+
+
+# === Массовая рассылка ===
+
+class RateLimiter:
+    """
+    Равномерно распределяет отправки во времени: не чаще rate в секунду.
+
+    pause() сдвигает все следующие отправки — так обрабатывается
+    RetryAfter, ведь лимит Telegram действует на весь бот, а не на чат.
+    """
+
+    def __init__(self, rate):
+        self._interval = 1.0 / rate
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        resume_at = asyncio.get_running_loop().time() + seconds
+        self._next_slot = max(self._next_slot, resume_at)
+
+
+def _retry_after_seconds(error):
+    retry_after = error.retry_after
+    # В новых версиях python-telegram-bot это timedelta
+    if hasattr(retry_after, 'total_seconds'):
+        retry_after = retry_after.total_seconds()
+    return float(retry_after)
+
+
+async def _send_with_retry(telegram_bot, limiter, stats, user_id, chart_key, chart_img, text):
+    """
+    Отправляет фото с учётом лимита; повторяет только при RetryAfter.
+
+    RetryAfter значит, что Telegram сообщение не принял, и повтор безопасен.
+    После сетевой ошибки (в том числе TimedOut) запрос мог дойти — повтор
+    привёл бы к дублю отчёта, поэтому такая доставка считается неизвестной.
+
+    :return: 'sent', 'failed' или 'unknown'
+    """
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        if attempt:
+            stats['retries'] += 1
+        await limiter.wait()
+        try:
+            if hasattr(chart_img, 'seek'):
+                chart_img.seek(0)
+            message = await telegram_bot.send_photo(chat_id=user_id, photo=chart_img, caption=text)
+            remember_chart_upload(chart_key, message)
+            return 'sent'
+        except RetryAfter as e:
+            seconds = _retry_after_seconds(e)
+            logging.warning(f"Flood control Telegram: пауза {seconds:.0f} с")
+            limiter.pause(seconds)
+        except (Forbidden, BadRequest) as e:
+            # Пользователь заблокировал бота или чат недоступен — повтор не поможет
+            logging.info(f"Отчёт для {user_id} не доставлен: {e}")
+            return 'failed'
+        except NetworkError as e:
+            logging.warning(f"Неизвестно, доставлен ли отчёт для {user_id}: {e}")
+            return 'unknown'
+        except TelegramError as e:
+            logging.error(f"Ошибка при отправке отчёта для {user_id}: {e}")
+            return 'failed'
+    logging.error(f"Отчёт для {user_id} не доставлен: лимит Telegram не снят за {BROADCAST_MAX_RETRIES} повтора")
+    return 'failed'
+
+
+async def take_report_snapshot(report):
+    """
+    Фиксирует цены всех монет, которые держат получатели отчёта.
+
+    Цены запрашиваются одним пакетом, и дальше вся рассылка считает
+    портфели по этому снимку — одинаково для всех и без новых запросов.
+
+    :param report: 'daily' или 'weekly'
+    :return: MarketSnapshot
+    """
+    await ensure_coin_index()
+    await ensure_fx_rates()
+    coin_ids = {coin_id_of(symbol, coin_id) for symbol, coin_id in get_report_coins(report)}
+    return await take_market_snapshot_async(coin_ids)
+
+
+async def broadcast_report(report, telegram_bot):
+    """
+    Рассылает отчёт всем получателям с ограничением параллелизма и скорости.
+
+    Получатели выбираются одним запросом, цены всех задействованных монет
+    фиксируются в одном снимке (take_report_snapshot), портфели всех получателей
+    считаются одним пакетом (calculate_portfolios), дальше отчёты строятся и
+    отправляются параллельно (не более BROADCAST_CONCURRENCY одновременно
+    и не чаще BROADCAST_RATE сообщений в секунду).
+
+    :param report: 'daily' или 'weekly'
+    :param telegram_bot: объект с методом send_photo (telegram.Bot)
+    :return: dict со статистикой рассылки
+    """
+    started = time_module.monotonic()
+    recipients = get_report_recipients(report)
+    stats = {'total': len(recipients), 'sent': 0, 'skipped': 0, 'failed': 0, 'unknown': 0, 'retries': 0}
+    if not recipients:
+        return stats
+
+    snapshot = await take_report_snapshot(report)
+    logging.info(f"Рассылка '{report}': {len(recipients)} получателей, {len(snapshot)} монет")
+    portfolios = await asyncio.to_thread(calculate_portfolios, recipients, snapshot)
+
+    limiter = RateLimiter(BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    progress_step = max(len(recipients) // 10, 1)
+
+    def count(outcome):
+        # Счётчик метрик растёт по ходу рассылки: скорость видна, пока она идёт
+        stats[outcome] += 1
+        REPORTS.inc(report=report, outcome=outcome)
+
+    async def deliver(user_id):
+        async with semaphore:
+            try:
+                built = await _build_report(user_id, report, snapshot, portfolios[user_id])
+            except Exception as e:
+                logging.error(f"Ошибка при подготовке отчёта для {user_id}: {e}")
+                count('failed')
+                return
+            if built is None:
+                count('skipped')
+                return
+            count(await _send_with_retry(telegram_bot, limiter, stats, user_id, *built))
+
+        done = stats['sent'] + stats['skipped'] + stats['failed'] + stats['unknown']
+        if done % progress_step == 0:
+            elapsed = time_module.monotonic() - started
+            logging.info(f"Рассылка '{report}': {done}/{stats['total']}, "
+                         f"{stats['sent'] / max(elapsed, 1e-6):.1f} сообщ./с")
+
+    # Ошибка одной доставки не должна прерывать рассылку и терять её статистику
+    results = await asyncio.gather(*(deliver(user_id) for user_id in recipients), return_exceptions=True)
+    for user_id, result in zip(recipients, results):
+        if isinstance(result, Exception):
+            logging.error(f"Ошибка при отправке отчёта для {user_id}: {result}")
+            count('failed')
+
+    stats['elapsed'] = round(time_module.monotonic() - started, 2)
+    stats['rate'] = round(stats['sent'] / stats['elapsed'], 2) if stats['elapsed'] else 0.0
+    REPORTS.inc(stats['retries'], report=report, outcome='retries')
+    REPORT_DURATION.observe(stats['elapsed'], report=report)
+    logging.info(f"Рассылка '{report}' завершена: {stats}")
+    return stats
 
 
 # === Вспомогательные функции ===
@@ -0,0 +1,336 @@
+# persistence.py
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from config import (CONVERSATION_TIMEOUT, PERSISTENCE_DB, PERSISTENCE_RETRY_MAX_DELAY, PERSISTENCE_STATE_TTL,
+                    PERSISTENCE_UPDATE_INTERVAL)
+from database import PRAGMAS
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS conversations (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        state TEXT NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (name, key)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_user_data_updated ON user_data (updated_at)",
+)
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Состояние диалогов и context.user_data в SQLite-файле, общем для
+    процессов бота (режим webhook, см. webhook.py).
+
+    Отдельный файл, а не основная база: эти записи не должны конкурировать
+    за блокировку с записью сделок и цен. Хранятся только user_data и
+    диалоги — chat_data, bot_data и callback_data бот не использует.
+
+    Запись пакетная: PTB раз в PERSISTENCE_UPDATE_INTERVAL передаёт
+    изменения по одному пользователю и диалогу, они копятся в буфере и
+    пишутся одной транзакцией в потоке, не блокируя event loop. user_data,
+    не изменившиеся с прошлой записи, не пишутся. Пачка, которую не удалось
+    записать, возвращается в буфер, и запись повторяется с растущей паузой
+    (до PERSISTENCE_RETRY_MAX_DELAY).
+
+    Черновики сделок неактивных пользователей и брошенные диалоги старше
+    PERSISTENCE_STATE_TTL и CONVERSATION_TIMEOUT не загружаются при запуске
+    и удаляются; из памяти работающего бота их убирает
+    evict_idle_user_data. Процесс загружает лишь свою долю пользователей
+    (shard): обновления одного пользователя всегда попадают в один процесс.
+    """
+
+    def __init__(self, path=PERSISTENCE_DB, update_interval=PERSISTENCE_UPDATE_INTERVAL, shard=None,
+                 state_ttl=PERSISTENCE_STATE_TTL, conversation_ttl=CONVERSATION_TIMEOUT):
+        """
+        :param path: путь к файлу базы
+        :param update_interval: как часто PTB сохраняет изменения, секунд
+        :param shard: (номер процесса, число процессов) или None — все пользователи
+        :param state_ttl: сколько хранить user_data неактивного пользователя, секунд
+        :param conversation_ttl: сколько хранить незавершённый диалог, секунд
+        """
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.shard = shard
+        self.state_ttl = state_ttl
+        self.conversation_ttl = conversation_ttl
+        self._conn = None
+        self._write_lock = threading.Lock()
+        self._pending_users = {}  # {user_id: JSON или None — удалить}
+        self._pending_conversations = {}  # {(name, key JSON): (user_id, JSON состояния или None)}
+        self._saved = {}  # {user_id: последний записанный JSON}
+        self._last_seen = {}  # {user_id: время последнего обновления от пользователя}
+        self._write_task = None
+        self._retry_delay = 0.0  # пауза перед следующей записью после ошибок, секунд
+        self._retry_waiting = False  # задача записи ждёт этой паузы
+        self._closing = False  # идёт flush: без пауз и без новых задач записи
+        self.stats = {'flushes': 0, 'rows': 0, 'skipped': 0, 'errors': 0, 'flush_time': 0.0,
+                      'expired': 0, 'evicted': 0}
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # Пишем из потоков пула (asyncio.to_thread), доступ — под _write_lock
+            self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            for pragma in PRAGMAS:
+                self._conn.execute(pragma)
+            for statement in SCHEMA:
+                self._conn.execute(statement)
+        return self._conn
+
+    def _in_shard(self, user_id):
+        return self.shard is None or user_id % self.shard[1] == self.shard[0]
+
+    # === Загрузка при запуске ===
+
+    async def get_user_data(self):
+        conn = self._connection()
+        with self._write_lock:
+            expired = conn.execute("DELETE FROM user_data WHERE updated_at < ?",
+                                   (time.time() - self.state_ttl,)).rowcount
+            rows = conn.execute("SELECT user_id, data, updated_at FROM user_data").fetchall()
+        self.stats['expired'] += expired
+        user_data = {}
+        for user_id, data, updated_at in rows:
+            if self._in_shard(user_id):
+                user_data[user_id] = json.loads(data)
+                self._saved[user_id] = data
+                self._last_seen[user_id] = updated_at
+        return user_data
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        conn = self._connection()
+        with self._write_lock:
+            expired = conn.execute("DELETE FROM conversations WHERE name = ? AND updated_at < ?",
+                                   (name, time.time() - self.conversation_ttl)).rowcount
+            rows = conn.execute("SELECT key, user_id, state FROM conversations WHERE name = ?",
+                                (name,)).fetchall()
+        self.stats['expired'] += expired
+        return {tuple(json.loads(key)): json.loads(state)
+                for key, user_id, state in rows if self._in_shard(user_id)}
+
+    # === Изменения: копятся в буфере ===
+
+    async def update_conversation(self, name, key, new_state):
+        # Ключ диалога per_user заканчивается ID пользователя
+        state = json.dumps(new_state) if new_state is not None else None
+        self._pending_conversations[(name, json.dumps(key))] = (key[-1], state)
+        self._schedule_write()
+
+    async def update_user_data(self, user_id, data):
+        self._last_seen[user_id] = time.time()
+        data = json.dumps(data, ensure_ascii=False) if data else None
+        if self._saved.get(user_id) == data:
+            self.stats['skipped'] += 1
+            return
+        if data is None:
+            self._saved.pop(user_id, None)
+        else:
+            self._saved[user_id] = data
+        self._pending_users[user_id] = data
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._last_seen.pop(user_id, None)
+        if self._saved.pop(user_id, None) is not None or user_id in self._pending_users:
+            self._pending_users[user_id] = None
+            self._schedule_write()
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # === Запись ===
+
+    def _schedule_write(self):
+        if self._write_task is None:
+            self._write_task = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def _write_pending(self):
+        try:
+            if self._retry_delay and not self._closing:
+                self._retry_waiting = True
+                try:
+                    await asyncio.sleep(self._retry_delay)
+                finally:
+                    self._retry_waiting = False
+            else:
+                # Пропускаем ход: PTB передаёт изменения одного сохранения
+                # пачкой корутин, и все они попадут в эту транзакцию
+                await asyncio.sleep(0)
+            users, conversations = self._take_pending()
+            try:
+                await asyncio.to_thread(self._write, users, conversations)
+            except Exception as e:
+                # Буфер меняется только в event loop: пачку возвращаем здесь, а не в потоке
+                self._return_pending(users, conversations)
+                self._retry_delay = min(max(self._retry_delay * 2, 1.0), PERSISTENCE_RETRY_MAX_DELAY)
+                self.stats['errors'] += 1
+                logger.error(f"Ошибка сохранения состояния диалогов ({len(users) + len(conversations)} записей), "
+                             f"повтор через {self._retry_delay:.0f} с: {e}")
+            else:
+                self._retry_delay = 0.0
+        finally:
+            self._write_task = None
+        if (self._pending_users or self._pending_conversations) and not self._closing:
+            self._schedule_write()
+
+    def _take_pending(self):
+        users, self._pending_users = self._pending_users, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        return users, conversations
+
+    def _return_pending(self, users, conversations):
+        """Возвращает незаписанную пачку в буфер; более новые изменения из буфера важнее."""
+        for user_id, data in users.items():
+            self._pending_users.setdefault(user_id, data)
+        for key, value in conversations.items():
+            self._pending_conversations.setdefault(key, value)
+
+    def _write(self, users, conversations):
+        """Пишет пачку изменений одной транзакцией (в потоке); ошибку пробрасывает."""
+        if not users and not conversations:
+            return
+        started = time.perf_counter()
+        now = time.time()
+        with self._write_lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)",
+                    [(user_id, data, now) for user_id, data in users.items() if data is not None]
+                )
+                conn.executemany(
+                    "DELETE FROM user_data WHERE user_id = ?",
+                    [(user_id,) for user_id, data in users.items() if data is None]
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO conversations (name, key, user_id, state, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(name, key, user_id, state, now)
+                     for (name, key), (user_id, state) in conversations.items() if state is not None]
+                )
+                conn.executemany(
+                    "DELETE FROM conversations WHERE name = ? AND key = ?",
+                    [(name, key) for (name, key), (_, state) in conversations.items() if state is None]
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        self.stats['flushes'] += 1
+        self.stats['rows'] += len(users) + len(conversations)
+        self.stats['flush_time'] += time.perf_counter() - started
+
+    async def flush(self):
+        """
+        Дописывает буфер и закрывает соединение (вызывается PTB при остановке).
+
+        Паузу после ошибок не ждём: буфер пишется сразу, последней попыткой.
+        """
+        self._closing = True
+        task = self._write_task
+        if task is not None:
+            if self._retry_waiting:
+                task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        users, conversations = self._take_pending()
+        try:
+            await asyncio.to_thread(self._write, users, conversations)
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.error(f"Состояние диалогов не сохранено при остановке "
+                         f"({len(users) + len(conversations)} записей): {e}")
+        with self._write_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # === Вытеснение из памяти ===
+
+    def idle_users(self, now=None):
+        """ID пользователей без обновлений дольше state_ttl."""
+        cutoff = (now or time.time()) - self.state_ttl
+        return [user_id for user_id, seen in self._last_seen.items() if seen < cutoff]
+
+    def evict_idle(self, application, now=None):
+        """
+        Убирает из памяти Application (и из базы) user_data пользователей,
+        не писавших боту дольше state_ttl.
+
+        :return: количество вытесненных пользователей
+        """
+        idle = self.idle_users(now)
+        for user_id in idle:
+            application.drop_user_data(user_id)
+            self._last_seen.pop(user_id, None)
+        self.stats['evicted'] += len(idle)
+        if idle:
+            logger.info(f"Из памяти убраны данные {len(idle)} неактивных пользователей")
+        return len(idle)
+
+    def info(self):
+        """Счётчики записи, размер буфера и число пользователей в памяти."""
+        return {
+            **self.stats,
+            'flush_time': round(self.stats['flush_time'], 3),
+            'pending': len(self._pending_users) + len(self._pending_conversations),
+            'users': len(self._last_seen),
+        }
+
+
+async def evict_idle_user_data(context):
+    """Убирает из памяти данные неактивных пользователей (задача JobQueue)."""
+    persistence = context.application.persistence
+    if isinstance(persistence, SQLitePersistence):
+        persistence.evict_idle(context.application)
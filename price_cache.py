@@ -0,0 +1,267 @@
+# price_cache.py
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from database import get_shared_prices, put_shared_prices
+
+logger = logging.getLogger(__name__)
+
+
+class PriceCache:
+    """
+    Двухуровневый кэш цен монет.
+
+    Первый уровень — LRU в памяти процесса с ограничением по числу монет.
+    Второй (необязательный) — общее хранилище, через которое цены делят
+    несколько процессов бота (см. SQLiteSharedTier). Его чтение и запись
+    синхронные, поэтому из корутин используйте lookup_async и store_async.
+
+    Запись моложе ttl — свежая. Запись старше ttl, но моложе stale_ttl —
+    устаревшая: её можно сразу отдать пользователю, параллельно обновив
+    (stale-while-revalidate). Старше stale_ttl — промах.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, stale_ttl: float, shared=None):
+        """
+        :param max_entries: сколько монет держать в памяти
+        :param ttl: срок свежести цены, секунд
+        :param stale_ttl: сколько секунд цену ещё можно отдавать как устаревшую
+        :param shared: общий уровень с методами get(coin_ids) и put(entries) или None
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.shared = shared
+        self._entries = OrderedDict()  # {coin_id: (prices, fetched_at)}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'shared_hits': 0, 'stale_hits': 0, 'misses': 0,
+                      'coalesced': 0, 'refreshes': 0, 'fetch_errors': 0, 'evictions': 0}
+        self._stale_age_total = 0.0
+
+    def _put_local(self, coin_id, prices, fetched_at):
+        self._entries[coin_id] = (prices, fetched_at)
+        self._entries.move_to_end(coin_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def lookup(self, coin_ids, currencies):
+        """
+        Ищет цены монет в кэше.
+
+        :param coin_ids: list ID монет
+        :param currencies: list валют — запись подходит, только если есть все
+        :return: (fresh, stale, missing) — fresh и stale: dict {coin_id: {currency: price}},
+                 missing: list ID монет, которые нужно запросить
+        """
+        now = time.time()
+        fresh, candidates = self._lookup_local(coin_ids, currencies, now)
+        local_hits = len(fresh)
+        # Чего нет свежего в памяти — ищем в общем уровне (его мог обновить другой процесс)
+        if candidates and self.shared is not None:
+            self._merge_shared(self._read_shared(list(candidates)), candidates, currencies)
+        return self._classify(fresh, candidates, currencies, now, local_hits)
+
+    async def lookup_async(self, coin_ids, currencies):
+        """
+        Асинхронный аналог lookup: общий уровень читается в потоке, не блокируя event loop.
+        """
+        now = time.time()
+        fresh, candidates = self._lookup_local(coin_ids, currencies, now)
+        local_hits = len(fresh)
+        if candidates and self.shared is not None:
+            shared = await asyncio.to_thread(self._read_shared, list(candidates))
+            self._merge_shared(shared, candidates, currencies)
+        return self._classify(fresh, candidates, currencies, now, local_hits)
+
+    def _lookup_local(self, coin_ids, currencies, now):
+        """
+        :return: (fresh — свежие цены из памяти,
+                  candidates — dict {coin_id: запись памяти или None} для остальных)
+        """
+        fresh, candidates = {}, {}
+        with self._lock:
+            for coin_id in coin_ids:
+                entry = self._entries.get(coin_id)
+                if entry is None or not all(c in entry[0] for c in currencies):
+                    candidates[coin_id] = None
+                    continue
+                self._entries.move_to_end(coin_id)
+                if now - entry[1] < self.ttl:
+                    fresh[coin_id] = {c: entry[0][c] for c in currencies}
+                else:
+                    candidates[coin_id] = entry
+        return fresh, candidates
+
+    def _read_shared(self, coin_ids):
+        try:
+            return self.shared.get(coin_ids)
+        except Exception as e:
+            logger.error(f"Ошибка чтения общего кэша цен: {e}")
+            return {}
+
+    def _merge_shared(self, shared, candidates, currencies):
+        """Берёт из общего уровня записи новее, чем в памяти."""
+        with self._lock:
+            for coin_id, (prices, fetched_at) in shared.items():
+                local = candidates.get(coin_id)
+                if local is None or fetched_at > local[1]:
+                    self._put_local(coin_id, prices, fetched_at)
+                    if all(c in prices for c in currencies):
+                        candidates[coin_id] = (prices, fetched_at)
+
+    def _classify(self, fresh, candidates, currencies, now, local_hits):
+        missing, stale = [], {}
+        with self._lock:
+            for coin_id, entry in candidates.items():
+                age = now - entry[1] if entry else None
+                if entry is None or age >= self.stale_ttl:
+                    missing.append(coin_id)
+                    continue
+                prices = {c: entry[0][c] for c in currencies}
+                if age < self.ttl:
+                    fresh[coin_id] = prices
+                    self.stats['shared_hits'] += 1
+                else:
+                    stale[coin_id] = prices
+                    self.stats['stale_hits'] += 1
+                    self._stale_age_total += age
+            self.stats['hits'] += local_hits
+            self.stats['misses'] += len(missing)
+        return fresh, stale, missing
+
+    def store(self, data, currencies, fetched_at=None):
+        """
+        Кладёт ответ simple/price в оба уровня.
+
+        :param data: dict {coin_id: {currency: price}}
+        :param fetched_at: время получения цен — одно на все монеты или dict {coin_id: время};
+                           по умолчанию — сейчас
+        :return: dict {coin_id: {currency: price}} только по запрошенным валютам
+        """
+        result, entries = self._store_local(data, currencies, fetched_at)
+        if entries and self.shared is not None:
+            self._write_shared(entries)
+        return result
+
+    async def store_async(self, data, currencies, fetched_at=None):
+        """
+        Асинхронный аналог store: запись в общий уровень идёт в потоке, не блокируя event loop.
+        """
+        result, entries = self._store_local(data, currencies, fetched_at)
+        if entries and self.shared is not None:
+            await asyncio.to_thread(self._write_shared, entries)
+        return result
+
+    def _store_local(self, data, currencies, fetched_at):
+        now = time.time()
+        times = fetched_at if isinstance(fetched_at, dict) else {}
+        default = now if isinstance(fetched_at, dict) else fetched_at or now
+        result = {}
+        entries = []
+        with self._lock:
+            for coin_id, prices in data.items():
+                if not prices:
+                    continue
+                coin_fetched_at = times.get(coin_id, default)
+                self._put_local(coin_id, prices, coin_fetched_at)
+                entries.append((coin_id, prices, coin_fetched_at))
+                result[coin_id] = {c: prices[c] for c in currencies if c in prices}
+        return result, entries
+
+    def _write_shared(self, entries):
+        try:
+            self.shared.put(entries)
+        except Exception as e:
+            logger.error(f"Ошибка записи общего кэша цен: {e}")
+
+    def peek(self, coin_ids):
+        """
+        Возвращает записи памяти без учёта в статистике и без изменения порядка LRU.
+
+        :return: dict {coin_id: (prices, fetched_at)} — только найденные монеты
+        """
+        with self._lock:
+            return {coin_id: self._entries[coin_id] for coin_id in coin_ids if coin_id in self._entries}
+
+    def record(self, name: str, count: int = 1):
+        """Увеличивает счётчик статистики (coalesced, refreshes, fetch_errors)."""
+        with self._lock:
+            self.stats[name] += count
+
+    def info(self):
+        """Возвращает счётчики, долю попаданий и возраст записей."""
+        now = time.time()
+        with self._lock:
+            served = self.stats['hits'] + self.stats['shared_hits'] + self.stats['stale_hits']
+            total = served + self.stats['misses']
+            ages = [now - fetched_at for _, fetched_at in self._entries.values()]
+            return {
+                **self.stats,
+                'hit_rate': round(served / total, 4) if total else 0.0,
+                'avg_stale_age': round(self._stale_age_total / self.stats['stale_hits'], 1)
+                if self.stats['stale_hits'] else 0.0,
+                'entries': len(self._entries),
+                'oldest_age': round(max(ages), 1) if ages else 0.0,
+            }
+
+
+class SingleFlight:
+    """
+    Объединение одновременных запросов одних и тех же ключей.
+
+    Первый вызов claim по ключу становится владельцем и выполняет запрос,
+    остальные получают Future и ждут его результата. Future из
+    concurrent.futures, поэтому ждать можно и из потока (future.result),
+    и из корутины (asyncio.wrap_future).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def claim(self, keys):
+        """
+        :return: (owned — ключи, которые запрашивает вызывающий,
+                  waiting — dict {key: Future} уже запрошенных другими)
+        """
+        owned, waiting = [], {}
+        with self._lock:
+            for key in keys:
+                future = self._calls.get(key)
+                if future is None:
+                    future = Future()
+                    # Выполняющийся Future нельзя отменить: таймаут одного
+                    # ждущего не должен ломать результат остальным
+                    future.set_running_or_notify_cancel()
+                    self._calls[key] = future
+                    owned.append(key)
+                else:
+                    waiting[key] = future
+        return owned, waiting
+
+    def resolve(self, keys, results):
+        """Завершает запросы владельца: ждущие получают results.get(key) (None — нет данных)."""
+        with self._lock:
+            futures = [(key, self._calls.pop(key, None)) for key in keys]
+        for key, future in futures:
+            if future is not None:
+                future.set_result(results.get(key))
+
+
+class SQLiteSharedTier:
+    """Общий уровень кэша цен в таблице price_cache базы бота."""
+
+    def get(self, coin_ids):
+        return {coin_id: (json.loads(prices), fetched_at)
+                for coin_id, prices, fetched_at in get_shared_prices(coin_ids)}
+
+    def put(self, entries):
+        put_shared_prices((coin_id, json.dumps(prices), fetched_at)
+                          for coin_id, prices, fetched_at in entries)
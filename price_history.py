@@ -0,0 +1,159 @@
+# price_history.py
+
+import asyncio
+import logging
+import time
+
+import numpy as np
+
+from async_crypto_api import ensure_coin_index, get_coin_prices_async
+from config import PRICE_HISTORY_MINUTE_KEEP, PRICE_HISTORY_HOUR_KEEP, PRICE_SAMPLE_INTERVAL
+from crypto_api import coin_id_of
+from database import (
+    add_price_samples,
+    get_coin_popularity,
+    get_portfolio,
+    get_price_history,
+    prune_price_history,
+)
+
+logger = logging.getLogger(__name__)
+
+MINUTE = 60
+HOUR = 60 * 60
+DAY = 60 * 60 * 24
+
+# Каждый замер сразу попадает во все три ряда; старые минутные и часовые
+# точки удаляются prune_history, дневные хранятся бессрочно
+RESOLUTIONS = (MINUTE, HOUR, DAY)
+
+_last_sample = 0.0  # когда record_prices последний раз писал замер
+
+
+def _series_params(days: int):
+    """
+    Подбирает разрешение хранимого ряда и шаг сетки для периода.
+
+    :return: (resolution, step) в секундах
+    """
+    if days <= 1:
+        return MINUTE, MINUTE * 5
+    if days <= 30:
+        return HOUR, HOUR
+    return DAY, DAY
+
+
+async def sample_prices():
+    """
+    Записывает текущие цены монет из портфелей и напоминаний (задача планировщика).
+
+    Цены берутся одним пакетным запросом (или из кэша). Если замер меньше
+    половины PRICE_SAMPLE_INTERVAL назад уже записало фоновое обновление
+    цен (ingestion.py), проход пропускается.
+
+    :return: количество записанных точек
+    """
+    if time.time() - _last_sample < PRICE_SAMPLE_INTERVAL / 2:
+        return 0
+    await ensure_coin_index()
+    popularity = await asyncio.to_thread(get_coin_popularity)
+    coin_ids = {coin_id_of(symbol, coin_id) for symbol, coin_id, _ in popularity}
+    if not coin_ids:
+        return 0
+    prices = await get_coin_prices_async(coin_ids)
+    return await asyncio.to_thread(
+        record_prices, {coin_id: p['usd'] for coin_id, p in prices.items() if 'usd' in p})
+
+
+def record_prices(prices, ts=None):
+    """
+    Сохраняет цены в историю (в минутный, часовой и дневной ряды).
+    Замеры пишут sample_prices и фоновое обновление цен (ingestion.py).
+
+    :param prices: dict {coin_id: price в USD}
+    :param ts: время замера (unix time), по умолчанию — сейчас
+    :return: количество записанных цен
+    """
+    global _last_sample
+    ts = int(ts or time.time())
+    add_price_samples(((coin_id, ts, price) for coin_id, price in prices.items()), RESOLUTIONS)
+    _last_sample = time.time()
+    return len(prices)
+
+
+def prune_history(now=None):
+    """Удаляет минутные точки старше суток и часовые старше 30 дней."""
+    now = int(now or time.time())
+    minutes = prune_price_history(MINUTE, now - PRICE_HISTORY_MINUTE_KEEP)
+    hours = prune_price_history(HOUR, now - PRICE_HISTORY_HOUR_KEEP)
+    logger.info(f"История цен: удалено {minutes} минутных и {hours} часовых точек")
+
+
+def get_price_matrix(coin_ids, days: int, now=None):
+    """
+    Возвращает цены монет на равномерной временной сетке.
+
+    Точки ряда подходящего разрешения раскладываются по шагам сетки через
+    np.bincount (несколько точек в шаге усредняются). Пропуски заполняются
+    последней известной ценой, а начало ряда до первой точки — первой
+    известной ценой. Монеты без истории дают строку из NaN.
+
+    :param coin_ids: list ID монет
+    :param days: глубина ряда в днях
+    :return: (timestamps — массив shape (T,), prices — массив shape (len(coin_ids), T))
+    """
+    resolution, step = _series_params(days)
+    now = int(now or time.time())
+    start = (now - days * DAY) // step * step
+    timestamps = np.arange(start, now // step * step + 1, step, dtype=np.int64)
+    size = len(coin_ids) * len(timestamps)
+
+    rows = get_price_history(coin_ids, resolution, start)
+    if rows:
+        position = {coin_id: i for i, coin_id in enumerate(coin_ids)}
+        row_ids, ts, price = zip(*rows)
+        steps = np.minimum((np.array(ts, dtype=np.int64) - start) // step, len(timestamps) - 1)
+        cells = np.array([position[c] for c in row_ids]) * len(timestamps) + steps
+        sums = np.bincount(cells, weights=price, minlength=size)
+        counts = np.bincount(cells, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            flat = sums / counts
+    else:
+        flat = np.full(size, np.nan)
+
+    matrix = flat.reshape(len(coin_ids), len(timestamps))
+    return timestamps, _fill_gaps(matrix)
+
+
+def _fill_gaps(matrix):
+    """Заполняет NaN последним известным значением (а в начале ряда — первым)."""
+    if matrix.size == 0:
+        return matrix
+    known = ~np.isnan(matrix)
+    columns = np.arange(matrix.shape[1])
+    index = np.where(known, columns, -1)
+    np.maximum.accumulate(index, axis=1, out=index)
+    first_known = known.argmax(axis=1)
+    index = np.where(index < 0, first_known[:, None], index)
+    return matrix[np.arange(matrix.shape[0])[:, None], index]
+
+
+def portfolio_value_series(user_id, days: int):
+    """
+    Считает стоимость текущих позиций пользователя за период.
+
+    Стоимость = количество монет × цена на каждом шаге, одним матричным
+    умножением по всем монетам портфеля.
+
+    :return: (timestamps, values) — массивы shape (T,)
+    """
+    holdings = {}
+    for symbol, amount, _, coin_id in get_portfolio(user_id):
+        coin_id = coin_id_of(symbol, coin_id)
+        holdings[coin_id] = holdings.get(coin_id, 0.0) + amount
+    coin_ids = list(holdings)
+    quantities = np.fromiter(holdings.values(), dtype=float, count=len(holdings))
+
+    timestamps, prices = get_price_matrix(coin_ids, days)
+    values = quantities @ np.nan_to_num(prices) if len(coin_ids) else np.zeros(len(timestamps))
+    return timestamps, values
@@ -0,0 +1,340 @@
+# price_stream.py
+
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from async_crypto_api import ensure_coin_index
+from config import STREAM_URL, STREAM_QUOTE, STREAM_MAX_SYMBOLS
+from crypto_api import coin_id_of, coin_index, price_cache, resolve_coin_id
+from database import get_coin_popularity
+from fx import BASE_CURRENCY
+
+logger = logging.getLogger(__name__)
+
+# Binance принимает не больше 5 управляющих сообщений в секунду
+SUBSCRIBE_CHUNK = 200  # потоков в одном SUBSCRIBE
+SUBSCRIBE_PAUSE = 0.25  # секунд между сообщениями
+RECONNECT_MAX_DELAY = 60
+
+
+class PriceStream:
+    """
+    Поток цен с биржи по WebSocket (Binance miniTicker).
+
+    Подписывается на тикеры отслеживаемых монет к STREAM_QUOTE и держит
+    таблицу последних цен, которая обновляется на месте при каждом тике.
+    Каждому тикеру сопоставлен ID монеты в CoinGecko (см. watch).
+    Слушатели (add_listener) вызываются на каждый тик — например, проверка
+    напоминаний в alerts.StreamAlerts. Раз в несколько секунд flush
+    переносит изменившиеся цены в общий кэш цен, откуда их читают портфель
+    и отчёты.
+
+    Цены к USDT считаются ценами в USD. Монеты, которых нет на бирже,
+    по-прежнему обновляются из CoinGecko (ingestion.py).
+    """
+
+    def __init__(self, url=STREAM_URL, quote=STREAM_QUOTE):
+        self.url = url
+        self.quote = quote.upper()
+        self.prices = {}  # {symbol: последняя цена}
+        self.updated_at = {}  # {symbol: время получения тика}
+        self._dirty = set()
+        self._listeners = []
+        self._watched = {}  # {биржевой символ: ID монеты в CoinGecko}
+        self._subscribed = set()
+        self._ws = None
+        self._task = None
+        self._request_id = 0
+        self.stats = {'ticks': 0, 'reconnects': 0, 'errors': 0, 'flushed': 0}
+
+    @property
+    def connected(self):
+        return self._ws is not None and not self._ws.closed
+
+    def add_listener(self, callback):
+        """
+        Добавляет обработчик тиков.
+
+        :param callback: функция (coin_id, price) — вызывается в event loop,
+                         поэтому должна быть быстрой и не блокирующей
+        """
+        self._listeners.append(callback)
+
+    def _stream_name(self, symbol):
+        return f"{symbol}{self.quote.lower()}@miniTicker"
+
+    async def watch(self, coins):
+        """
+        Задаёт отслеживаемые монеты; подписки меняются только на разницу.
+
+        :param coins: dict {биржевой символ: ID монеты в CoinGecko} (см. exchange_symbols)
+        """
+        self._watched = {symbol.lower(): coin_id for symbol, coin_id in coins.items()}
+        if self.connected:
+            await self._sync_subscriptions()
+
+    async def _send(self, method, symbols):
+        streams = [self._stream_name(symbol) for symbol in symbols]
+        for i in range(0, len(streams), SUBSCRIBE_CHUNK):
+            self._request_id += 1
+            await self._ws.send_json({'method': method, 'params': streams[i:i + SUBSCRIBE_CHUNK],
+                                      'id': self._request_id})
+            await asyncio.sleep(SUBSCRIBE_PAUSE)
+
+    async def _sync_subscriptions(self):
+        watched = set(self._watched)
+        removed = sorted(self._subscribed - watched)
+        added = sorted(watched - self._subscribed)
+        if removed:
+            await self._send('UNSUBSCRIBE', removed)
+            for symbol in removed:
+                self.prices.pop(symbol, None)
+                self.updated_at.pop(symbol, None)
+        if added:
+            await self._send('SUBSCRIBE', added)
+        self._subscribed = watched
+
+    def _on_message(self, raw):
+        message = json.loads(raw)
+        # Комбинированный поток оборачивает событие в {'stream': ..., 'data': ...}
+        data = message.get('data', message)
+        if data.get('e') != '24hrMiniTicker':
+            return
+        pair = data['s']
+        if not pair.endswith(self.quote):
+            return
+        symbol = pair[:-len(self.quote)].lower()
+        coin_id = self._watched.get(symbol)
+        if coin_id is None:
+            return  # тик успел прийти после отписки
+        price = float(data['c'])
+        self.prices[symbol] = price
+        # Время получения, а не биржевое 'E': не зависит от расхождения часов
+        self.updated_at[symbol] = time.time()
+        self._dirty.add(symbol)
+        self.stats['ticks'] += 1
+        for listener in self._listeners:
+            try:
+                listener(coin_id, price)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика тика {symbol}: {e}")
+
+    async def _listen(self, session):
+        async with session.ws_connect(self.url, heartbeat=30) as ws:
+            self._ws = ws
+            self._subscribed = set()
+            try:
+                await self._sync_subscriptions()
+                logger.info(f"Поток цен подключён: {len(self._subscribed)} монет")
+                async for message in ws:
+                    if message.type == aiohttp.WSMsgType.TEXT:
+                        self._on_message(message.data)
+                    elif message.type == aiohttp.WSMsgType.ERROR:
+                        break
+            finally:
+                self._ws = None
+
+    async def run(self):
+        """Держит подключение, переподключаясь с растущей паузой."""
+        delay = 1.0
+        async with aiohttp.ClientSession() as session:
+            while True:
+                ticks = self.stats['ticks']
+                try:
+                    await self._listen(session)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    logger.error(f"Ошибка потока цен: {e!r}")
+                # Соединение, по которому шли тики, считаем удачным
+                delay = 1.0 if self.stats['ticks'] > ticks else min(delay * 2, RECONNECT_MAX_DELAY)
+                self.stats['reconnects'] += 1
+                logger.warning(f"Поток цен отключился, переподключение через {delay:.0f} с")
+                await asyncio.sleep(delay)
+
+    def start(self):
+        """Запускает поток фоновой задачей в текущем event loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Останавливает поток."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def flush(self):
+        """
+        Переносит изменившиеся с прошлого вызова цены в кэш цен.
+
+        Каждая цена сохраняется со временем своего тика; запись в общий
+        уровень кэша идёт в потоке, не блокируя event loop.
+
+        :return: количество перенесённых цен
+        """
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, set()
+        # Отписанные с прошлого вызова монеты уже удалены из таблицы
+        coin_ids = {symbol: self._watched[symbol] for symbol in dirty
+                    if symbol in self.prices and symbol in self._watched}
+        data = {coin_id: {BASE_CURRENCY: self.prices[symbol]} for symbol, coin_id in coin_ids.items()}
+        fetched_at = {coin_id: self.updated_at[symbol] for symbol, coin_id in coin_ids.items()}
+        stored = await price_cache.store_async(data, [BASE_CURRENCY], fetched_at)
+        self.stats['flushed'] += len(stored)
+        return len(stored)
+
+    def info(self):
+        """Счётчики, число подписок и возраст последних цен."""
+        now = time.time()
+        ages = [now - ts for ts in self.updated_at.values()]
+        return {
+            **self.stats,
+            'connected': self.connected,
+            'watched': len(self._watched),
+            'subscribed': len(self._subscribed),
+            'max_age': round(max(ages), 1) if ages else 0.0,
+        }
+
+
+price_stream = PriceStream()
+
+
+def exchange_symbols(popularity, limit=STREAM_MAX_SYMBOLS):
+    """
+    Сопоставляет монеты из get_coin_popularity тикерам биржи.
+
+    Тикер биржи — символ монеты, а у одного символа бывает несколько монет.
+    Монета попадает в поток, только если она первый кандидат своего символа
+    (resolve_coin_id): иначе её ценой стали бы тики другой монеты.
+
+    :param popularity: строки get_coin_popularity
+    :param limit: наибольшее количество тикеров
+    :return: dict {биржевой символ: ID монеты в CoinGecko}
+    """
+    coins = {}
+    for symbol, coin_id, _ in popularity:
+        coin = coin_index.get(coin_id_of(symbol, coin_id))
+        if coin is None:
+            continue
+        ticker = coin['symbol'].lower()
+        if ticker in coins or resolve_coin_id(ticker) != coin['id']:
+            continue
+        coins[ticker] = coin['id']
+        if len(coins) >= limit:
+            break
+    return coins
+
+
+async def sync_stream_watchlist(stream_alerts=None):
+    """
+    Обновляет подписки потока по монетам из портфелей и напоминаний
+    (и индекс напоминаний для проверки по тикам). Задача планировщика.
+    """
+    await ensure_coin_index()
+    if stream_alerts is not None:
+        await stream_alerts.reload()
+    popularity = await asyncio.to_thread(get_coin_popularity)
+    await price_stream.watch(exchange_symbols(popularity))
+
+
+async def flush_stream_prices():
+    """Переносит цены из потока в кэш цен (задача планировщика)."""
+    return await price_stream.flush()
+
+
+async def _replay(path, host, port, rate):
+    """Локальная замена биржевого потока: раздаёт записанные тики с заданной частотой."""
+    from aiohttp import web
+
+    with open(path, encoding='utf-8') as f:
+        ticks = [line.strip() for line in f if line.strip()]
+    if not ticks:
+        raise SystemExit(f"В {path} нет тиков")
+
+    async def handler(request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        async def answer_control():
+            async for message in ws:
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    await ws.send_json({'result': None, 'id': json.loads(message.data).get('id')})
+
+        control = asyncio.create_task(answer_control())
+        interval = 1 / rate if rate else 0
+        sent = 0
+        started = time.monotonic()
+        try:
+            while not ws.closed:
+                await ws.send_str(ticks[sent % len(ticks)])
+                sent += 1
+                # Пауза не на каждый тик, а по отставанию от расписания
+                ahead = sent * interval - (time.monotonic() - started)
+                if ahead > 0.001 or sent % 1000 == 0:
+                    await asyncio.sleep(max(ahead, 0))
+        except ConnectionResetError:
+            pass
+        finally:
+            control.cancel()
+        print(f"Отправлено тиков: {sent} за {time.monotonic() - started:.1f} с")
+        return ws
+
+    app = web.Application()
+    app.router.add_get('/stream', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"ws://{host}:{port}/stream — {len(ticks)} тиков, {rate or 'без ограничения'} в секунду")
+    await asyncio.Event().wait()
+
+
+async def _record(path, symbols, seconds):
+    """Записывает тики живого потока в файл (по одному сообщению в строке)."""
+    stream = PriceStream()
+    written = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        def write(symbol, price):
+            nonlocal written
+            f.write(json.dumps({'data': {'e': '24hrMiniTicker', 'E': int(stream.updated_at[symbol] * 1000),
+                                         's': f"{symbol.upper()}{stream.quote}", 'c': str(price)}}) + '\n')
+            written += 1
+
+        stream.add_listener(write)
+        # Без справочника монет: ID монеты — сам символ, его и получает write
+        await stream.watch({symbol.lower(): symbol.lower() for symbol in symbols})
+        stream.start()
+        await asyncio.sleep(seconds)
+        await stream.stop()
+    print(f"Записано тиков: {written}")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Запись и воспроизведение потока цен")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record', help="записать тики живого потока в файл")
+    record_parser.add_argument('path')
+    record_parser.add_argument('symbols', nargs='+', help="символы монет, например btc eth")
+    record_parser.add_argument('--seconds', type=float, default=60)
+    replay_parser = subparsers.add_parser('replay', help="раздавать записанные тики по WebSocket")
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--host', default='127.0.0.1')
+    replay_parser.add_argument('--port', type=int, default=8765)
+    replay_parser.add_argument('--rate', type=float, default=1000, help="тиков в секунду, 0 — без ограничения")
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        asyncio.run(_record(args.path, args.symbols, args.seconds))
+    else:
+        asyncio.run(_replay(args.path, args.host, args.port, args.rate))
@@ -1,57 +1,255 @@
 # recommendation.py
 
-from crypto_api import search_coin, get_coin_price
+import asyncio
+import logging
+import math
+import time
 
+import numpy as np
 
-def recommend_investment(amount, desired_profit, days):
+from async_crypto_api import client
+from config import (
+    RECOMMEND_TOP_COINS,
+    RECOMMEND_REFRESH_INTERVAL,
+    RECOMMEND_HISTORY_DAYS,
+    RECOMMEND_MIN_VOLUME,
+    RECOMMEND_DRIFT_SHRINK,
+    RECOMMEND_RESULTS,
+)
+from crypto_api import price_cache
+from database import add_price_samples, get_price_history_counts
+from fx import BASE_CURRENCY
+from price_history import DAY, HOUR, get_price_matrix, record_prices
+
+logger = logging.getLogger(__name__)
+
+MARKETS_PAGE_SIZE = 250  # максимум CoinGecko для /coins/markets
+HOURS_PER_YEAR = 24 * 365
+# Годовая волатильность (%), до которой риск считается низким и средним;
+# ниже MIN_VOLATILITY — стейблкоины, их не рекомендуем
+RISK_LEVELS = ((60, 'low'), (100, 'medium'))
+MIN_VOLATILITY = 5
+# Точек часового ряда, без которых история монеты дополняется из sparkline
+MIN_HISTORY_POINTS = 48
+
+
+class MarketScan:
     """
-    Возвращает список монет с потенциалом для достижения цели пользователя.
+    Признаки монет рынка, посчитанные одним векторным проходом.
 
-    :param amount: сумма инвестиции (в USD)
-    :param desired_profit: желаемая прибыль (в USD)
-    :param days: срок (в днях)
-    :return: list of dict — список рекомендаций
+    Скан строится по расписанию (refresh_recommendations) и хранится в
+    памяти, а recommend лишь пересчитывает вероятность цели пользователя
+    по готовым массивам — без запросов к API и к базе.
     """
-    coins_to_check = [
-        'bitcoin', 'ethereum', 'solana', 'cardano',
-        'dogecoin', 'pepecoin', 'bonk', 'litecoin', 'chainlink'
-    ]
-    recommendations = []
 
-    for coin_name in coins_to_check:
-        coin = search_coin(coin_name)
-        if not coin:
-            continue
+    def __init__(self, coins, drift, volatility, score, taken_at=None):
+        """
+        :param coins: list of dict (id, name, symbol) — строки массивов
+        :param drift: средняя часовая лог-доходность
+        :param volatility: стандартное отклонение часовой лог-доходности
+        :param score: сводная оценка (импульс, волатильность, ликвидность)
+        """
+        self.coins = coins
+        self.drift = drift
+        self.volatility = volatility
+        self.score = score
+        self.taken_at = taken_at or time.time()
 
-        current_price = get_coin_price(coin['symbol'])
-        if not current_price:
-            continue
+    def __len__(self):
+        return len(self.coins)
 
-        # Оценка риска
-        risk_level = 'medium'
-        if any(keyword in coin_name.lower() for keyword in ['pepe', 'doge', 'shib']):
-            risk_level = 'high'
+    @property
+    def age(self):
+        return time.time() - self.taken_at
 
-        # Прогноз роста в %
-        expected_growth = {
-            'high': 15,
-            'medium': 8,
-            'low': 3
-        }[risk_level]
+    def recommend(self, amount, desired_profit, days, limit=RECOMMEND_RESULTS):
+        """
+        Подбирает монеты под цель пользователя.
 
-        # Расчёт ожидаемой прибыли
-        expected_return = amount * (expected_growth / 100)
+        Доходность за срок считается нормальной в лог-шкале: среднее —
+        часовой тренд × часы (с поправкой RECOMMEND_DRIFT_SHRINK), разброс —
+        волатильность × √часов. Монеты ранжируются по вероятности получить
+        желаемую прибыль, при равной — по сводной оценке.
 
-        # Проверяем, соответствует ли монета цели
-        if expected_return >= desired_profit:
+        :param amount: сумма инвестиции (в USD)
+        :param desired_profit: желаемая прибыль (в USD)
+        :param days: срок (в днях)
+        :return: list of dict — name, symbol, risk, forecast, expected_return, probability
+        """
+        if not len(self) or amount <= 0:
+            return []
+        hours = max(days, 1) * 24
+        target = math.log1p(max(desired_profit, 0) / amount)
+        mean = self.drift * RECOMMEND_DRIFT_SHRINK * hours
+        spread = self.volatility * math.sqrt(hours)
+        z = (mean - target) / spread
+        probability = 0.5 * (1 + np.array([math.erf(value / math.sqrt(2)) for value in z]))
+
+        order = np.lexsort((-self.score, -probability))[:limit]
+        annual = self.volatility * math.sqrt(HOURS_PER_YEAR) * 100
+        growth = np.expm1(mean) * 100
+        recommendations = []
+        for i in order:
+            coin = self.coins[i]
             recommendations.append({
                 'name': coin['name'],
                 'symbol': coin['symbol'].upper(),
-                'risk': risk_level,
-                'forecast': f"+{expected_growth}% за {days} дней",
-                'expected_return': expected_return
+                'risk': _risk_level(annual[i]),
+                'forecast': f"{growth[i]:+.1f}% за {days} дней",
+                'expected_return': float(amount * growth[i] / 100),
+                'probability': float(probability[i] * 100),
             })
+        return recommendations
+
+
+def _risk_level(annual_volatility):
+    for limit, level in RISK_LEVELS:
+        if annual_volatility < limit:
+            return level
+    return 'high'
+
+
+def _zscore(values):
+    std = values.std()
+    return (values - values.mean()) / std if std > 0 else np.zeros_like(values)
+
+
+async def _fetch_markets():
+    """Топ RECOMMEND_TOP_COINS монет по капитализации — страницы запрашиваются параллельно."""
+    pages = math.ceil(RECOMMEND_TOP_COINS / MARKETS_PAGE_SIZE)
+    responses = await asyncio.gather(*(
+        client.get_coins_markets(BASE_CURRENCY, page, MARKETS_PAGE_SIZE, sparkline=True)
+        for page in range(1, pages + 1)
+    ))
+    markets = [coin for page in responses for coin in page]
+    return [coin for coin in markets if coin.get('current_price')][:RECOMMEND_TOP_COINS]
+
+
+def _save_history(markets, now):
+    """
+    Кладёт цены скана в кэш и историю; монетам без часового ряда
+    (которых нет в портфелях) история дополняется 7-дневным sparkline.
+    """
+    prices = {coin['id']: coin['current_price'] for coin in markets}
+    price_cache.store({coin_id: {BASE_CURRENCY: price} for coin_id, price in prices.items()}, [BASE_CURRENCY])
+    record_prices(prices, now)
+
+    counts = get_price_history_counts(prices, HOUR, now - RECOMMEND_HISTORY_DAYS * DAY)
+    samples = []
+    for coin in markets:
+        if counts.get(coin['id'], 0) >= MIN_HISTORY_POINTS:
+            continue
+        sparkline = (coin.get('sparkline_in_7d') or {}).get('price') or []
+        # Точки sparkline идут с шагом в час и заканчиваются текущим моментом
+        start = now - (len(sparkline) - 1) * HOUR
+        samples.extend((coin['id'], start + i * HOUR, price)
+                       for i, price in enumerate(sparkline) if price)
+    if samples:
+        add_price_samples(samples, (HOUR,))
+    return len(samples)
+
+
+def build_scan(markets, now=None):
+    """
+    Считает признаки монет по локальной истории цен.
+
+    Из часового ряда за RECOMMEND_HISTORY_DAYS (матрица монеты × часы):
+    тренд и волатильность часовой лог-доходности, импульс за весь период и
+    за сутки. Из рыночных данных — ликвидность: оборот и его доля в капитализации.
+    Сводная оценка — сумма z-оценок признаков.
+
+    :param markets: ответ /coins/markets
+    :return: MarketScan
+    """
+    now = int(now or time.time())
+    ids = [coin['id'] for coin in markets]
+    _, prices = get_price_matrix(ids, RECOMMEND_HISTORY_DAYS, now)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        log_prices = np.log(prices)
+    returns = np.diff(log_prices, axis=1)
+    if returns.shape[1] < 2:
+        return MarketScan([], np.empty(0), np.empty(0), np.empty(0), now)
+
+    with np.errstate(invalid='ignore'):
+        drift = returns.mean(axis=1)
+        volatility = returns.std(axis=1, ddof=1)
+    momentum = log_prices[:, -1] - log_prices[:, 0]
+    momentum_day = log_prices[:, -1] - log_prices[:, -min(25, log_prices.shape[1])]
+    volume = np.array([coin.get('total_volume') or 0 for coin in markets], dtype=float)
+    market_cap = np.array([coin.get('market_cap') or 0 for coin in markets], dtype=float)
+
+    annual = volatility * math.sqrt(HOURS_PER_YEAR) * 100
+    keep = (np.isfinite(drift) & np.isfinite(volatility) & (annual >= MIN_VOLATILITY)
+            & (volume >= RECOMMEND_MIN_VOLUME))
+    if not keep.any():
+        return MarketScan([], np.empty(0), np.empty(0), np.empty(0), now)
+
+    liquidity = np.log10(volume[keep])
+    turnover = np.divide(volume[keep], market_cap[keep],
+                         out=np.zeros(int(keep.sum())), where=market_cap[keep] > 0)
+    score = (_zscore(momentum[keep]) + 0.5 * _zscore(momentum_day[keep])
+             - _zscore(volatility[keep]) + _zscore(liquidity) + 0.5 * _zscore(np.minimum(turnover, 1)))
+
+    coins = [{'id': coin['id'], 'name': coin['name'], 'symbol': coin['symbol']}
+             for coin, ok in zip(markets, keep) if ok]
+    return MarketScan(coins, drift[keep], volatility[keep], score, now)
+
+
+_latest_scan = None
+_scan_lock = None
+
+
+async def refresh_recommendations():
+    """
+    Сканирует рынок и заменяет скан в памяти (задача планировщика).
+
+    :return: количество монет в скане
+    """
+    global _latest_scan
+    started = time.time()
+    try:
+        markets = await _fetch_markets()
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке рынка для рекомендаций: {e}")
+        return 0
+    now = int(time.time())
+    seeded = await asyncio.to_thread(_save_history, markets, now)
+    _latest_scan = await asyncio.to_thread(build_scan, markets, now)
+    logger.info(f"Скан рынка: {len(_latest_scan)} из {len(markets)} монет, "
+                f"дополнено точек истории: {seeded}, {time.time() - started:.2f} с")
+    return len(_latest_scan)
+
+
+async def ensure_scan():
+    """Строит скан, если его ещё нет или задача планировщика давно не обновляла его."""
+    global _scan_lock
+    if _latest_scan is not None and _latest_scan.age < RECOMMEND_REFRESH_INTERVAL * 2:
+        return
+    if _scan_lock is None:
+        _scan_lock = asyncio.Lock()
+    async with _scan_lock:
+        if _latest_scan is None or _latest_scan.age >= RECOMMEND_REFRESH_INTERVAL * 2:
+            await refresh_recommendations()
+
+
+def recommend_investment(amount, desired_profit, days):
+    """
+    Возвращает список монет с потенциалом для достижения цели пользователя.
+
+    Ответ строится из последнего скана рынка в памяти; пока скана нет
+    (бот только запущен) — пустой список.
+
+    :param amount: сумма инвестиции (в USD)
+    :param desired_profit: желаемая прибыль (в USD)
+    :param days: срок (в днях)
+    :return: list of dict — список рекомендаций
+    """
+    if _latest_scan is None:
+        return []
+    return _latest_scan.recommend(amount, desired_profit, days)
+
 
-    # Сортируем по ожидаемому возврату
-    recommendations.sort(key=lambda x: x['expected_return'], reverse=True)
-    return recommendations[:2]  # Возвращаем топ-2
\ No newline at end of file
+async def recommend_investment_async(amount, desired_profit, days):
+    """Асинхронный аналог recommend_investment: при отсутствии скана строит его."""
+    await ensure_scan()
+    return recommend_investment(amount, desired_profit, days)
@@ -0,0 +1,53 @@
+# tests/conftest.py
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import async_crypto_api  # noqa: E402
+import crypto_api  # noqa: E402
+import database  # noqa: E402
+from price_cache import PriceCache, SingleFlight  # noqa: E402
+
+# Небольшой справочник: у символа 'uni' два кандидата
+COINS = [
+    {'id': 'bitcoin', 'symbol': 'btc', 'name': 'Bitcoin'},
+    {'id': 'ethereum', 'symbol': 'eth', 'name': 'Ethereum'},
+    {'id': 'solana', 'symbol': 'sol', 'name': 'Solana'},
+    {'id': 'uniswap', 'symbol': 'uni', 'name': 'Uniswap'},
+    {'id': 'universe-token', 'symbol': 'uni', 'name': 'Universe Token'},
+]
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Чистая база во временном каталоге (соединение текущего потока переоткрывается)."""
+    database.close_connection()
+    monkeypatch.setattr(database, 'DB_NAME', str(tmp_path / 'portfolio.db'))
+    database.init_db()
+    database.profile_cache.clear()
+    yield database
+    database.close_connection()
+    database.profile_cache.clear()
+
+
+@pytest.fixture
+def coins(monkeypatch):
+    """Справочник монет COINS вместо загрузки из CoinGecko."""
+    monkeypatch.setattr(crypto_api.coin_index, '_index', None)
+    crypto_api.coin_index.load(COINS)
+    return crypto_api.coin_index
+
+
+@pytest.fixture
+def fresh_prices(monkeypatch):
+    """Пустой кэш цен без общего уровня и без чужих запросов в полёте."""
+    cache = PriceCache(1000, ttl=60, stale_ttl=600)
+    flight = SingleFlight()
+    for module in (crypto_api, async_crypto_api):
+        monkeypatch.setattr(module, 'price_cache', cache)
+        monkeypatch.setattr(module, 'price_flight', flight)
+    return cache
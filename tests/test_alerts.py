@@ -0,0 +1,74 @@
+# tests/test_alerts.py
+
+import asyncio
+
+import alerts
+from alerts import ReminderIndex
+
+
+class FakeBot:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text):
+        self.messages.append((chat_id, text))
+
+
+def reminder(id_, target_price, direction):
+    return id_, 1, 'btc', target_price, direction
+
+
+def ids(reminders):
+    return sorted(r[0] for r in reminders)
+
+
+def test_index_thresholds_are_inclusive():
+    index = ReminderIndex([reminder(1, 100.0, 'above'), reminder(2, 200.0, 'above'),
+                           reminder(3, 50.0, 'below'), reminder(4, 80.0, 'below')])
+
+    assert ids(index.triggered('btc', 99.99)) == []
+    assert ids(index.triggered('btc', 100.0)) == [1]
+    assert ids(index.triggered('btc', 200.0)) == [1, 2]
+    assert ids(index.triggered('btc', 80.0)) == [4]
+    assert ids(index.triggered('btc', 50.0)) == [3, 4]
+    assert ids(index.triggered('btc', 80.01)) == []
+    assert index.triggered('eth', 1.0) == []
+
+
+def test_could_trigger_matches_triggered():
+    index = ReminderIndex([reminder(1, 100.0, 'above'), reminder(2, 50.0, 'below')])
+
+    for price in (49.0, 50.0, 50.01, 99.99, 100.0, 101.0):
+        assert index.could_trigger('btc', price) == bool(index.triggered('btc', price))
+    assert not index.could_trigger('eth', 1.0)
+
+
+def test_triggered_reminder_is_sent_once_and_deactivated(monkeypatch, db, coins):
+    async def prices(coin_ids, currencies=('usd',)):
+        return {coin_id: {'usd': 150.0} for coin_id in coin_ids}
+
+    monkeypatch.setattr(alerts, 'get_coin_prices_async', prices)
+    db.add_user(1)
+    db.add_user(2)
+    db.set_reminder(1, 'BTC', 100.0)
+    db.set_reminder(2, 'btc', 200.0)
+    bot = FakeBot()
+
+    assert asyncio.run(alerts.check_reminders(bot)) == 1
+    assert asyncio.run(alerts.check_reminders(bot)) == 0
+
+    assert [chat_id for chat_id, _ in bot.messages] == [1]
+    assert [row[1] for row in db.get_all_active_reminders()] == [2]
+
+
+def test_polling_and_stream_build_the_same_index(db, coins):
+    db.add_user(1)
+    db.set_reminder(1, 'BTC', 100.0)
+    db.set_reminder(1, 'btc', 90.0, 'below')
+
+    index = alerts.load_reminder_index()
+    stream_index, stream_coins = alerts.StreamAlerts._load()
+
+    assert index.coins() == stream_index.coins() == ['btc']
+    assert stream_coins == {'bitcoin': ['btc']}
+    assert len(index) == 2
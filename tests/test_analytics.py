@@ -0,0 +1,97 @@
+# tests/test_analytics.py
+
+import asyncio
+import math
+
+import numpy as np
+import pytest
+
+import analytics
+from analytics import calculate_portfolio, calculate_portfolio_async, calculate_portfolios
+from crypto_api import MarketSnapshot, fx_rates
+
+# Дневные цены: биткоин +10%, −10%, +10%; эфир не меняется
+HISTORY = {
+    'bitcoin': [100.0, 110.0, 99.0, 108.9],
+    'ethereum': [10.0, 10.0, 10.0, 10.0],
+}
+SNAPSHOT = MarketSnapshot({'bitcoin': {'usd': 108.9}, 'ethereum': {'usd': 10.0}})
+
+
+@pytest.fixture
+def history(monkeypatch):
+    """История цен из HISTORY вместо таблицы price_history."""
+    def price_matrix(coin_ids, days, now=None):
+        rows = [HISTORY.get(coin_id, [math.nan] * 4) for coin_id in coin_ids]
+        return np.arange(4), np.array(rows, dtype=float).reshape(len(coin_ids), 4)
+
+    monkeypatch.setattr(analytics, 'get_price_matrix', price_matrix)
+    monkeypatch.setattr(fx_rates, '_rates', {'usd': 1.0, 'eur': 0.5})
+
+
+def test_risk_metrics_by_hand(db, history):
+    db.add_user(1)
+    db.add_transaction(1, 'Bitcoin', 'btc', 1.0, 100.0, 'buy', coin_id='bitcoin')
+
+    metrics = calculate_portfolio(1, SNAPSHOT)['metrics']
+
+    # Доходности 0.1, −0.1, 0.1: среднее 1/30, выборочное стандартное отклонение sqrt(0.04 / 3)
+    std = math.sqrt(0.04 / 3)
+    assert metrics['volatility'] == round(std * math.sqrt(365) * 100, 2)
+    assert metrics['sharpe'] == round(1 / 30 / std * math.sqrt(365), 2)
+    # Пик 110, дно 99: просадка 10%
+    assert metrics['max_drawdown'] == -10.0
+    assert metrics['hhi'] == 1.0
+
+
+def test_flat_series_and_concentration(db, history):
+    db.add_user(1)
+    db.add_transaction(1, 'Bitcoin', 'btc', 1.0, 100.0, 'buy', coin_id='bitcoin')
+    db.add_transaction(1, 'Ethereum', 'eth', 10.0, 10.0, 'buy', coin_id='ethereum')
+    db.add_user(2)
+    db.add_transaction(2, 'Ethereum', 'eth', 1.0, 10.0, 'buy', coin_id='ethereum')
+
+    # Веса 108.9 / 208.9 и 100 / 208.9
+    weights = np.array([108.9, 100.0]) / 208.9
+    assert calculate_portfolio(1, SNAPSHOT)['metrics']['hhi'] == round(float((weights ** 2).sum()), 4)
+    assert calculate_portfolio(2, SNAPSHOT)['metrics'] == {
+        'hhi': 1.0, 'volatility': 0.0, 'max_drawdown': 0.0, 'sharpe': 0.0}
+
+
+def test_risk_metrics_rows_are_independent():
+    values = np.array([HISTORY['bitcoin'], HISTORY['ethereum'], [0.0, 0.0, 5.0, 5.0]])
+
+    risk = analytics._risk_metrics(values)
+
+    np.testing.assert_allclose(risk['max_drawdown'], [-10.0, 0.0, 0.0])
+    assert risk['volatility'][1] == 0.0 and risk['sharpe'][1] == 0.0
+    assert np.isfinite(risk['volatility']).all() and np.isfinite(risk['sharpe']).all()
+
+
+def test_batch_matches_single_user(db, coins, history):
+    trades = {
+        1: [('Bitcoin', 'btc', 1.0, 100.0, 'buy', 'bitcoin')],
+        2: [('Bitcoin', 'btc', 2.0, 90.0, 'buy', 'bitcoin'), ('Ethereum', 'eth', 5.0, 12.0, 'buy', None),
+            ('Bitcoin', 'btc', 0.5, 120.0, 'sell', 'bitcoin')],
+        3: [('Solana', 'sol', 3.0, 50.0, 'buy', 'solana')],  # нет цены в снимке
+        4: [],
+    }
+    for user_id, rows in trades.items():
+        db.add_user(user_id)
+        for coin_name, symbol, amount, price, transaction_type, coin_id in rows:
+            db.add_transaction(user_id, coin_name, symbol, amount, price, transaction_type, coin_id=coin_id)
+    db.set_user_currency(2, 'eur')
+
+    batch = calculate_portfolios(list(trades), SNAPSHOT)
+
+    for user_id in trades:
+        assert batch[user_id] == calculate_portfolio(user_id, SNAPSHOT)
+    assert batch[2]['currency'] == 'eur'
+    assert batch[2]['total']['realized'] == round(0.5 * (120.0 - 90.0) * 0.5, 2)
+
+
+def test_async_matches_sync(db, coins, history):
+    db.add_user(1)
+    db.add_transaction(1, 'Bitcoin', 'btc', 1.0, 100.0, 'buy', coin_id='bitcoin')
+
+    assert asyncio.run(calculate_portfolio_async(1, SNAPSHOT)) == calculate_portfolio(1, SNAPSHOT)
@@ -0,0 +1,121 @@
+# tests/test_async_crypto_api.py
+
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import async_crypto_api
+from async_crypto_api import AsyncCoinGeckoClient
+from metrics import API_RATE_LIMITED
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Паузы между повторами: запоминаются, но не ждутся."""
+    waits = []
+    real_sleep = asyncio.sleep
+
+    async def fake_sleep(delay, *args, **kwargs):
+        if delay:
+            waits.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(asyncio, 'sleep', fake_sleep)
+    return waits
+
+
+def run_against(responses, scenario):
+    """
+    Запускает scenario(client, hits) против локального HTTP-сервера, который
+    по очереди отдаёт responses — (status, headers, body JSON).
+    """
+    hits = []
+
+    async def handler(request):
+        hits.append(dict(request.query))
+        status, headers, body = responses[min(len(hits), len(responses)) - 1]
+        return web.json_response(body, status=status, headers=headers)
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/{tail:.*}', handler)
+        async with TestServer(app) as server:
+            client = AsyncCoinGeckoClient(base_url=str(server.make_url('')), max_retries=2)
+            try:
+                return await scenario(client, hits)
+            finally:
+                await client.close()
+
+    return asyncio.run(main())
+
+
+def test_retries_429_after_retry_after(sleeps):
+    before = API_RATE_LIMITED.value(endpoint='/simple/price')
+    responses = [(429, {'Retry-After': '7'}, {}), (200, {}, {'bitcoin': {'usd': 1.0}})]
+
+    async def scenario(client, hits):
+        return await client.get_price(['bitcoin'], ['usd']), len(hits)
+
+    data, attempts = run_against(responses, scenario)
+
+    assert data == {'bitcoin': {'usd': 1.0}}
+    assert attempts == 2
+    assert sleeps == [7.0]
+    assert API_RATE_LIMITED.value(endpoint='/simple/price') == before + 1
+
+
+def test_5xx_backs_off_exponentially_then_raises(sleeps):
+    async def scenario(client, hits):
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            await client.get('/coins/list')
+        return error.value.status, len(hits)
+
+    status, attempts = run_against([(503, {}, {})], scenario)
+
+    assert status == 503
+    assert attempts == 3
+    assert sleeps == [1.0, 2.0]
+
+
+def test_4xx_is_not_retried(sleeps):
+    async def scenario(client, hits):
+        with pytest.raises(aiohttp.ClientResponseError):
+            await client.get('/coins/unknown')
+        return len(hits)
+
+    assert run_against([(404, {}, {'error': 'not found'})], scenario) == 1
+    assert sleeps == []
+
+
+def test_async_prices_are_batched_and_cached(monkeypatch, fresh_prices, sleeps):
+    coin_ids = [f"coin-{i}" for i in range(300)]
+    batches = []
+
+    async def handler(request):
+        ids = request.query['ids'].split(',')
+        batches.append(len(ids))
+        return web.json_response({coin_id: {'usd': 1.0} for coin_id in ids})
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/simple/price', handler)
+        async with TestServer(app) as server:
+            client = AsyncCoinGeckoClient(base_url=str(server.make_url('')))
+            monkeypatch.setattr(async_crypto_api, 'client', client)
+            try:
+                first = await async_crypto_api.get_coin_prices_async(coin_ids)
+                second = await async_crypto_api.get_coin_prices_async(coin_ids[:10])
+            finally:
+                await client.close()
+            return first, second
+
+    first, second = asyncio.run(main())
+
+    assert sorted(batches) == [50, 250]
+    assert len(first) == 300
+    assert second == {coin_id: {'usd': 1.0} for coin_id in coin_ids[:10]}
+    assert fresh_prices.stats['misses'] == 300
+    assert fresh_prices.stats['hits'] == 10
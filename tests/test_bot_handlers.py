@@ -0,0 +1,125 @@
+# tests/test_bot_handlers.py
+
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+import bot_handlers
+from metrics import HANDLER_LATENCY
+
+
+class FakeMessage:
+    def __init__(self):
+        self.photos = []
+        self.deleted = False
+
+    async def reply_photo(self, photo, caption):
+        self.photos.append((photo, caption))
+
+    async def delete(self):
+        self.deleted = True
+
+
+class FakeQuery:
+    """CallbackQuery, который запоминает ответы бота."""
+
+    def __init__(self, data, user_id=1):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = FakeMessage()
+        self.edits = []
+
+    async def answer(self):
+        pass
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.edits.append(text)
+
+
+def press(data, user_id=1):
+    query = FakeQuery(data, user_id)
+    asyncio.run(bot_handlers.button_handler(SimpleNamespace(callback_query=query), None))
+    return query
+
+
+def test_callback_action_labels_are_bounded():
+    assert bot_handlers._callback_action('portfolio') == 'portfolio'
+    assert bot_handlers._callback_action('value_chart') == 'value_chart'
+    assert bot_handlers._callback_action('value_chart_365') == 'value_chart'
+    assert bot_handlers._callback_action('history_older_2024-01-31_42') == 'history_older'
+    assert bot_handlers._callback_action('cost_method_fifo') == 'cost_method'
+    assert bot_handlers._callback_action('currency_eur') == 'currency'
+    # Произвольные данные от клиента не порождают новых меток
+    for data in ('currency', 'portfolio_x', 'abc123', 'coin_7', '', None, 'x' * 64):
+        assert bot_handlers._callback_action(data) == 'unknown'
+
+
+def test_button_handler_observes_bounded_label(monkeypatch):
+    async def handle(update, context):
+        return 'handled'
+
+    monkeypatch.setattr(bot_handlers, '_handle_button', handle)
+    before = HANDLER_LATENCY.count(action='unknown')
+
+    for data in ('forged_1', 'forged_2', 'forged_3'):
+        update = SimpleNamespace(callback_query=SimpleNamespace(data=data))
+        assert asyncio.run(bot_handlers.button_handler(update, None)) == 'handled'
+
+    assert HANDLER_LATENCY.count(action='unknown') == before + 3
+    assert HANDLER_LATENCY.count(action='forged') == 0
+
+
+def test_value_chart_series_is_computed_off_the_event_loop(monkeypatch, db):
+    threads = []
+
+    def series(user_id, days):
+        threads.append(threading.get_ident())
+        return np.arange(3), np.array([1.0, 2.0, 3.0])
+
+    async def no_rates():
+        pass
+
+    async def render(timestamps, values, days, currency):
+        return b'png'
+
+    monkeypatch.setattr(bot_handlers, 'portfolio_value_series', series)
+    monkeypatch.setattr(bot_handlers, 'ensure_fx_rates', no_rates)
+    monkeypatch.setattr(bot_handlers, 'render_value_chart', render)
+
+    query = press('value_chart_30')
+
+    assert query.message.photos == [(b'png', "📈 Стоимость портфеля за 30 дн.")]
+    assert threads and threads[0] != threading.get_ident()
+
+
+def test_currency_without_rate_is_rejected(monkeypatch, db):
+    monkeypatch.setattr(bot_handlers.fx_rates, '_rates', {'usd': 1.0, 'eur': 0.5})
+    db.add_user(1)
+
+    rejected = press('currency_rub')
+    assert rejected.edits[0].startswith("❌")
+    assert db.get_user_currency(1) == 'usd'
+
+    unsupported = press('currency_xyz')
+    assert unsupported.edits[0].startswith("❌")
+    assert db.get_user_currency(1) == 'usd'
+
+    accepted = press('currency_eur')
+    assert accepted.edits[0].startswith("✅ Валюта отображения: EUR")
+    assert db.get_user_currency(1) == 'eur'
+
+
+def test_settings_screen_reads_profile_from_cache(monkeypatch, db):
+    monkeypatch.setattr(bot_handlers.fx_rates, '_rates', {'usd': 1.0, 'eur': 0.5})
+    db.add_user(1)
+    db.set_cost_method(1, 'fifo')
+    press('settings')
+    misses = db.profile_cache.stats['misses']
+
+    query = press('settings')
+
+    assert db.profile_cache.stats['misses'] == misses
+    assert "Валюта отображения: USD" in query.edits[0]
+    assert bot_handlers.COST_METHOD_NAMES['fifo'] in query.edits[0]
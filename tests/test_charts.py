@@ -0,0 +1,73 @@
+# tests/test_charts.py
+
+import asyncio
+import os
+import threading
+import time
+
+import charts
+from chart_cache import ChartCache
+
+
+def _spilled_files(path):
+    return sorted(name for name in os.listdir(path) if name.endswith('.png'))
+
+
+def test_spill_dir_is_capped(tmp_path):
+    cache = ChartCache(max_bytes=10, spill_dir=str(tmp_path), spill_max_bytes=25)
+    for i in range(6):
+        cache.put(f"k{i}", bytes(10))
+
+    # В памяти последняя картинка, на диске — не больше двух файлов по 10 байт
+    assert _spilled_files(tmp_path) == ['k3.png', 'k4.png']
+    assert cache.info()['spilled_bytes'] == 20
+    assert cache.stats['spill_evictions'] == 3
+
+
+def test_disk_hit_keeps_file_and_refreshes_its_age(tmp_path):
+    cache = ChartCache(max_bytes=10, spill_dir=str(tmp_path), spill_max_bytes=25)
+    for i in range(3):
+        cache.put(f"k{i}", bytes(10))
+
+    assert cache.get('k0') == bytes(10)
+    cache.put('k3', bytes(10))
+
+    # k0 недавно читали — вытеснен k1
+    assert _spilled_files(tmp_path) == ['k0.png', 'k2.png']
+    assert cache.stats['disk_hits'] == 1
+
+
+def test_existing_spill_files_are_counted_on_start(tmp_path):
+    for i in range(4):
+        path = tmp_path / f"k{i}.png"
+        path.write_bytes(bytes(10))
+        os.utime(path, (i, i))
+
+    cache = ChartCache(max_bytes=10, spill_dir=str(tmp_path), spill_max_bytes=25)
+
+    assert _spilled_files(tmp_path) == ['k2.png', 'k3.png']
+    assert cache.info()['spilled'] == 2
+
+
+def test_concurrent_renders_of_same_chart_are_coalesced(monkeypatch):
+    cache = ChartCache(max_bytes=1024)
+    renders = []
+
+    def slow_render(labels, sizes):
+        renders.append(threading.get_ident())
+        time.sleep(0.05)
+        return b'png'
+
+    monkeypatch.setattr(charts, 'chart_cache', cache)
+    monkeypatch.setattr(charts, '_render_pie_png', slow_render)
+    monkeypatch.setattr(charts, 'start_chart_pool', lambda: None)
+
+    async def main():
+        return await asyncio.gather(*(charts._render_pie_cached(['BTC'], [1000]) for _ in range(5)))
+
+    results = asyncio.run(main())
+
+    assert len(renders) == 1
+    assert {png for _, png in results} == {b'png'}
+    assert cache.stats['coalesced'] == 4
+    assert charts._renders == {}
@@ -0,0 +1,124 @@
+# tests/test_crypto_api.py
+
+import threading
+import time
+
+import crypto_api
+from analytics import calculate_portfolio
+
+
+class FakeCoinGecko:
+    """Заглушка CoinGeckoAPI: отвечает на get_price ценами из prices и запоминает запросы."""
+
+    def __init__(self, prices, fail_on=()):
+        self.prices = prices
+        self.fail_on = set(fail_on)
+        self.calls = []
+
+    def get_price(self, ids, vs_currencies):
+        self.calls.append(list(ids))
+        if self.fail_on & set(ids):
+            raise ValueError({'status': {'error_code': 429, 'error_message': 'rate limited'}})
+        return {coin_id: {c: self.prices[coin_id] for c in vs_currencies}
+                for coin_id in ids if coin_id in self.prices}
+
+
+def test_misses_are_fetched_in_batches(monkeypatch, fresh_prices):
+    coin_ids = [f"coin-{i}" for i in range(600)]
+    fake = FakeCoinGecko({coin_id: float(i) for i, coin_id in enumerate(coin_ids)})
+    monkeypatch.setattr(crypto_api, 'cg', fake)
+
+    prices = crypto_api.get_coin_prices(coin_ids)
+
+    assert [len(batch) for batch in fake.calls] == [250, 250, 100]
+    assert len(prices) == 600
+    assert prices['coin-42'] == {'usd': 42.0}
+
+
+def test_cached_prices_are_not_requested_again(monkeypatch, fresh_prices):
+    fake = FakeCoinGecko({'bitcoin': 100.0, 'ethereum': 10.0, 'solana': 1.0})
+    monkeypatch.setattr(crypto_api, 'cg', fake)
+
+    crypto_api.get_coin_prices(['bitcoin', 'ethereum'])
+    prices = crypto_api.get_coin_prices(['BITCOIN', 'ethereum', 'solana'])
+
+    assert fake.calls == [['bitcoin', 'ethereum'], ['solana']]
+    assert prices == {'bitcoin': {'usd': 100.0}, 'ethereum': {'usd': 10.0}, 'solana': {'usd': 1.0}}
+
+
+def test_failed_batch_does_not_drop_the_others(monkeypatch, fresh_prices):
+    coin_ids = [f"coin-{i}" for i in range(300)]
+    fake = FakeCoinGecko({coin_id: 1.0 for coin_id in coin_ids}, fail_on={'coin-0'})
+    monkeypatch.setattr(crypto_api, 'cg', fake)
+
+    prices = crypto_api.get_coin_prices(coin_ids)
+
+    assert len(fake.calls) == 2
+    assert set(prices) == set(coin_ids[250:])
+    assert fresh_prices.stats['fetch_errors'] == 1
+
+
+def test_calculate_portfolio_uses_one_request(monkeypatch, db, coins, fresh_prices):
+    fake = FakeCoinGecko({'bitcoin': 30000.0, 'ethereum': 2000.0, 'solana': 100.0})
+    monkeypatch.setattr(crypto_api, 'cg', fake)
+    db.add_user(1)
+    db.add_transaction(1, 'Bitcoin', 'btc', 0.5, 20000.0, 'buy')
+    db.add_transaction(1, 'Ethereum', 'eth', 2.0, 1000.0, 'buy')
+    db.add_transaction(1, 'Solana', 'sol', 10.0, 50.0, 'buy')
+
+    data = calculate_portfolio(1, currency='usd')
+
+    assert len(fake.calls) == 1
+    assert sorted(fake.calls[0]) == ['bitcoin', 'ethereum', 'solana']
+    assert data['total']['invested'] == 10000 + 2000 + 500
+    assert data['total']['current'] == 15000 + 4000 + 1000
+
+
+def test_stale_prices_are_refreshed_unless_ingested(monkeypatch, fresh_prices):
+    refreshed = []
+    monkeypatch.setattr(crypto_api, '_refresh_in_background', lambda coin_ids, _: refreshed.extend(coin_ids))
+    monkeypatch.setattr(crypto_api, '_ingested_coins', frozenset())
+    fresh_prices.store({'bitcoin': {'usd': 1.0}, 'ethereum': {'usd': 2.0}}, ['usd'], time.time() - 120)
+    crypto_api.set_ingested_coins(['bitcoin'])
+
+    prices = crypto_api.get_coin_prices(['bitcoin', 'ethereum'])
+
+    assert prices == {'bitcoin': {'usd': 1.0}, 'ethereum': {'usd': 2.0}}
+    assert refreshed == ['ethereum']
+
+
+def test_snapshot_lookup_ignores_case():
+    snapshot = crypto_api.MarketSnapshot({'bitcoin': {'usd': 100.0}})
+
+    assert snapshot.get('Bitcoin') == 100.0
+    assert snapshot.get('BITCOIN', 'eur') is None
+    assert snapshot.get('ethereum') is None
+
+
+def test_stale_burst_is_refreshed_once_in_the_pool(monkeypatch, fresh_prices):
+    release = threading.Event()
+
+    class SlowCoinGecko(FakeCoinGecko):
+        def get_price(self, ids, vs_currencies):
+            release.wait(5)
+            return super().get_price(ids, vs_currencies)
+
+    fake = SlowCoinGecko({'bitcoin': 2.0, 'ethereum': 3.0})
+    monkeypatch.setattr(crypto_api, 'cg', fake)
+    monkeypatch.setattr(crypto_api, '_ingested_coins', frozenset())
+    fresh_prices.store({'bitcoin': {'usd': 1.0}, 'ethereum': {'usd': 1.0}}, ['usd'], time.time() - 120)
+    threads = threading.active_count()
+
+    for _ in range(50):
+        assert crypto_api.get_coin_prices(['bitcoin', 'ethereum']) == {
+            'bitcoin': {'usd': 1.0}, 'ethereum': {'usd': 1.0}}
+    assert threading.active_count() <= threads + crypto_api.PRICE_REFRESH_WORKERS
+
+    release.set()
+    deadline = time.time() + 5
+    while fresh_prices.peek(['ethereum'])['ethereum'][0] != {'usd': 3.0} and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert fake.calls == [['bitcoin', 'ethereum']]
+    assert fresh_prices.stats['refreshes'] == 2
+    assert crypto_api.get_coin_prices(['bitcoin']) == {'bitcoin': {'usd': 2.0}}
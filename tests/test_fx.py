@@ -0,0 +1,79 @@
+# tests/test_fx.py
+
+import pytest
+
+import analytics
+from crypto_api import fx_rates
+from fx import FxRates
+
+# Ответ /exchange_rates: курсы даны к BTC
+EXCHANGE_RATES = {'rates': {
+    'btc': {'value': 1.0, 'type': 'crypto'},
+    'eth': {'value': 20.0, 'type': 'crypto'},
+    'usd': {'value': 50000.0, 'type': 'fiat'},
+    'eur': {'value': 45000.0, 'type': 'fiat'},
+    'rub': {'value': 4500000.0, 'type': 'fiat'},
+    'uah': {'value': 0, 'type': 'fiat'},
+}}
+
+
+def failing_loader():
+    raise ConnectionError('API недоступен')
+
+
+def test_cross_rates_to_usd():
+    rates = FxRates(lambda: EXCHANGE_RATES)
+
+    assert rates.rate('EUR') == pytest.approx(0.9)
+    assert rates.rate('rub') == pytest.approx(90.0)
+    assert rates.convert(100.0, 'eur') == pytest.approx(90.0)
+    # Криптовалюты и нулевые курсы в таблицу не попадают
+    assert rates.rate('eth') is None
+    assert rates.rate('uah') is None
+    assert rates.convert(100.0, 'uah') is None
+    assert rates.available(['usd', 'eur', 'uah', 'tjs']) == ['usd', 'eur']
+
+
+def test_manual_rates_extend_and_override_api():
+    rates = FxRates(lambda: EXCHANGE_RATES, {'TJS': 11.0, 'eur': 0.95})
+
+    assert rates.rate('tjs') == 11.0
+    assert rates.rate('eur') == 0.95
+
+
+def test_manual_rates_are_the_fallback_without_api():
+    rates = FxRates(failing_loader, {'tjs': 11.0})
+
+    assert rates.rate('usd') == 1.0
+    assert rates.rate('tjs') == 11.0
+    assert rates.rate('eur') is None
+    assert rates.loaded
+
+
+def test_failed_refresh_keeps_previous_rates():
+    responses = [EXCHANGE_RATES]
+
+    def loader():
+        if not responses:
+            raise ConnectionError('API недоступен')
+        return responses.pop()
+
+    rates = FxRates(loader)
+    rates.ensure_loaded()
+
+    assert rates.refresh() is False
+    assert rates.rate('eur') == pytest.approx(0.9)
+
+
+def test_missing_rate_falls_back_to_usd(monkeypatch):
+    monkeypatch.setattr(fx_rates, '_rates', {'usd': 1.0, 'eur': 0.5})
+    asset = ('btc', 1.0, 100.0, 200.0, 100.0, 200.0, 100.0, 100.0, 1.0)
+
+    in_eur = analytics._build_result([asset], analytics._empty_risk(), 10.0, 'EUR')
+    in_unknown = analytics._build_result([asset], analytics._empty_risk(), 10.0, 'rub')
+
+    assert in_eur['currency'] == 'eur'
+    assert (in_eur['total']['current'], in_eur['total']['realized']) == (100.0, 5.0)
+    assert in_eur['assets'][0]['current_price'] == 100.0
+    assert in_unknown['currency'] == 'usd'
+    assert (in_unknown['total']['current'], in_unknown['total']['realized']) == (200.0, 10.0)
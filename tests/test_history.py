@@ -0,0 +1,85 @@
+# tests/test_history.py
+
+import csv
+import io
+
+import pytest
+
+import exporter
+from importer import import_csv
+
+D1, D2, D3 = '2024-01-01 10:00:00', '2024-01-02 10:00:00', '2024-01-03 10:00:00'
+
+
+@pytest.fixture
+def history(db, coins):
+    """Семь сделок: по три с одинаковыми датами, id не совпадают с порядком дат."""
+    db.add_user(1)
+    trades = [(D2, 'btc'), (D1, 'eth'), (D2, 'eth'), (D1, 'btc'), (D3, 'btc'), (D2, 'btc'), (D1, 'eth')]
+    names = {'btc': 'Bitcoin', 'eth': 'Ethereum'}
+    with db.transaction() as cursor:
+        cursor.executemany(
+            "INSERT INTO transactions (user_id, coin_name, symbol, amount, price, type, date, exchange) "
+            "VALUES (1, ?, ?, ?, ?, 'buy', ?, 'Kraken')",
+            [(names[symbol], symbol, i + 1.0, 100.0 * (i + 1), date) for i, (date, symbol) in enumerate(trades)])
+    # От новых к старым: дата по убыванию, при равной — id по убыванию
+    return [5, 6, 3, 1, 7, 4, 2]
+
+
+def page(db, limit, cursor=None, direction='older'):
+    rows, has_more = db.get_transactions_page(1, limit, cursor, direction)
+    return [row[0] for row in rows], has_more
+
+
+def key(db, tx_id):
+    """Курсор (date, id) сделки."""
+    return db.get_connection().execute("SELECT date, id FROM transactions WHERE id = ?", (tx_id,)).fetchone()
+
+
+def test_older_pages_split_rows_with_equal_dates(db, history):
+    assert page(db, 3) == ([5, 6, 3], True)
+    assert page(db, 3, key(db, 3)) == ([1, 7, 4], True)
+    assert page(db, 3, key(db, 4)) == ([2], False)
+
+
+def test_newer_pages_return_to_the_start(db, history):
+    assert page(db, 3, key(db, 2), 'newer') == ([1, 7, 4], True)
+    assert page(db, 3, key(db, 1), 'newer') == ([5, 6, 3], False)
+    assert page(db, 3, key(db, 5), 'newer') == ([], False)
+
+
+def test_has_more_at_the_edges(db, history):
+    assert page(db, 7) == (history, False)
+    assert page(db, 6) == (history[:6], True)
+    assert page(db, 1, key(db, 2)) == ([], False)
+    assert db.get_transactions_page(2, 3) == ([], False)
+
+
+def test_iter_transactions_reads_in_batches(db, history):
+    assert [row[0] for row in db.iter_transactions(1, batch_size=2, newest_first=True)] == history
+    assert [row[0] for row in db.iter_transactions(1, batch_size=2)] == history[::-1]
+    all_transactions = db.get_all_transactions(1)
+    assert isinstance(all_transactions, list)
+    assert [row[0] for row in all_transactions] == history
+
+
+def test_export_round_trips_through_generic_import(monkeypatch, db, history):
+    monkeypatch.setattr(exporter, 'EXPORT_BATCH_ROWS', 2)
+
+    chunks = list(exporter.iter_csv_chunks(1))
+    text = ''.join(chunks)
+    rows = list(csv.reader(io.StringIO(text)))
+
+    assert len(chunks) == 4
+    assert chunks[0].startswith(','.join(exporter.EXPORT_HEADER) + '\n')
+    assert rows[0] == list(exporter.EXPORT_HEADER)
+    assert [int(row[-1]) for row in rows[1:]] == history[::-1]
+
+    stats = import_csv(2, io.BytesIO(text.encode('utf-8')))
+
+    assert (stats['format'], stats['imported'], stats['skipped']) == ('generic', 7, 0)
+
+    def trades(user_id):
+        return sorted(row[1:] for row in db.iter_transactions(user_id))
+
+    assert trades(2) == trades(1)
@@ -0,0 +1,93 @@
+# tests/test_holdings.py
+
+import asyncio
+from types import SimpleNamespace
+
+import bot_handlers
+import crypto_api
+from analytics import calculate_portfolio, calculate_portfolios
+from crypto_api import MarketSnapshot
+
+PRICES = {'uniswap': {'usd': 5.0}, 'universe-token': {'usd': 0.01}}
+
+
+def test_chosen_coin_id_is_kept_for_ambiguous_symbol(db, coins):
+    db.add_user(1)
+    db.add_transaction(1, 'Universe Token', 'uni', 100.0, 0.02, 'buy', coin_id='universe-token')
+
+    assert db.get_portfolio(1) == [('uni', 100.0, 0.02, 'universe-token')]
+    data = calculate_portfolio(1, MarketSnapshot(PRICES), currency='usd')
+    assert data['assets'][0]['current_price'] == 0.01
+
+
+def test_trades_without_coin_id_resolve_by_symbol(db, coins):
+    db.add_user(1)
+    db.add_transaction(1, 'Uniswap', 'uni', 10.0, 4.0, 'buy')
+
+    assert db.get_portfolio(1)[0][3] is None
+    assert crypto_api.coin_id_of('uni') == 'uniswap'
+    data = calculate_portfolio(1, MarketSnapshot(PRICES), currency='usd')
+    assert data['assets'][0]['current_price'] == 5.0
+
+
+def test_coin_id_survives_rebuild_and_later_trades(db, coins):
+    db.add_user(1)
+    db.add_user(2)
+    db.add_transaction(1, 'Universe Token', 'uni', 100.0, 0.02, 'buy', coin_id='universe-token')
+    # Старые клиенты без coin_id не затирают уже выбранную монету
+    db.add_transaction(1, 'Universe Token', 'uni', 50.0, 0.01, 'sell')
+    db.add_transaction(2, 'Uniswap', 'uni', 10.0, 4.0, 'buy', coin_id='uniswap')
+    db.set_cost_method(1, 'fifo')
+
+    assert db.get_portfolio(1)[0][3] == 'universe-token'
+    results = calculate_portfolios([1, 2], MarketSnapshot(PRICES))
+    assert results[1]['assets'][0]['current_price'] == 0.01
+    assert results[2]['assets'][0]['current_price'] == 5.0
+
+
+def test_report_coins_and_popularity_keep_coin_ids(db, coins):
+    db.add_user(1)
+    db.add_user(2)
+    db.add_transaction(1, 'Universe Token', 'uni', 100.0, 0.02, 'buy', coin_id='universe-token')
+    db.add_transaction(2, 'Uniswap', 'uni', 10.0, 4.0, 'buy', coin_id='uniswap')
+
+    assert sorted(db.get_report_coins('daily')) == [('uni', 'uniswap'), ('uni', 'universe-token')]
+    assert sorted(db.get_coin_popularity()) == [('uni', 'uniswap', 1), ('uni', 'universe-token', 1)]
+
+
+class FakeMessage:
+    def __init__(self, text=''):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, reply_markup=None):
+        self.replies.append((text, reply_markup))
+
+
+class FakeQuery:
+    def __init__(self, data):
+        self.data = data
+        self.edits = []
+
+    async def answer(self):
+        pass
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.edits.append((text, reply_markup))
+
+
+def test_ambiguous_coin_can_be_switched_before_saving(db, coins):
+    context = SimpleNamespace(user_data={'transaction_type': 'buy'})
+    message = FakeMessage('uni')
+    state = asyncio.run(bot_handlers.handle_coin_input(SimpleNamespace(message=message), context))
+
+    assert state == bot_handlers.ENTER_AMOUNT_OR_VALUE
+    assert context.user_data['coin_id'] == 'uniswap'
+    [[button]] = message.replies[0][1].inline_keyboard
+    assert 'universe-token' in button.text
+
+    query = FakeQuery(button.callback_data)
+    asyncio.run(bot_handlers.handle_coin_choice(SimpleNamespace(callback_query=query), context))
+
+    assert context.user_data['coin_id'] == 'universe-token'
+    assert context.user_data['symbol'] == 'uni'
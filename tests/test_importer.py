@@ -0,0 +1,82 @@
+# tests/test_importer.py
+
+import io
+
+import pytest
+
+from importer import CSVFormatError, _detect_format, _parse_number, _split_pair, import_csv
+
+BINANCE = """Date(UTC),Pair,Side,Price,Executed,Amount,Fee
+2024-01-02 10:00:00,BTCUSDT,BUY,"30,000.5",0.5BTC,15000.25USDT,0.001BTC
+2024-01-03 10:00:00,ETHBTC,SELL,0.05,1ETH,0.05BTC,0.0001BTC
+2024-01-04 10:00:00,SOLUSD,BUY,100,2SOL,200USD,0
+"""
+
+BYBIT = """Spot Pairs,Order Type,Direction,Filled Value,Filled Price,Filled Quantity,Fees,Transaction ID,Timestamp (UTC)
+BTCUSDT,MARKET,BUY,3000,30000,0.1,0,T-1,2024-01-02 10:00:00
+BTCUSDT,MARKET,SELL,1600,32000,0.05,0,T-2,2024-01-05 10:00:00
+"""
+
+GENERIC = """date;symbol;type;amount;price;exchange
+02.01.2024 10:00;eth;buy;1 234,5;2000;Kraken
+02.01.2024 10:00;eth;buy;1 234,5;2000;Kraken
+"""
+
+
+def csv_file(text):
+    return io.BytesIO(text.encode('utf-8'))
+
+
+@pytest.mark.parametrize('header, expected', [
+    (['Date(UTC)', 'Pair', 'Side', 'Price', 'Executed', 'Amount', 'Fee'], 'binance'),
+    (['Spot Pairs', 'Order Type', 'Direction', 'Filled Price', 'Filled Quantity', 'Timestamp (UTC)'], 'bybit'),
+    (['Date', 'Symbol', 'Type', 'Amount', 'Price'], 'generic'),
+])
+def test_format_is_detected_by_header(header, expected):
+    assert _detect_format(header)[0] == expected
+
+
+def test_unknown_header_is_rejected():
+    with pytest.raises(CSVFormatError):
+        _detect_format(['when', 'what', 'how much'])
+
+
+def test_split_pair():
+    assert _split_pair('BTCUSDT') == ('BTC', 'USDT')
+    assert _split_pair('BTCUSD') == ('BTC', 'USD')
+    assert _split_pair('eth/btc') == ('ETH', 'BTC')
+    assert _split_pair('sol') == ('SOL', '')
+
+
+def test_parse_number():
+    assert _parse_number('1 234,5') == 1234.5
+    assert _parse_number('0.5BTC') == 0.5
+    assert _parse_number('1,234.5 USDT') == 1234.5
+    with pytest.raises(ValueError):
+        _parse_number('BTC')
+
+
+def test_binance_import_skips_non_usd_quotes(db, coins):
+    stats = import_csv(1, csv_file(BINANCE))
+
+    assert (stats['format'], stats['rows'], stats['imported'], stats['skipped']) == ('binance', 3, 2, 1)
+    assert stats['non_usd'] == {'ETH/BTC'}
+    assert sorted(db.get_portfolio(1)) == [('btc', 0.5, 30000.5, 'bitcoin'), ('sol', 2.0, 100.0, 'solana')]
+
+
+def test_reimport_adds_nothing(db, coins):
+    assert import_csv(1, csv_file(BYBIT))['imported'] == 2
+
+    stats = import_csv(1, csv_file(BYBIT))
+
+    assert (stats['imported'], stats['duplicates']) == (0, 2)
+    assert db.get_portfolio(1) == [('btc', 0.05, 30000.0, 'bitcoin')]
+
+
+def test_identical_rows_without_trade_id_are_two_trades(db, coins):
+    stats = import_csv(1, csv_file(GENERIC))
+
+    assert (stats['format'], stats['imported']) == ('generic', 2)
+    assert db.get_portfolio(1) == [('eth', 2469.0, 2000.0, 'ethereum')]
+    # Повторный импорт того же файла получает те же ключи
+    assert import_csv(1, csv_file(GENERIC))['imported'] == 0
@@ -0,0 +1,76 @@
+# tests/test_metrics.py
+
+import urllib.error
+import urllib.request
+
+import pytest
+
+from metrics import Registry, registry, start_metrics_server
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Registry('test').histogram('latency_seconds', "Задержка", ('endpoint',), buckets=(0.1, 1.0))
+
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, endpoint='price')
+    histogram.observe(2.0, endpoint='markets')
+
+    lines = histogram.render()
+
+    assert lines[:5] == [
+        'test_latency_seconds_bucket{endpoint="price",le="0.1"} 2',
+        'test_latency_seconds_bucket{endpoint="price",le="1.0"} 3',
+        'test_latency_seconds_bucket{endpoint="price",le="+Inf"} 4',
+        'test_latency_seconds_sum{endpoint="price"} 3.65',
+        'test_latency_seconds_count{endpoint="price"} 4',
+    ]
+    assert 'test_latency_seconds_bucket{endpoint="markets",le="1.0"} 0' in lines
+    assert 'test_latency_seconds_bucket{endpoint="markets",le="+Inf"} 1' in lines
+    assert histogram.count(endpoint='price') == 4
+
+
+def test_registry_renders_help_type_and_infos():
+    metrics = Registry('test')
+    metrics.counter('errors_total', "Ошибки", ('status',)).inc(status='429')
+    metrics.histogram('latency_seconds', "Задержка", buckets=(1.0,)).observe(0.5)
+    metrics.register_info('cache', lambda: {'size': 3, 'enabled': True, 'name': 'prices'})
+
+    assert metrics.render() == (
+        '# HELP test_errors_total Ошибки\n'
+        '# TYPE test_errors_total counter\n'
+        'test_errors_total{status="429"} 1\n'
+        '# HELP test_latency_seconds Задержка\n'
+        '# TYPE test_latency_seconds histogram\n'
+        'test_latency_seconds_bucket{le="1.0"} 1\n'
+        'test_latency_seconds_bucket{le="+Inf"} 1\n'
+        'test_latency_seconds_sum 0.5\n'
+        'test_latency_seconds_count 1\n'
+        '# TYPE test_cache_size gauge\n'
+        'test_cache_size 3\n'
+        '# TYPE test_cache_enabled gauge\n'
+        'test_cache_enabled 1\n'
+    )
+
+
+@pytest.fixture
+def server():
+    server = start_metrics_server('127.0.0.1', 0)
+    assert server is not None
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_metrics_endpoint_serves_prometheus_text(server):
+    with urllib.request.urlopen(f"{server}/metrics", timeout=5) as response:
+        content_type = response.headers['Content-Type']
+        body = response.read().decode('utf-8')
+
+    assert content_type == 'text/plain; version=0.0.4; charset=utf-8'
+    assert body == registry.render()
+    assert '# TYPE bot_api_request_seconds histogram\n' in body
+    assert body.endswith('\n')
+
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(f"{server}/nothing", timeout=5)
+    assert error.value.code == 404
@@ -0,0 +1,69 @@
+# tests/test_migrations.py
+
+import pytest
+
+import database
+
+
+def _create_at_version(version):
+    """Схема как после миграции version (без пересчёта holdings)."""
+    with database.transaction() as cursor:
+        for number, steps in database.MIGRATIONS:
+            if number > version:
+                break
+            for step in steps:
+                if step == database.REBUILD_HOLDINGS:
+                    continue
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+        cursor.execute(f"PRAGMA user_version = {version}")
+
+
+@pytest.fixture
+def old_db(tmp_path, monkeypatch):
+    database.close_connection()
+    monkeypatch.setattr(database, 'DB_NAME', str(tmp_path / 'old.db'))
+    database.profile_cache.clear()
+    yield
+    database.close_connection()
+
+
+def _add_trades(cursor):
+    cursor.execute("INSERT INTO users (user_id) VALUES (1)")
+    cursor.executemany(
+        "INSERT INTO transactions (user_id, coin_name, symbol, amount, price, type) VALUES (1, ?, ?, ?, ?, ?)",
+        [('Bitcoin', 'btc', 2.0, 100.0, 'buy'), ('Bitcoin', 'btc', 1.0, 200.0, 'buy'),
+         ('Bitcoin', 'btc', 1.5, 300.0, 'sell')])
+
+
+def test_upgrade_from_v2_backfills_holdings(old_db):
+    _create_at_version(2)
+    with database.transaction() as cursor:
+        _add_trades(cursor)
+
+    database.init_db()
+
+    assert database.get_schema_version() == database.MIGRATIONS[-1][0]
+    assert database.verify_holdings() == []
+    quantity, cost_basis, realized = database.get_holdings(1)[0][1:]
+    assert (quantity, cost_basis, realized) == (1.5, 200.0, 1.5 * (300.0 - 400.0 / 3))
+    # Лоты и контрольная точка заполнены: новая сделка не повторяет историю
+    database.add_transaction(1, 'Bitcoin', 'btc', 0.5, 100.0, 'buy')
+    assert database.verify_holdings() == []
+
+
+def test_upgrade_from_v5_fills_lots(old_db):
+    _create_at_version(5)
+    with database.transaction() as cursor:
+        _add_trades(cursor)
+        # Позиция, заполненная старой миграцией 3 (средняя цена, без лотов)
+        cursor.execute("INSERT INTO holdings (user_id, symbol, quantity, cost_basis, realized_pnl) "
+                       "VALUES (1, 'btc', 1.5, 200.0, 100.0)")
+
+    database.init_db()
+
+    database.add_transaction(1, 'Bitcoin', 'btc', 0.5, 100.0, 'buy')
+    assert database.verify_holdings() == []
+    assert database.get_holdings(1)[0][1] == 2.0
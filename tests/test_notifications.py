@@ -0,0 +1,102 @@
+# tests/test_notifications.py
+
+import asyncio
+import io
+from datetime import timedelta
+
+import pytest
+from telegram.error import Forbidden, RetryAfter, TimedOut
+
+import notifications
+from crypto_api import MarketSnapshot
+
+
+class FakeBot:
+    """Бот, который запоминает время отправок и бросает заданные ошибки."""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.sent = []
+        self.calls = []
+
+    async def send_photo(self, chat_id, photo, caption):
+        self.calls.append((chat_id, asyncio.get_running_loop().time()))
+        errors = self.errors.get(chat_id)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append(chat_id)
+        return None
+
+
+@pytest.fixture
+def recipients(db, coins, monkeypatch):
+    """Пять пользователей с биткоином; снимок цен и графики без сети."""
+    for user_id in range(1, 6):
+        db.add_user(user_id)
+        db.add_transaction(user_id, 'Bitcoin', 'btc', 1.0, 100.0, 'buy', coin_id='bitcoin')
+
+    async def snapshot(report):
+        return MarketSnapshot({'bitcoin': {'usd': 200.0}})
+
+    async def chart(data):
+        return 'chart', io.BytesIO(b'png')
+
+    monkeypatch.setattr(notifications, 'take_report_snapshot', snapshot)
+    monkeypatch.setattr(notifications, 'get_portfolio_chart', chart)
+    monkeypatch.setattr(notifications, 'BROADCAST_RATE', 100)
+    return list(range(1, 6))
+
+
+def broadcast(bot):
+    return asyncio.run(notifications.broadcast_report('daily', bot))
+
+
+def test_sends_are_spaced_by_rate_limit(recipients):
+    bot = FakeBot()
+
+    stats = broadcast(bot)
+
+    assert stats['sent'] == 5
+    assert sorted(bot.sent) == recipients
+    # Слоты идут по расписанию: пять отправок при 100 в секунду занимают не меньше 40 мс
+    times = sorted(at for _, at in bot.calls)
+    assert times[-1] - times[0] >= 0.04 - 1e-3
+
+
+def test_retry_after_pauses_all_sends_and_retries(recipients):
+    bot = FakeBot({1: [RetryAfter(timedelta(milliseconds=100))]})
+
+    stats = broadcast(bot)
+
+    assert stats['sent'] == 5
+    assert stats['retries'] == 1
+    first_at = bot.calls[0][1]
+    assert [chat_id for chat_id, _ in bot.calls].count(1) == 2
+    assert all(at - first_at >= 0.1 - 1e-3 for _, at in bot.calls[1:])
+
+
+def test_forbidden_is_not_retried(recipients):
+    bot = FakeBot({2: [Forbidden('bot was blocked by the user')]})
+
+    stats = broadcast(bot)
+
+    assert (stats['sent'], stats['failed'], stats['retries']) == (4, 1, 0)
+    assert [chat_id for chat_id, _ in bot.calls].count(2) == 1
+
+
+def test_timeout_is_not_retried_to_avoid_duplicates(recipients):
+    bot = FakeBot({3: [TimedOut()]})
+
+    stats = broadcast(bot)
+
+    assert (stats['sent'], stats['unknown'], stats['retries']) == (4, 1, 0)
+    assert [chat_id for chat_id, _ in bot.calls].count(3) == 1
+
+
+def test_unexpected_error_does_not_abort_broadcast(recipients):
+    bot = FakeBot({4: [RuntimeError('boom')]})
+
+    stats = broadcast(bot)
+
+    assert (stats['sent'], stats['failed']) == (4, 1)
+    assert 'elapsed' in stats
@@ -0,0 +1,87 @@
+# tests/test_persistence.py
+
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+from persistence import SQLitePersistence
+
+
+class FlakyWrite:
+    """Подменяет SQLitePersistence._write: первые failures вызовов падают."""
+
+    def __init__(self, persistence, failures):
+        self.write = persistence._write
+        self.failures = failures
+        self.threads = set()
+
+    def __call__(self, users, conversations):
+        self.threads.add(threading.get_ident())
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError('database is locked')
+        self.write(users, conversations)
+
+
+@pytest.fixture
+def persistence(tmp_path):
+    return SQLitePersistence(str(tmp_path / 'persistence.db'))
+
+
+def _saved_user_data(persistence):
+    return dict(persistence._connection().execute("SELECT user_id, data FROM user_data").fetchall())
+
+
+async def _until_written(persistence):
+    while persistence._write_task is not None:
+        await persistence._write_task
+
+
+def test_failed_batch_is_retried_with_growing_pause(monkeypatch, persistence):
+    flaky = FlakyWrite(persistence, failures=3)
+    monkeypatch.setattr(persistence, '_write', flaky)
+    waits = []
+    real_sleep = asyncio.sleep
+
+    async def fake_sleep(delay, *args, **kwargs):
+        if delay:
+            waits.append(delay)
+            if len(waits) == 1:
+                # Пока запись ждёт повтора, пользователь успел поменять данные
+                await persistence.update_user_data(1, {'step': 'newer'})
+        await real_sleep(0)
+
+    monkeypatch.setattr(asyncio, 'sleep', fake_sleep)
+
+    async def main():
+        await persistence.update_user_data(1, {'step': 'older'})
+        await persistence.update_user_data(2, {'step': 'only'})
+        await _until_written(persistence)
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(main())
+
+    assert waits == [1.0, 2.0, 4.0]
+    assert persistence.stats['errors'] == 3
+    assert persistence._retry_delay == 0.0
+    assert _saved_user_data(persistence) == {1: '{"step": "newer"}', 2: '{"step": "only"}'}
+    assert loop_thread not in flaky.threads
+
+
+def test_flush_does_not_wait_for_retry_pause(monkeypatch, persistence):
+    flaky = FlakyWrite(persistence, failures=1)
+    monkeypatch.setattr(persistence, '_write', flaky)
+
+    async def main():
+        await persistence.update_user_data(1, {'step': 'draft'})
+        # Первая запись падает, следующая ждёт паузы в 1 с
+        while persistence.stats['errors'] == 0:
+            await asyncio.sleep(0)
+        await asyncio.wait_for(persistence.flush(), 0.5)
+
+    asyncio.run(main())
+
+    assert persistence._write_task is None
+    assert _saved_user_data(persistence) == {1: '{"step": "draft"}'}
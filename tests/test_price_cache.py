@@ -0,0 +1,55 @@
+# tests/test_price_cache.py
+
+import asyncio
+import threading
+import time
+
+from price_cache import PriceCache
+
+
+class RecordingTier:
+    """Общий уровень в памяти, запоминающий потоки, из которых его вызывали."""
+
+    def __init__(self, entries=None):
+        self.entries = dict(entries or {})
+        self.threads = []
+
+    def get(self, coin_ids):
+        self.threads.append(threading.get_ident())
+        return {coin_id: self.entries[coin_id] for coin_id in coin_ids if coin_id in self.entries}
+
+    def put(self, entries):
+        self.threads.append(threading.get_ident())
+        for coin_id, prices, fetched_at in entries:
+            self.entries[coin_id] = (prices, fetched_at)
+
+
+def test_async_shared_tier_io_runs_off_event_loop():
+    tier = RecordingTier({'bitcoin': ({'usd': 1.0}, time.time())})
+    cache = PriceCache(100, ttl=60, stale_ttl=600, shared=tier)
+
+    async def main():
+        found = await cache.lookup_async(['bitcoin', 'ethereum'], ['usd'])
+        stored = await cache.store_async({'ethereum': {'usd': 2.0}}, ['usd'])
+        return threading.get_ident(), found, stored
+
+    loop_thread, (fresh, stale, missing), stored = asyncio.run(main())
+
+    assert fresh == {'bitcoin': {'usd': 1.0}} and stale == {} and missing == ['ethereum']
+    assert stored == {'ethereum': {'usd': 2.0}}
+    assert tier.entries['ethereum'][0] == {'usd': 2.0}
+    assert len(tier.threads) == 2
+    assert loop_thread not in tier.threads
+    assert cache.stats['shared_hits'] == 1
+
+
+def test_sync_lookup_prefers_newer_shared_entry():
+    now = time.time()
+    tier = RecordingTier({'bitcoin': ({'usd': 2.0}, now)})
+    cache = PriceCache(100, ttl=60, stale_ttl=600, shared=tier)
+    cache._put_local('bitcoin', {'usd': 1.0}, now - 120)
+
+    fresh, stale, missing = cache.lookup(['bitcoin'], ['usd'])
+
+    assert fresh == {'bitcoin': {'usd': 2.0}}
+    assert (stale, missing) == ({}, [])
@@ -0,0 +1,39 @@
+# tests/test_price_history.py
+
+import asyncio
+
+import price_history
+
+
+def test_price_history_reads_more_coins_than_one_in_batch(db):
+    coin_ids = [f"coin-{i}" for i in range(db.SQL_IN_BATCH_SIZE * 2 + 1)]
+    db.add_price_samples([(coin_id, 3600, 1.0) for coin_id in coin_ids], (3600,))
+
+    rows = db.get_price_history(coin_ids, 3600, 0)
+
+    assert sorted(row[0] for row in rows) == sorted(coin_ids)
+    assert db.get_price_history_counts(coin_ids, 3600, 0) == dict.fromkeys(coin_ids, 1)
+    assert db.get_price_history([], 3600, 0) == []
+
+
+def test_sample_prices_records_held_coins_unless_just_sampled(monkeypatch, db, coins):
+    fetched = []
+
+    async def prices(coin_ids, currencies=('usd',)):
+        fetched.append(sorted(coin_ids))
+        return {coin_id: {'usd': 10.0} for coin_id in coin_ids}
+
+    monkeypatch.setattr(price_history, 'get_coin_prices_async', prices)
+    monkeypatch.setattr(price_history, '_last_sample', 0.0)
+    db.add_user(1)
+    db.add_transaction(1, 'Bitcoin', 'btc', 1.0, 100.0, 'buy', coin_id='bitcoin')
+    db.set_reminder(1, 'sol', 50.0)
+
+    assert asyncio.run(price_history.sample_prices()) == 2
+    assert fetched == [['bitcoin', 'solana']]
+    assert {row[0] for row in db.get_price_history(['bitcoin', 'solana'], price_history.DAY, 0)} == {
+        'bitcoin', 'solana'}
+
+    # Замер только что записан (например, фоновым обновлением цен) — проход пропускается
+    assert asyncio.run(price_history.sample_prices()) == 0
+    assert len(fetched) == 1
@@ -0,0 +1,114 @@
+# tests/test_price_stream.py
+
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import price_stream as price_stream_module
+from alerts import StreamAlerts
+from price_stream import PriceStream, exchange_symbols
+
+
+def tick(pair, price):
+    return json.dumps({'stream': f"{pair.lower()}@miniTicker",
+                       'data': {'e': '24hrMiniTicker', 'E': 0, 's': pair, 'c': str(price)}})
+
+
+class FakeBot:
+    def __init__(self):
+        self.messages = []
+        self.delivered = asyncio.Event()
+
+    async def send_message(self, chat_id, text):
+        self.messages.append((chat_id, text))
+        self.delivered.set()
+
+
+@pytest.fixture
+def stream(monkeypatch, fresh_prices):
+    """Поток без пауз между подписками, пишущий в пустой кэш цен."""
+    stream = PriceStream(url='ws://unused')
+    monkeypatch.setattr(price_stream_module, 'price_stream', stream)
+    monkeypatch.setattr(price_stream_module, 'price_cache', fresh_prices)
+    monkeypatch.setattr(price_stream_module, 'SUBSCRIBE_PAUSE', 0)
+    return stream
+
+
+def test_watchlist_maps_coin_ids_to_exchange_tickers(db, coins):
+    for user_id in (1, 2, 3):
+        db.add_user(user_id)
+    db.add_transaction(1, 'Universe Token', 'uni', 100.0, 0.02, 'buy', coin_id='universe-token')
+    db.add_transaction(2, 'Solana', 'sol', 1.0, 100.0, 'buy')
+    db.set_reminder(3, 'bitcoin', 50000.0)
+    db.set_reminder(3, 'BTC', 60000.0)
+    db.set_reminder(3, 'uni', 10.0)
+
+    coins_by_ticker = exchange_symbols(db.get_coin_popularity())
+
+    # 'uni' на бирже — Uniswap (первый кандидат символа); Universe Token в поток не попадает
+    assert coins_by_ticker == {'btc': 'bitcoin', 'sol': 'solana', 'uni': 'uniswap'}
+
+
+def test_flush_keeps_each_symbol_time(monkeypatch, stream, fresh_prices):
+    stream._watched = {'btc': 'bitcoin', 'eth': 'ethereum'}
+    clock = iter([1000.0, 1005.0])
+    with monkeypatch.context() as patch:
+        patch.setattr(price_stream_module.time, 'time', lambda: next(clock))
+        stream._on_message(tick('BTCUSDT', 30000))
+        stream._on_message(tick('ETHUSDT', 2000))
+
+    assert asyncio.run(stream.flush()) == 2
+    assert fresh_prices.peek(['bitcoin', 'ethereum']) == {
+        'bitcoin': ({'usd': 30000.0}, 1000.0),
+        'ethereum': ({'usd': 2000.0}, 1005.0),
+    }
+
+
+def test_tick_fires_reminder_by_coin_id(db, coins, stream, fresh_prices):
+    db.add_user(1)
+    db.add_user(2)
+    db.set_reminder(1, 'bitcoin', 100.0)
+    db.set_reminder(2, 'uni', 5.0)
+    subscriptions = []
+
+    async def handler(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for message in ws:
+            control = json.loads(message.data)
+            subscriptions.extend(control['params'])
+            for data in (tick('BTCUSDT', 150), tick('UNIUSDT', 4), tick('XYZUSDT', 1)):
+                await ws.send_str(data)
+        return ws
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/stream', handler)
+        async with TestServer(app) as server:
+            stream.url = str(server.make_url('/stream'))
+            bot = FakeBot()
+            alerts = StreamAlerts(bot)
+            stream.add_listener(alerts.on_tick)
+            await price_stream_module.sync_stream_watchlist(alerts)
+            stream.start()
+            try:
+                await asyncio.wait_for(bot.delivered.wait(), 5)
+                await asyncio.gather(*alerts._tasks)
+                flushed = await price_stream_module.flush_stream_prices()
+            finally:
+                await stream.stop()
+            return bot.messages, alerts.fired, flushed
+
+    messages, fired, flushed = asyncio.run(main())
+
+    assert sorted(subscriptions) == ['btcusdt@miniTicker', 'uniusdt@miniTicker']
+    assert fired == 1
+    assert [chat_id for chat_id, _ in messages] == [1]
+    assert flushed == 2
+    assert fresh_prices.peek(['bitcoin'])['bitcoin'][0] == {'usd': 150.0}
+    assert fresh_prices.peek(['uniswap'])['uniswap'][0] == {'usd': 4.0}
+    # Сработавшее напоминание помечено; напоминание по 'uni' ждёт своей цены
+    assert [row[1:3] for row in db.get_all_active_reminders()] == [(2, 'uni')]
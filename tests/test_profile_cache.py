@@ -0,0 +1,126 @@
+# tests/test_profile_cache.py
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from analytics import calculate_portfolios
+from crypto_api import MarketSnapshot, fx_rates
+from database import ProfileCache
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def user(db):
+    db.add_user(1)
+    db.add_transaction(1, 'Bitcoin', 'btc', 2.0, 100.0, 'buy', coin_id='bitcoin')
+    return 1
+
+
+def test_currency_write_invalidates_read(db, user):
+    assert db.get_user_currency(user) == 'usd'
+    db.set_user_currency(user, 'eur')
+    assert db.get_user_currency(user) == 'eur'
+    assert db.get_user_currencies([user]) == {user: 'eur'}
+
+
+def test_cost_method_write_invalidates_method_and_holdings(db, user):
+    db.add_transaction(user, 'Bitcoin', 'btc', 1.0, 400.0, 'buy', coin_id='bitcoin')
+    db.add_transaction(user, 'Bitcoin', 'btc', 1.0, 500.0, 'sell', coin_id='bitcoin')
+    assert db.get_cost_method(user) == 'avg'
+    assert db.get_realized_pnl([user]) == {user: 300.0}
+
+    db.set_cost_method(user, 'lifo')
+
+    assert db.get_cost_method(user) == 'lifo'
+    assert db.get_realized_pnl([user]) == {user: 100.0}
+    assert db.get_holdings(user)[0][2] == 200.0
+
+
+def test_notifications_write_invalidates_read(db, user):
+    assert db.get_user_notifications(user) == (True, True)
+    db.toggle_daily_notification(user)
+    assert db.get_user_notifications(user) == (False, True)
+    db.toggle_weekly_notification(user)
+    assert db.get_user_profile(user)['weekly_report'] is False
+
+
+def test_trade_invalidates_portfolio_holdings_and_realized(db, user):
+    version = db.get_user_profile(user)['holdings_version']
+    assert db.get_portfolio(user) == [('btc', 2.0, 100.0, 'bitcoin')]
+    assert db.get_holdings(user) == [('btc', 2.0, 200.0, 0.0)]
+    assert db.get_realized_pnl([user]) == {user: 0.0}
+
+    db.add_transaction(user, 'Bitcoin', 'btc', 1.0, 300.0, 'sell', coin_id='bitcoin')
+
+    assert db.get_portfolio(user) == [('btc', 1.0, 100.0, 'bitcoin')]
+    assert db.get_holdings(user) == [('btc', 1.0, 100.0, 200.0)]
+    assert db.get_realized_pnl([user]) == {user: 200.0}
+    assert db.get_user_profile(user)['holdings_version'] != version
+
+
+def test_rollback_does_not_poison_cache(db, user):
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.set_user_currency(user, 'eur')
+            db.add_transaction(user, 'Bitcoin', 'btc', 5.0, 100.0, 'buy', coin_id='bitcoin')
+            # Внутри транзакции видны её же незакоммиченные данные — они попадают в кэш
+            assert db.get_user_currency(user) == 'eur'
+            assert db.get_portfolio(user)[0][1] == 7.0
+            raise RuntimeError('откат')
+
+    assert db.get_user_currency(user) == 'usd'
+    assert db.get_portfolio(user) == [('btc', 2.0, 100.0, 'bitcoin')]
+
+
+def test_load_started_before_invalidation_is_not_stored():
+    cache = ProfileCache(10)
+
+    def load():
+        # Запись другого потока успела сбросить кэш, пока шла загрузка
+        cache.invalidate(1, 'currency')
+        return 'usd'
+
+    assert cache.get(1, 'currency', load) == 'usd'
+    assert cache.get(1, 'currency', lambda: 'eur') == 'eur'
+
+
+def test_least_recently_used_users_are_evicted():
+    cache = ProfileCache(2)
+    cache.get(1, 'currency', lambda: 'usd')
+    cache.get(2, 'currency', lambda: 'eur')
+    cache.get(1, 'currency', lambda: 'unused')
+    cache.get(3, 'currency', lambda: 'rub')
+
+    assert cache.get(1, 'currency', lambda: 'reloaded') == 'usd'
+    assert cache.get(2, 'currency', lambda: 'reloaded') == 'reloaded'
+    assert cache.info()['users'] == 2
+    assert cache.stats['evictions'] == 2
+
+
+WRITER = """
+import sys
+import database
+database.DB_NAME = sys.argv[1]
+database.set_user_currency(1, 'eur')
+database.add_transaction(1, 'Bitcoin', 'btc', 1.0, 300.0, 'sell', coin_id='bitcoin')
+"""
+
+
+def test_batch_reports_see_writes_of_another_process(monkeypatch, db, user):
+    monkeypatch.setattr(fx_rates, '_rates', {'usd': 1.0, 'eur': 0.5})
+    # Кэш этого процесса уже знает валюту и прибыль пользователя
+    assert db.get_user_currency(user) == 'usd'
+    assert db.get_realized_pnl([user]) == {user: 0.0}
+
+    subprocess.run([sys.executable, '-c', WRITER, db.DB_NAME], check=True, cwd=ROOT)
+
+    result = calculate_portfolios([user], MarketSnapshot({'bitcoin': {'usd': 200.0}}))[user]
+    assert result['currency'] == 'eur'
+    assert result['assets'][0]['amount'] == 1.0
+    assert result['total']['realized'] == 200.0 * 0.5
+    # Кэш обработчиков этого процесса по-прежнему старый — пользователь не его
+    assert db.get_user_currency(user) == 'usd'
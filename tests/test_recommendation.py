@@ -0,0 +1,75 @@
+# tests/test_recommendation.py
+
+import numpy as np
+import pytest
+
+import recommendation
+from recommendation import build_scan, recommend_investment
+
+HOURS = 7 * 24 + 1
+
+
+def series(rng, drift, volatility, start=100.0):
+    """Часовые цены со случайной лог-доходностью."""
+    return start * np.exp(np.cumsum(np.r_[0.0, rng.normal(drift, volatility, HOURS - 1)]))
+
+
+@pytest.fixture
+def market(monkeypatch):
+    """Рынок из шести монет и их часовая история вместо price_history."""
+    rng = np.random.default_rng(0)
+    twin = series(rng, 0.001, 0.01)
+    history = {
+        'rising': series(rng, 0.003, 0.01),
+        'falling': series(rng, -0.003, 0.01),
+        'twin-liquid': twin,
+        'twin-thin': twin,
+        'tether': series(rng, 0.0, 0.0001, start=1.0),
+        'illiquid': series(rng, 0.005, 0.01),
+    }
+    volumes = {'rising': 5e8, 'falling': 5e8, 'twin-liquid': 9e8, 'twin-thin': 2e6,
+               'tether': 5e10, 'illiquid': 1e5}
+    markets = [{'id': coin_id, 'name': coin_id.title(), 'symbol': coin_id[:3], 'current_price': prices[-1],
+                'total_volume': volumes[coin_id], 'market_cap': 1e10} for coin_id, prices in history.items()]
+
+    def price_matrix(coin_ids, days, now=None):
+        return np.arange(HOURS), np.array([history[coin_id] for coin_id in coin_ids])
+
+    monkeypatch.setattr(recommendation, 'get_price_matrix', price_matrix)
+    return markets
+
+
+def test_stablecoins_and_low_volume_are_filtered(market):
+    scan = build_scan(market, now=1_700_000_000)
+
+    assert sorted(coin['id'] for coin in scan.coins) == ['falling', 'rising', 'twin-liquid', 'twin-thin']
+
+
+def test_results_ordered_by_probability_then_score(market):
+    scan = build_scan(market, now=1_700_000_000)
+
+    results = scan.recommend(1000, 50, 7, limit=len(scan))
+
+    probabilities = [r['probability'] for r in results]
+    assert probabilities == sorted(probabilities, reverse=True)
+    assert results[0]['name'] == 'Rising' and results[-1]['name'] == 'Falling'
+    # Одинаковая история — одинаковая вероятность; выше монета с большим оборотом
+    names = [r['name'] for r in results]
+    assert probabilities[names.index('Twin-Liquid')] == probabilities[names.index('Twin-Thin')]
+    assert names.index('Twin-Liquid') < names.index('Twin-Thin')
+    assert len(scan.recommend(1000, 50, 7)) == recommendation.RECOMMEND_RESULTS
+
+
+def test_non_positive_amount_gives_nothing(market):
+    scan = build_scan(market, now=1_700_000_000)
+
+    assert scan.recommend(0, 50, 7) == []
+    assert scan.recommend(-100, 50, 7) == []
+
+
+def test_no_recommendations_before_first_scan(monkeypatch, market):
+    monkeypatch.setattr(recommendation, '_latest_scan', None)
+    assert recommend_investment(1000, 50, 7) == []
+
+    monkeypatch.setattr(recommendation, '_latest_scan', build_scan(market, now=1_700_000_000))
+    assert recommend_investment(1000, 50, 7)
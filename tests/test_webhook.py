@@ -0,0 +1,82 @@
+# tests/test_webhook.py
+
+import asyncio
+import json
+import queue
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+import webhook
+from persistence import SQLitePersistence
+from webhook import LeaderLock, WebhookFrontend, update_user_id
+
+
+def message(update_id, user_id, text='/start'):
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'date': 0, 'text': text,
+                                                 'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+                                                 'chat': {'id': user_id, 'type': 'private'}}}
+
+
+def button(update_id, user_id, data='portfolio'):
+    return {'update_id': update_id, 'callback_query': {'id': str(update_id), 'chat_instance': '1', 'data': data,
+                                                        'from': {'id': user_id, 'is_bot': False,
+                                                                 'first_name': 'u'}}}
+
+
+def test_update_user_id():
+    assert update_user_id(message(1, 42)) == 42
+    assert update_user_id(button(2, 43)) == 43
+    assert update_user_id({'update_id': 3, 'poll': {'id': 'p'}}) == 0
+
+
+def test_user_updates_always_go_to_the_same_worker(monkeypatch, tmp_path):
+    monkeypatch.setattr(webhook, 'WEBHOOK_SECRET', None)
+    frontend = WebhookFrontend(workers=3, options={'persistence_path': str(tmp_path / 'p.db')})
+    users = [7, 8, 9, 10, 1_000_000_007, 123456789]
+    updates = [make(i * 10 + j, user_id) for i, user_id in enumerate(users)
+               for j, make in enumerate((message, button, message))]
+
+    async def main():
+        app = web.Application()
+        app.router.add_post(webhook.WEBHOOK_PATH, frontend.handle_update)
+        async with TestServer(app) as server, ClientSession() as session:
+            for update in updates:
+                async with session.post(server.make_url(webhook.WEBHOOK_PATH), json=update) as response:
+                    assert response.status == 200
+
+    asyncio.run(main())
+
+    workers_of = {}
+    for index, updates_queue in enumerate(frontend.queues):
+        while True:
+            try:
+                raw = updates_queue.get(timeout=0.2)
+            except queue.Empty:
+                break
+            workers_of.setdefault(update_user_id(json.loads(raw)), set()).add(index)
+
+    assert frontend.stats['received'] == len(updates)
+    assert set(workers_of) == set(users)
+    for user_id, workers in workers_of.items():
+        assert workers == {user_id % 3}
+        # Состояние диалогов пользователя загружает тот же процесс
+        (index,) = workers
+        assert [SQLitePersistence(shard=(i, 3))._in_shard(user_id) for i in range(3)] == [
+            i == index for i in range(3)]
+
+
+def test_second_leader_lock_waits_for_release(tmp_path):
+    path = str(tmp_path / 'locks' / 'scheduler.lock')
+    first, second = LeaderLock(path), LeaderLock(path)
+
+    assert first.acquire()
+    assert first.acquire()  # повторный захват своей блокировки
+    assert not second.acquire()
+    assert not second.held
+
+    first.release()
+
+    assert second.acquire()
+    assert not first.acquire()
+    second.release()
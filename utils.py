@@ -2,10 +2,31 @@
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+# Знаки валют: для этих пишется перед суммой ($12.50), для остальных — после (12.50 ₽)
+CURRENCY_PREFIXES = {'usd': '$', 'eur': '€', 'gbp': '£'}
+CURRENCY_SUFFIXES = {'rub': '₽', 'uah': '₴', 'tjs': 'сом.', 'kzt': '₸'}
+
+
+def format_money(amount, currency='usd', signed=False):
+    """
+    Форматирует сумму в валюте: format_money(12.5, 'eur') → '€12.50'.
+
+    :param signed: добавлять знак + для неотрицательных сумм
+    """
+    sign = '-' if amount < 0 else ('+' if signed else '')
+    currency = currency.lower()
+    if currency in CURRENCY_PREFIXES:
+        return f"{sign}{CURRENCY_PREFIXES[currency]}{abs(amount):,.2f}"
+    suffix = CURRENCY_SUFFIXES.get(currency, currency.upper())
+    return f"{sign}{abs(amount):,.2f} {suffix}"
+
+
 def main_menu_keyboard():
     keyboard = [
         [InlineKeyboardButton("💼 Портфель", callback_data="portfolio"),
          InlineKeyboardButton("📊 График", callback_data="chart")],
+        [InlineKeyboardButton("📈 Динамика", callback_data="value_chart"),
+         InlineKeyboardButton("📜 История", callback_data="history")],
         [InlineKeyboardButton("🔍 Рекомендации", callback_data="recommend"),
          InlineKeyboardButton("➕ Добавить сделку", callback_data="add_transaction")],
         [InlineKeyboardButton("🔔 Напоминания", callback_data="reminders"),
@@ -18,4 +39,51 @@ def back_to_main_menu():
     keyboard = [
         [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
     ]
-    return InlineKeyboardMarkup(keyboard)
\ No newline at end of file
+    return InlineKeyboardMarkup(keyboard)
+
+
+def value_period_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("7 дней", callback_data="value_chart_7"),
+         InlineKeyboardButton("30 дней", callback_data="value_chart_30"),
+         InlineKeyboardButton("1 год", callback_data="value_chart_365")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+COST_METHOD_NAMES = {
+    'avg': "по средней цене",
+    'fifo': "FIFO (сначала старые покупки)",
+    'lifo': "LIFO (сначала новые покупки)",
+}
+
+
+def settings_keyboard(cost_method='avg', currency='usd', currencies=('usd',)):
+    keyboard = [
+        [InlineKeyboardButton(("✅ " if method == cost_method else "") + name.split(' (')[0],
+                              callback_data=f"cost_method_{method}")]
+        for method, name in COST_METHOD_NAMES.items()
+    ]
+    keyboard.append([
+        InlineKeyboardButton(("✅ " if code == currency else "") + code.upper(),
+                             callback_data=f"currency_{code}")
+        for code in currencies
+    ])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def history_keyboard(older=None, newer=None):
+    """
+    :param older: (date, id) последней сделки на странице, если есть более старые
+    :param newer: (date, id) первой сделки на странице, если есть более новые
+    """
+    navigation = []
+    if newer:
+        navigation.append(InlineKeyboardButton("⬅️ Новее", callback_data=f"history_newer_{newer[0]}_{newer[1]}"))
+    if older:
+        navigation.append(InlineKeyboardButton("Старше ➡️", callback_data=f"history_older_{older[0]}_{older[1]}"))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("⬅️ В меню", callback_data="back_to_main")])
+    return InlineKeyboardMarkup(keyboard)
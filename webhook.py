@@ -0,0 +1,527 @@
+# webhook.py
+
+import asyncio
+import fcntl
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+from aiohttp import web
+from telegram import Bot, Update
+from telegram.ext import BaseUpdateProcessor
+from telegram.request import BaseRequest
+
+import database
+from app import build_application, on_shutdown, register_metrics, start_background
+from config import (
+    BOT_TOKEN,
+    LEADER_CHECK_INTERVAL,
+    LEADER_LOCK_PATH,
+    METRICS_ENABLED,
+    METRICS_PORT,
+    PERSISTENCE_DB,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    WEBHOOK_WORKER_CONCURRENCY,
+    WEBHOOK_WORKERS,
+)
+from charts import start_chart_pool
+from crypto_api import coin_index, fx_rates
+from metrics import registry, start_metrics_server
+from persistence import SQLitePersistence
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+WORKER_BATCH_SIZE = 256  # обновлений, забираемых из очереди за раз
+WATCHDOG_INTERVAL = 5  # как часто проверять, живы ли процессы, секунд
+
+
+def update_user_id(data):
+    """
+    ID пользователя, от которого пришло обновление (для выбора процесса).
+
+    Берётся поле from (или user, chat) вложенного объекта — сообщения,
+    нажатия кнопки и т. д.; 0 — если автора нет (например, опрос).
+    """
+    for body in data.values():
+        if isinstance(body, dict):
+            author = body.get('from') or body.get('user') or body.get('chat')
+            if isinstance(author, dict) and 'id' in author:
+                return author['id']
+    return 0
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка обновлений разных пользователей.
+
+    Обновления одного пользователя выполняются строго по очереди: иначе
+    ConversationHandler увидит следующий шаг диалога раньше, чем сохранит
+    состояние после предыдущего.
+    """
+
+    def __init__(self, max_concurrent_updates, processed=None):
+        """
+        :param max_concurrent_updates: обновлений в обработке одновременно
+        :param processed: multiprocessing.Value — общий счётчик обработанных или None
+        """
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # {user_id: [asyncio.Lock, ожидающих обновлений]}
+        self._processed = processed
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            await coroutine
+        else:
+            entry = self._locks.get(user.id)
+            if entry is None:
+                entry = self._locks[user.id] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await coroutine
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[user.id]
+        if self._processed is not None:
+            with self._processed.get_lock():
+                self._processed.value += 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class LeaderLock:
+    """
+    Выбор ведущего процесса через flock на файл.
+
+    Блокировку держит ровно один процесс; ОС снимает её, когда процесс
+    завершается (даже аварийно), и её захватывает следующий. Работает для
+    процессов одной машины.
+    """
+
+    def __init__(self, path=LEADER_LOCK_PATH):
+        self.path = path
+        self._fd = None
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def acquire(self):
+        """
+        Пытается стать ведущим, не блокируясь.
+
+        :return: True, если блокировка у этого процесса
+        """
+        if self._fd is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        # PID ведущего — для диагностики
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+class DryRunRequest(BaseRequest):
+    """
+    Заглушка Bot API для нагрузочного теста: запросы не уходят в Telegram,
+    а получают правдоподобный ответ сразу.
+    """
+
+    MESSAGE_METHODS = {'sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText'}
+
+    def __init__(self):
+        self._message_id = 0
+        self.calls = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        endpoint = url.rsplit('/', 1)[-1]
+        parameters = request_data.parameters if request_data is not None else {}
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'CryptoKeeper', 'username': 'crypto_keeper_bot'}
+        elif endpoint in self.MESSAGE_METHODS:
+            self._message_id += 1
+            result = {'message_id': self._message_id, 'date': int(time.time()),
+                      'chat': {'id': parameters.get('chat_id', 0), 'type': 'private'},
+                      'text': parameters.get('text', '')}
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+# Справочник монет для холостого режима: поиск монеты не ходит в CoinGecko
+DRY_RUN_COINS = [
+    {'id': 'bitcoin', 'symbol': 'btc', 'name': 'Bitcoin'},
+    {'id': 'ethereum', 'symbol': 'eth', 'name': 'Ethereum'},
+    {'id': 'solana', 'symbol': 'sol', 'name': 'Solana'},
+]
+
+
+def _next_batch(updates):
+    """Ждёт обновление в очереди и забирает вместе с ним уже пришедшие (в потоке)."""
+    batch = [updates.get()]
+    while len(batch) < WORKER_BATCH_SIZE and batch[-1] is not None:
+        try:
+            batch.append(updates.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+async def _elect(application, lock):
+    """Ждёт своей очереди стать ведущим и запускает планировщик."""
+    while not lock.acquire():
+        await asyncio.sleep(LEADER_CHECK_INTERVAL)
+    logger.info(f"Процесс {os.getpid()} стал ведущим: запускаю задачи планировщика")
+    await start_background(application)
+
+
+async def _run_worker(index, updates, processed, ready, options):
+    if options['db_name']:
+        database.DB_NAME = options['db_name']
+    persistence = SQLitePersistence(options['persistence_path'], shard=(index, options['workers']))
+    processor = PerUserUpdateProcessor(WEBHOOK_WORKER_CONCURRENCY, processed)
+    request = DryRunRequest() if options['dry_run'] else None
+    application = build_application(persistence, request, processor)
+    if options['dry_run']:
+        fx_rates.load_fallback()
+        coin_index.load(DRY_RUN_COINS)
+    else:
+        start_chart_pool()
+    if options['metrics']:
+        # Метрики у каждого процесса свои: процесс N отдаёт их на METRICS_PORT + 1 + N
+        register_metrics(application)
+        start_metrics_server(port=METRICS_PORT + 1 + index)
+
+    leader = LeaderLock(options['lock_path'])
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    await application.start()
+    election = asyncio.create_task(_elect(application, leader)) if options['scheduler'] else None
+    with ready.get_lock():
+        ready.value += 1
+    try:
+        stopping = False
+        while not stopping:
+            for raw in await loop.run_in_executor(None, _next_batch, updates):
+                if raw is None:
+                    stopping = True
+                    break
+                await application.update_queue.put(Update.de_json(json.loads(raw), application.bot))
+    finally:
+        if election is not None:
+            election.cancel()
+        await application.stop()
+        await application.shutdown()
+        await on_shutdown(application)
+        leader.release()
+
+
+def _worker_main(index, updates, processed, ready, options):
+    """Точка входа процесса-обработчика."""
+    try:
+        asyncio.run(_run_worker(index, updates, processed, ready, options))
+    except KeyboardInterrupt:
+        pass
+
+
+class WebhookFrontend:
+    """
+    HTTP-сервер, принимающий обновления Telegram, и процессы-обработчики.
+
+    Сервер только проверяет секрет и кладёт тело запроса в очередь процесса
+    user_id % N — все обновления пользователя обрабатывает один процесс,
+    поэтому состояние диалога (ConversationHandler) и context.user_data
+    согласованы. Само состояние сохраняется в общий SQLitePersistence: после
+    перезапуска процесса или смены N его подхватывает новый владелец.
+
+    Процессы запускают задачи планировщика только у ведущего (LeaderLock);
+    при его падении ведущим становится другой. Упавший процесс
+    перезапускается, его очередь при этом не теряется.
+    """
+
+    def __init__(self, workers=WEBHOOK_WORKERS, options=None):
+        """
+        :param workers: число процессов-обработчиков
+        :param options: переопределения для процессов — dry_run, scheduler,
+                        metrics, db_name, persistence_path, lock_path
+        """
+        self.options = {'workers': workers, 'dry_run': False, 'scheduler': True, 'metrics': METRICS_ENABLED,
+                        'db_name': None, 'persistence_path': PERSISTENCE_DB, 'lock_path': LEADER_LOCK_PATH,
+                        **(options or {})}
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = [self._context.Queue(WEBHOOK_QUEUE_SIZE) for _ in range(workers)]
+        self.processed = self._context.Value('q', 0)
+        self.ready = self._context.Value('i', 0)
+        self.processes = [None] * workers
+        self.stats = {'received': 0, 'rejected': 0, 'invalid': 0, 'restarts': 0}
+        self._watchdog = None
+
+    def _spawn(self, index):
+        process = self._context.Process(
+            target=_worker_main, name=f"bot-worker-{index}",
+            args=(index, self.queues[index], self.processed, self.ready, self.options)
+        )
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(len(self.queues)):
+            self._spawn(index)
+
+    def stop(self, timeout=30):
+        """Дожидается обработки очередей и останавливает процессы."""
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} не остановился за {timeout} с, завершаю принудительно")
+                process.terminate()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error(f"{process.name} завершился с кодом {process.exitcode}, перезапускаю")
+                    self.stats['restarts'] += 1
+                    self._spawn(index)
+
+    async def handle_update(self, request):
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        raw = await request.read()
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            self.stats['invalid'] += 1
+            return web.Response(status=400)
+        self.stats['received'] += 1
+        try:
+            self.queues[update_user_id(data) % len(self.queues)].put_nowait(raw)
+        except queue.Full:
+            # Telegram повторит доставку позже
+            self.stats['rejected'] += 1
+            return web.Response(status=503)
+        return web.Response()
+
+    async def handle_health(self, request):
+        return web.json_response({
+            **self.stats,
+            'processed': self.processed.value,
+            'workers_ready': self.ready.value,
+            'alive': [process.is_alive() for process in self.processes],
+            'queued': [updates.qsize() for updates in self.queues],
+        })
+
+    async def _on_startup(self, app):
+        self.start()
+        self._watchdog = asyncio.create_task(self._watch())
+
+    async def _on_cleanup(self, app):
+        self._watchdog.cancel()
+        await asyncio.get_running_loop().run_in_executor(None, self.stop)
+
+    def info(self):
+        """Счётчики приёма, число обработанных и длина очередей."""
+        return {
+            **self.stats,
+            'processed': self.processed.value,
+            'queued': sum(updates.qsize() for updates in self.queues),
+            'workers_alive': sum(process is not None and process.is_alive() for process in self.processes),
+        }
+
+    def make_app(self):
+        """aiohttp-приложение: POST WEBHOOK_PATH — обновления, GET /health — состояние."""
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_update)
+        app.router.add_get('/health', self.handle_health)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+
+async def _set_webhook(app):
+    async with Bot(BOT_TOKEN) as bot:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=100)
+    logger.info(f"Webhook зарегистрирован: {WEBHOOK_URL}")
+
+
+def serve(workers=WEBHOOK_WORKERS, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, dry_run=False):
+    """Запускает бота в режиме webhook."""
+    database.init_db()
+    frontend = WebhookFrontend(workers, {'dry_run': dry_run})
+    app = frontend.make_app()
+    if WEBHOOK_URL and not dry_run:
+        app.on_startup.append(_set_webhook)
+    if METRICS_ENABLED:
+        registry.register_info('webhook', frontend.info)
+        start_metrics_server()
+    print(f"Бот запущен в режиме webhook: {workers} процессов, http://{host}:{port}{WEBHOOK_PATH}")
+    web.run_app(app, host=host, port=port, print=None)
+
+
+# === НАГРУЗОЧНЫЙ ТЕСТ ===
+
+def _synthetic_updates(user_id, rounds, counter):
+    """
+    Обновления одного пользователя: /start, затем rounds раз добавление
+    сделки через диалог, история, настройки и возврат в меню.
+    """
+    chat = {'id': user_id, 'type': 'private'}
+    author = {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+
+    def message(text):
+        body = {'message_id': next(counter), 'date': int(time.time()), 'chat': chat, 'from': author, 'text': text}
+        if text.startswith('/'):
+            body['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        return {'update_id': next(counter), 'message': body}
+
+    def button(data):
+        return {'update_id': next(counter), 'callback_query': {
+            'id': str(next(counter)), 'from': author, 'chat_instance': str(user_id), 'data': data,
+            'message': {'message_id': next(counter), 'date': int(time.time()), 'chat': chat,
+                        'from': {'id': 1, 'is_bot': True, 'first_name': 'CryptoKeeper'}, 'text': '…'},
+        }}
+
+    updates = [message('/start')]
+    for _ in range(rounds):
+        updates += [button('type_buy'), message('btc'), message('0.5'), message('30000'),
+                    button('skip_exchange'), button('confirm_yes'),
+                    button('history'), button('settings'), button('back_to_main')]
+    return updates
+
+
+async def _load_test(workers, users, rounds, concurrency, data_dir):
+    import itertools
+
+    import aiohttp
+    import numpy as np
+
+    options = {
+        'dry_run': True,
+        'scheduler': False,
+        'metrics': False,
+        'db_name': os.path.join(data_dir, 'portfolio.db'),
+        'persistence_path': os.path.join(data_dir, 'persistence.db'),
+        'lock_path': os.path.join(data_dir, 'scheduler.lock'),
+    }
+    database.DB_NAME = options['db_name']
+    database.init_db()
+
+    frontend = WebhookFrontend(workers, options)
+    runner = web.AppRunner(frontend.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    while frontend.ready.value < workers:
+        await asyncio.sleep(0.1)
+
+    counter = itertools.count(1)
+    scripts = [_synthetic_updates(100000 + i, rounds, counter) for i in range(users)]
+    total = sum(len(script) for script in scripts)
+    latencies = []
+    limit = asyncio.Semaphore(concurrency)
+    url = f"http://127.0.0.1:{port}{WEBHOOK_PATH}"
+
+    async def send(session, script):
+        # Обновления одного пользователя отправляются по порядку, как это делает Telegram
+        for update in script:
+            async with limit:
+                started = time.perf_counter()
+                async with session.post(url, json=update) as response:
+                    response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        await asyncio.gather(*(send(session, script) for script in scripts))
+    accepted = time.perf_counter() - started
+    while frontend.processed.value < total:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    await runner.cleanup()
+    transactions = database.get_connection().execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+    database.close_connection()
+    latencies = np.array(latencies) * 1000
+    print(f"Процессов: {workers}, пользователей: {users}, обновлений: {total}")
+    print(f"Приём:      {total / accepted:,.0f} обновлений/с "
+          f"(p50 {np.percentile(latencies, 50):.2f} мс, p99 {np.percentile(latencies, 99):.2f} мс)")
+    print(f"Обработка:  {total / elapsed:,.0f} обновлений/с, всего {elapsed:.2f} с")
+    print(f"Сделок сохранено: {transactions} из {users * rounds}")
+
+
+def load_test(workers=WEBHOOK_WORKERS, users=200, rounds=5, concurrency=64):
+    """
+    Прогоняет синтетические обновления через сервер и процессы-обработчики
+    с заглушкой Bot API (DryRunRequest) и временной базой.
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        asyncio.run(_load_test(workers, users, rounds, concurrency, data_dir))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Режим webhook с несколькими процессами-обработчиками")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help="принимать обновления по webhook")
+    serve_parser.add_argument('--workers', type=int, default=WEBHOOK_WORKERS)
+    serve_parser.add_argument('--host', default=WEBHOOK_LISTEN)
+    serve_parser.add_argument('--port', type=int, default=WEBHOOK_PORT)
+    serve_parser.add_argument('--dry-run', action='store_true', help="не отправлять запросы в Telegram")
+    test_parser = subparsers.add_parser('loadtest', help="нагрузочный тест на синтетических обновлениях")
+    test_parser.add_argument('--workers', type=int, default=WEBHOOK_WORKERS)
+    test_parser.add_argument('--users', type=int, default=200)
+    test_parser.add_argument('--rounds', type=int, default=5, help="добавлений сделки на пользователя")
+    test_parser.add_argument('--concurrency', type=int, default=64, help="одновременных HTTP-запросов")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.workers, args.host, args.port, args.dry_run)
+    else:
+        load_test(args.workers, args.users, args.rounds, args.concurrency)